@@ -52,6 +52,47 @@ def config_parser():
         default=[],
         help="optional, specify a subset of scenes from eval_dataset to evaluate",
     )
+    parser.add_argument(
+        "--scannet_store",
+        type=str,
+        default="data/scannet_store",
+        help="root of the preprocessed ScanNet scene store read by train_scannet_store, "
+        "built with scripts/build_scannet_store.py",
+    )
+    parser.add_argument(
+        "--nearest_index_dir",
+        type=str,
+        default="data/nearest_index",
+        help="where the per-scene nearest view tables are cached, empty keeps them in memory only",
+    )
+    parser.add_argument(
+        "--manifest_dir",
+        type=str,
+        default="data/manifests",
+        help="where the ScanNet scene manifests (frames, poses, intrinsics, scan2nyu) are cached, one per split "
+        "(the val datasets share the one of --val_set_list), rebuilt for scenes whose pose files changed; "
+        "empty scans the scenes at every start",
+    )
+    parser.add_argument(
+        "--frame_pool_mb",
+        type=float,
+        default=0,
+        help="size (MB) of the shared memory pool of decoded ScanNet frames and labels, shared by all data "
+        "loader workers and ranks of a node; frames are then loaded as uint8 and converted on the gpu. 0 disables",
+    )
+    parser.add_argument(
+        "--frame_pool_name",
+        type=str,
+        default="gnt_frames",
+        help="name of the shared frame pool in /dev/shm",
+    )
+    parser.add_argument(
+        "--gpu_preprocess",
+        action="store_true",
+        help="ScanNet training frames are decoded at a reduced size to uint8 and labels returned as raw int16 ids "
+        "by the data loader workers; blur, resize, normalization and the label mapping run batched on the gpu "
+        "(not with train_scannet_store, whose frames are already preprocessed)",
+    )
     ## others
     parser.add_argument(
         "--testskip",
@@ -67,11 +108,92 @@ def config_parser():
         "--sample_mode",
         type=str,
         default="uniform",
-        help="how to sample pixels from images for training:" "uniform|center",
+        help="how to sample pixels from images for training: uniform|center|stratified|patch|importance",
     )
     parser.add_argument(
         "--center_ratio", type=float, default=0.8, help="the ratio of center crop to keep"
     )
+    parser.add_argument(
+        "--sample_patch_size", type=int, default=8, help="side of the square pixel patches of sample_mode patch"
+    )
+    parser.add_argument(
+        "--sampler_seed",
+        type=int,
+        default=234,
+        help="seed of the training pixel sampler, every rank draws from its own stream derived from it",
+    )
+    parser.add_argument(
+        "--error_map_stride",
+        type=int,
+        default=8,
+        help="pixels per cell side of the per-frame error maps of sample_mode importance",
+    )
+    parser.add_argument(
+        "--error_map_decay",
+        type=float,
+        default=0.9,
+        help="weight of the previous error of a cell when rays of a new step hit it",
+    )
+    parser.add_argument(
+        "--error_map_uniform",
+        type=float,
+        default=0.2,
+        help="share of the rays of sample_mode importance drawn uniformly over the image",
+    )
+    parser.add_argument(
+        "--skip_empty",
+        action="store_true",
+        help="place the coarse samples of every ray inside the intervals that a network-free pre-pass finds "
+        "possibly occupied (source view visibility, and source depth maps with --occupancy_depth)",
+    )
+    parser.add_argument(
+        "--occupancy_probes", type=int, default=128, help="probe intervals per ray of the --skip_empty pre-pass"
+    )
+    parser.add_argument(
+        "--occupancy_min_views",
+        type=int,
+        default=2,
+        help="source views that have to see a probe for it to be possibly occupied",
+    )
+    parser.add_argument(
+        "--occupancy_depth",
+        action="store_true",
+        help="load the ScanNet source depth maps and treat probes in front of an observed surface as empty",
+    )
+    parser.add_argument(
+        "--occupancy_depth_tol",
+        type=float,
+        default=0.05,
+        help="relative depth margin in front of an observed surface that is still kept",
+    )
+    parser.add_argument(
+        "--depth_bounds",
+        action="store_true",
+        help="sample between the per-frame near/far of scripts/compute_scannet_depth_bounds.py instead of [0.1, 10.0], "
+        "val views get the range of the frustums of their source views",
+    )
+    parser.add_argument(
+        "--fine_prune",
+        action="store_true",
+        help="at inference, drop the fine samples behind the surface found by the coarse pass (early ray termination)",
+    )
+    parser.add_argument(
+        "--fine_prune_eps",
+        type=float,
+        default=1e-3,
+        help="share of the coarse weight of a ray that may lie behind the kept fine samples",
+    )
+    parser.add_argument(
+        "--fine_prune_bucket",
+        type=int,
+        default=16,
+        help="kept samples per ray are rounded up to a multiple of it, rays of equal length run as one batch",
+    )
+    parser.add_argument(
+        "--fine_prune_compare",
+        action="store_true",
+        help="eval_scannet.py also renders every view without --fine_prune and reports the PSNR delta",
+    )
     parser.add_argument(
         "--N_rand",
         type=int,
@@ -113,6 +235,30 @@ def config_parser():
         default=True,
         help="use single network for both coarse and/or fine sampling",
     )
+    parser.add_argument(
+        "--ray_attn_backend",
+        type=str,
+        default="matmul",
+        choices=["matmul", "sdpa"],
+        help="ray transformer attention: explicit softmax(q k^T) matrices or scaled_dot_product_attention",
+    )
+    parser.add_argument(
+        "--view_attn_chunk",
+        type=int,
+        default=0,
+        help="run the view transformer attention over chunks of this many rays, recomputed in the backward "
+        "pass when training; 0 processes all rays at once",
+    )
+    parser.add_argument(
+        "--amp",
+        type=str,
+        default="none",
+        choices=["none", "bf16", "fp16"],
+        help="mixed precision for training and inference, fp16 uses a grad scaler; weights stay fp32",
+    )
+    parser.add_argument(
+        "--channels_last", action="store_true", help="use channels-last memory format for the conv nets"
+    )
 
     ########## checkpoints ##########
     parser.add_argument(
@@ -183,6 +329,63 @@ def config_parser():
         default=1,
         help="render with large stride for validation to save time",
     )
+    parser.add_argument(
+        "--fused_sampling",
+        action="store_true",
+        help="stack the reference features and deep semantics to sample them with one grid_sample "
+        "(the reference rgb keeps its own grid_sample at image resolution)",
+    )
+    parser.add_argument(
+        "--native_fpn",
+        action="store_true",
+        help="keep the FPN levels of the source views at their native strides and sample each level in the "
+        "projector, instead of upsampling all of them to the largest level and concatenating",
+    )
+    parser.add_argument(
+        "--ref_feat_cache_mb",
+        type=float,
+        default=0,
+        help="memory budget (MB) of the source view feature cache for full-image evaluation and rendering, "
+        "0 disables the cache",
+    )
+    parser.add_argument(
+        "--ref_feat_cache_device",
+        type=str,
+        default="cuda",
+        help="where the cached source view features are kept: cuda|cpu",
+    )
+    parser.add_argument(
+        "--eval_workers",
+        type=int,
+        default=1,
+        help="evaluation processes of eval.py / eval_scannet.py, spread over the visible gpus (or all on the cpu); "
+        "ignored under torch.distributed, where the ranks are the workers",
+    )
+    parser.add_argument(
+        "--eval_claim",
+        type=int,
+        default=1,
+        help="consecutive frames an evaluation worker claims at once, more keep the source views of a worker "
+        "shared for the reference feature cache",
+    )
+    parser.add_argument(
+        "--metrics_batch",
+        type=int,
+        default=4,
+        help="rendered views whose psnr/ssim/lpips go through one forward in eval_scannet.py",
+    )
+    parser.add_argument(
+        "--metrics_sync",
+        action="store_true",
+        help="compute the metrics of eval_scannet.py in the rendering thread instead of a background thread",
+    )
+    parser.add_argument(
+        "--chunk_mem_mb",
+        type=float,
+        default=0,
+        help="memory budget (MB) of one chunk in full-image rendering, the number of rays per chunk is derived "
+        "from it and adapted while rendering; 0 uses the fixed --chunk_size",
+    )
 
     ########## logging/saving options ##########
     parser.add_argument("--i_print", type=int, default=100, help="frequency of terminal printout")
@@ -192,6 +395,23 @@ def config_parser():
     parser.add_argument(
         "--save_interval", type=int, default=10000, help="frequency of weight ckpt saving"
     )
+    parser.add_argument(
+        "--async_ckpt",
+        action="store_true",
+        help="write checkpoints from a background thread, the training loop only waits for a copy to host memory",
+    )
+    parser.add_argument(
+        "--ckpt_keep",
+        type=int,
+        default=0,
+        help="with --async_ckpt, number of newest model_<step>.pth kept in the out folder, 0 keeps all",
+    )
+    parser.add_argument(
+        "--ckpt_skip_unchanged",
+        action="store_true",
+        help="with --async_ckpt, sub-networks are written to shards/ and the ones unchanged since the last save "
+        "(e.g. frozen) are not written again",
+    )
 
     ########## evaluation options ##########
     parser.add_argument(
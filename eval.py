@@ -4,7 +4,7 @@ import shutil
 import torch
 import torch.utils.data.distributed
 
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, default_collate
 
 from gnt.data_loaders import dataset_dict
 from gnt.render_image import render_single_image
@@ -14,6 +14,7 @@ from utils import img_HWC2CHW, colorize, img2psnr, lpips, ssim
 import config
 import torch.distributed as dist
 from gnt.projection import Projector
+from gnt.sharded_eval import run_sharded
 from gnt.data_loaders.create_training_dataset import create_training_dataset
 import imageio
 
@@ -37,6 +38,56 @@ def synchronize():
     dist.barrier()
 
 
+class EvalWorker(object):
+    """
+    evaluates frames of the validation set on its own device with its own model,
+    run by every worker of gnt.sharded_eval.run_sharded
+    """
+
+    def __init__(self, args, out_folder):
+        self.args = args
+        self.out_folder = out_folder
+
+    @torch.no_grad()
+    def __call__(self, rank, counter):
+        args = self.args
+        if not args.distributed:
+            # local worker processes are spread over the visible gpus
+            args.local_rank = rank % max(torch.cuda.device_count(), 1)
+        device = torch.device("cuda:{}".format(args.local_rank) if torch.cuda.is_available() else "cpu")
+        if device.type == "cuda":
+            torch.cuda.set_device(device)
+        dataset = dataset_dict[args.eval_dataset](args, "validation", scenes=args.eval_scenes)
+        model = GNTModel(
+            args, load_opt=not args.no_load_opt, load_scheduler=not args.no_load_scheduler
+        )
+        projector = Projector(device=device)
+
+        results = []
+        for indx in counter:
+            # a batch of one, as DataLoader(batch_size=1) yields it
+            data = default_collate([dataset[indx]])
+            tmp_ray_sampler = RaySamplerSingleImage(data, device, render_stride=args.render_stride)
+            H, W = tmp_ray_sampler.H, tmp_ray_sampler.W
+            gt_img = tmp_ray_sampler.rgb.reshape(H, W, 3)
+            results.append((indx, log_view(
+                indx,
+                args,
+                model,
+                tmp_ray_sampler,
+                projector,
+                gt_img,
+                render_stride=args.render_stride,
+                prefix="val/",
+                out_folder=self.out_folder,
+                ret_alpha=args.N_importance > 0,
+                single_net=args.single_net,
+            )))
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+        return results
+
+
 @torch.no_grad()
 def eval(args):
 
@@ -57,26 +108,35 @@ def eval(args):
         if not os.path.isfile(f):
             shutil.copy(args.config, f)
 
-    if args.run_val == False:
-        # create training dataset
-        dataset, sampler = create_training_dataset(args)
-        # currently only support batch_size=1 (i.e., one set of target and source views) for each GPU node
-        # please use distributed parallel on multiple GPUs to train multiple target views per batch
-        loader = torch.utils.data.DataLoader(
-            dataset,
-            batch_size=1,
-            worker_init_fn=lambda _: np.random.seed(),
-            num_workers=args.num_workers,
-            pin_memory=True,
-            sampler=sampler,
-            shuffle=True if sampler is None else False,
+    if args.run_val:
+        # the frames of the validation set, spread over the ranks or --eval_workers processes
+        n_frames = len(dataset_dict[args.eval_dataset](args, "validation", scenes=args.eval_scenes))
+        results, seconds = run_sharded(
+            EvalWorker(args, out_folder), n_frames, num_workers=args.eval_workers, claim=args.eval_claim
         )
-        iterator = iter(loader)
-    else:
-        # create validation dataset
-        dataset = dataset_dict[args.eval_dataset](args, "validation", scenes=args.eval_scenes)
-        loader = DataLoader(dataset, batch_size=1)
-        iterator = iter(loader)
+        if dist.is_initialized() and dist.get_rank() != 0:
+            return
+        print("evaluated {} views in {:.1f}s, {:.3f} views/s".format(n_frames, seconds, n_frames / seconds))
+        psnr_scores, lpips_scores, ssim_scores = (list(x) for x in zip(*results))
+        print("Average PSNR: ", np.mean(psnr_scores))
+        print("Average LPIPS: ", np.mean(lpips_scores))
+        print("Average SSIM: ", np.mean(ssim_scores))
+        return
+
+    # create training dataset
+    dataset, sampler = create_training_dataset(args)
+    # currently only support batch_size=1 (i.e., one set of target and source views) for each GPU node
+    # please use distributed parallel on multiple GPUs to train multiple target views per batch
+    loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=1,
+        worker_init_fn=lambda _: np.random.seed(),
+        num_workers=args.num_workers,
+        pin_memory=True,
+        sampler=sampler,
+        shuffle=True if sampler is None else False,
+    )
+    iterator = iter(loader)
 
     # Create GNT model
     model = GNTModel(
@@ -232,8 +292,11 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     if args.distributed:
-        torch.cuda.set_device(args.local_rank)
-        torch.distributed.init_process_group(backend="nccl", init_method="env://")
+        if torch.cuda.is_available():
+            torch.cuda.set_device(args.local_rank)
+        # gloo for cpu-only ranks
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+        torch.distributed.init_process_group(backend=backend, init_method="env://")
         synchronize()
 
     eval(args)
@@ -5,19 +5,47 @@ import torch
 import torch.utils.data.distributed
 from torch.nn import functional as F
 
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, default_collate
 
 from gnt.data_loaders import dataset_dict
-from gnt.render_image import render_single_image
+from gnt.render_image import render_single_image, make_chunk_sizer
+from gnt.render_ray import OccupancyProxy, FineSamplePruner
 from gnt.model import GNTModel
 from gnt.sample_ray import RaySamplerSingleImage
-from utils import img_HWC2CHW, colorize, img2psnr, lpips, ssim
+from utils import img_HWC2CHW, colorize, MetricsEngine, metrics_engine
 import config
 import torch.distributed as dist
 from gnt.projection import Projector
+from gnt.feature_cache import ReferenceFeatureCache
 import imageio
 
-from gnt.loss import SemanticLoss, IoU
+from gnt.loss import SemanticLoss, IoU, ConfusionMatrix, confusion_scores
+from gnt.sharded_eval import run_sharded
+
+
+SEMANTIC_COLOR_MAP = [
+    [174, 199, 232],  # wall
+    [152, 223, 138],  # floor
+    [31, 119, 180],   # cabinet
+    [255, 187, 120],  # bed
+    [188, 189, 34],   # chair
+    [140, 86, 75],    # sofa
+    [255, 152, 150],  # table
+    [214, 39, 40],    # door
+    [197, 176, 213],  # window
+    [148, 103, 189],  # bookshelf
+    [196, 156, 148],  # picture
+    [23, 190, 207],   # counter
+    [247, 182, 210],  # desk
+    [219, 219, 141],  # curtain
+    [255, 127, 14],   # refrigerator
+    [91, 163, 138],   # shower curtain
+    [44, 160, 44],    # toilet
+    [112, 128, 144],  # sink
+    [227, 119, 194],  # bathtub
+    [82, 84, 163],    # otherfurn
+    [248, 166, 116]  # invalid
+]
 
 
 def worker_init_fn(worker_id):
@@ -39,10 +67,126 @@ def synchronize():
     dist.barrier()
 
 
+class EvalWorker(object):
+    """
+    evaluates (scene, frame) work items of the validation scenes on its own device with its own model,
+    run by every worker of gnt.sharded_eval.run_sharded
+    """
+
+    def __init__(self, args, val_scenes, items, out_folder):
+        self.args = args
+        self.val_scenes = val_scenes
+        self.items = items
+        self.out_folder = out_folder
+
+    @torch.no_grad()
+    def __call__(self, rank, counter):
+        args = self.args
+        if not args.distributed:
+            # local worker processes are spread over the visible gpus
+            args.local_rank = rank % max(torch.cuda.device_count(), 1)
+        device = torch.device("cuda:{}".format(args.local_rank) if torch.cuda.is_available() else "cpu")
+        if device.type == "cuda":
+            torch.cuda.set_device(device)
+
+        # Create GNT model
+        model = GNTModel(
+            args, load_opt=not args.no_load_opt, load_scheduler=not args.no_load_scheduler
+        )
+        # create projector
+        projector = Projector(device=device)
+        # source views are shared by consecutive frames, encode each of them once
+        # (not with rectify_inplane_rotation, which warps the sources per target view)
+        if args.ref_feat_cache_mb > 0 and not args.rectify_inplane_rotation:
+            ref_feat_cache = ReferenceFeatureCache(args.ref_feat_cache_mb, storage=args.ref_feat_cache_device)
+        else:
+            ref_feat_cache = None
+        # rays per chunk adapted to --chunk_mem_mb over all rendered views, None keeps --chunk_size
+        chunk_sizer = make_chunk_sizer(args)
+        # empty-space skipping pre-pass with --skip_empty, None otherwise
+        occupancy = OccupancyProxy.from_args(args)
+        # early ray termination in the fine pass with --fine_prune, None otherwise
+        pruner = FineSamplePruner.from_args(args)
+        # psnr/ssim/lpips of batches of views on the device, in a background thread unless --metrics_sync
+        metrics = MetricsEngine.from_args(args, device)
+
+        iou_criterion = IoU(args)
+        semantic_criterion = SemanticLoss(args)
+
+        # validation scenes are opened when the worker gets their first frame
+        val_datasets = {}
+        # confusion matrix of every scene, over the views of the scene this worker evaluates
+        confusions = {}
+        # last result of every scene, it carries the confusion matrix of the scene back to eval
+        last_results = {}
+        results = []
+        for item in counter:
+            scene_idx, frame_idx = self.items[item]
+            if scene_idx not in val_datasets:
+                val_datasets[scene_idx] = dataset_dict['val_scannet'](
+                    args, is_train=False, scenes=self.val_scenes[scene_idx]
+                )
+                confusions[scene_idx] = ConfusionMatrix.from_args(args, device)
+            # a batch of one, as DataLoader(batch_size=1) yields it
+            val_data = default_collate([val_datasets[scene_idx][frame_idx]])
+
+            tmp_ray_sampler = RaySamplerSingleImage(val_data, device, render_stride=args.render_stride)
+            H, W = tmp_ray_sampler.H, tmp_ray_sampler.W
+            gt_img = tmp_ray_sampler.rgb.reshape(H, W, 3)
+            gt_labels = tmp_ray_sampler.labels.reshape(H, W, 1)
+
+            view_args = dict(
+                evaluator=[iou_criterion, semantic_criterion],
+                render_stride=args.render_stride,
+                out_folder=self.out_folder,
+                ret_alpha=args.N_importance > 0,
+                single_net=args.single_net,
+                ref_feat_cache=ref_feat_cache,
+                chunk_sizer=chunk_sizer,
+                occupancy=occupancy,
+                metrics=metrics,
+            )
+            prefix = "val/" if args.run_val else "train/"
+            scores = log_view(
+                frame_idx, args, model, tmp_ray_sampler, projector, gt_img, gt_labels,
+                prefix=prefix, pruner=pruner, confusion=confusions[scene_idx], **view_args
+            )
+            # metrics stay pending and the confusion matrix on the device, no host sync per view
+            result = {"scores": scores}
+            if pruner is not None and args.fine_prune_compare:
+                # the same view without pruning, for the PSNR cost of --fine_prune
+                result["full_scores"] = log_view(
+                    frame_idx, args, model, tmp_ray_sampler, projector, gt_img, gt_labels,
+                    prefix="full_" + prefix, **view_args
+                )
+            results.append((item, result))
+            last_results[scene_idx] = result
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+
+        metrics.close()
+        for _, r in results:
+            r.update(r.pop("scores").result())
+            if "full_scores" in r:
+                r["prune_psnr_delta"] = r["psnr"] - r.pop("full_scores").result()["psnr"]
+        # one matrix per scene and worker to the host, eval sums them over the workers
+        for scene_idx, r in last_results.items():
+            r["conf_mat"] = confusions[scene_idx].mat.cpu().numpy()
+
+        if ref_feat_cache is not None:
+            print("worker {}: {}".format(rank, ref_feat_cache.stats()))
+        if chunk_sizer is not None:
+            print("worker {}: {}".format(rank, chunk_sizer))
+        if occupancy is not None:
+            print("worker {}: {}".format(rank, occupancy.stats()))
+        if pruner is not None:
+            print("worker {}: {}".format(rank, pruner.stats()))
+        return results
+
+
 @torch.no_grad()
 def eval(args):
 
-    device = "cuda:{}".format(args.local_rank)
     out_folder = os.path.join(args.rootdir, "out", args.expname)
     print("outputs will be saved to {}".format(out_folder))
     os.makedirs(out_folder, exist_ok=True)
@@ -59,73 +203,76 @@ def eval(args):
         if not os.path.isfile(f):
             shutil.copy(args.config, f)
 
-    # create validation dataset
-    val_set_lists, val_set_names = [], []
-    val_scenes = np.loadtxt(args.val_set_list, dtype=str).tolist()
-    for name in val_scenes:
+    # work items: every frame of every validation scene, spread over the ranks or --eval_workers processes
+    val_scenes = np.loadtxt(args.val_set_list, dtype=str, ndmin=1).tolist()
+    items = []
+    for scene_idx, name in enumerate(val_scenes):
         val_dataset = dataset_dict['val_scannet'](args, is_train=False, scenes=name)
-        val_loader = DataLoader(val_dataset, batch_size=1)
-        val_set_lists.append(val_loader)
-        val_set_names.append(name)
-        print(f'{name} val set len {len(val_loader)}')
-
-    # Create GNT model
-    model = GNTModel(
-        args, load_opt=not args.no_load_opt, load_scheduler=not args.no_load_scheduler
-    )
-    # create projector
-    projector = Projector(device=device)
-
-    iou_criterion = IoU(args)
-    semantic_criterion = SemanticLoss(args)
+        items += [(scene_idx, frame_idx) for frame_idx in range(len(val_dataset))]
+        print(f'{name} val set len {len(val_dataset)}')
 
+    results, seconds = run_sharded(
+        EvalWorker(args, val_scenes, items, out_folder), len(items),
+        num_workers=args.eval_workers, claim=args.eval_claim,
+    )
+    if dist.is_initialized() and dist.get_rank() != 0:
+        return None
+    num_workers = dist.get_world_size() if dist.is_initialized() else max(args.eval_workers, 1)
+    print("evaluated {} views with {} workers in {:.1f}s, {:.3f} views/s".format(
+        len(items), num_workers, seconds, len(items) / seconds))
+
+    # merged in item order, the same means as a sequential run
+    # mIoU and accuracies of the confusion matrix summed over the views of a scene, and over all scenes
     all_psnr_scores,all_lpips_scores,all_ssim_scores, all_iou_scores = [],[],[],[]
-    for val_scene, val_name in zip(val_set_lists, val_set_names):
-        indx = 0
-        psnr_scores,lpips_scores,ssim_scores, iou_scores = [],[],[],[]
-        for val_data in val_scene:
-            tmp_ray_sampler = RaySamplerSingleImage(val_data, device, render_stride=args.render_stride)
-            H, W = tmp_ray_sampler.H, tmp_ray_sampler.W
-            gt_img = tmp_ray_sampler.rgb.reshape(H, W, 3)
-            gt_labels = tmp_ray_sampler.labels.reshape(H, W, 1)
-
-            psnr_curr_img, lpips_curr_img, ssim_curr_img, iou_metric = log_view(
-                indx,
-                args,
-                model,
-                tmp_ray_sampler,
-                projector,
-                gt_img,
-                gt_labels,
-                evaluator=[iou_criterion, semantic_criterion],
-                render_stride=args.render_stride,
-                prefix="val/" if args.run_val else "train/",
-                out_folder=out_folder,
-                ret_alpha=args.N_importance > 0,
-                single_net=args.single_net,
-            )
-            psnr_scores.append(psnr_curr_img)
-            lpips_scores.append(lpips_curr_img)
-            ssim_scores.append(ssim_curr_img)
-            iou_scores.append(iou_metric)
-            torch.cuda.empty_cache()
-            indx += 1
-        print("Average {} PSNR: {}, LPIPS: {}, SSIM: {}, IoU: {}".format(
+    total_conf_mat = 0
+    for scene_idx, val_name in enumerate(val_scenes):
+        scene_results = [r for (s, _), r in zip(items, results) if s == scene_idx]
+        psnr_scores = [r["psnr"] for r in scene_results]
+        lpips_scores = [r["lpips"] for r in scene_results]
+        ssim_scores = [r["ssim"] for r in scene_results]
+        conf_mat = sum(r["conf_mat"] for r in scene_results if "conf_mat" in r)
+        total_conf_mat = total_conf_mat + conf_mat
+        scene_sem = confusion_scores(conf_mat)
+        print("Average {} PSNR: {}, LPIPS: {}, SSIM: {}, mIoU: {}, accuracy: {}, class accuracy: {}".format(
             val_name, 
             np.mean(psnr_scores),
             np.mean(lpips_scores),
             np.mean(ssim_scores),
-            np.mean(iou_scores)))
+            scene_sem["miou"].item(),
+            scene_sem["total_accuracy"].item(),
+            scene_sem["class_average_accuracy"].item()))
         all_psnr_scores.append(np.mean(psnr_scores))
         all_lpips_scores.append(np.mean(lpips_scores))
         all_ssim_scores.append(np.mean(ssim_scores))
-        all_iou_scores.append(np.mean(iou_scores))    
-    print("Overall PSNR: {}, LPIPS: {}, SSIM: {}, IoU: {}".format(
-        np.mean(all_psnr_scores),
-        np.mean(all_lpips_scores),
-        np.mean(all_ssim_scores),
-        np.mean(all_iou_scores)))
-    
+        all_iou_scores.append(scene_sem["miou"].item())
+    global_sem = confusion_scores(total_conf_mat)
+    summary = {
+        "psnr": np.mean(all_psnr_scores),
+        "lpips": np.mean(all_lpips_scores),
+        "ssim": np.mean(all_ssim_scores),
+        "iou": np.mean(all_iou_scores),
+        "global_iou": global_sem["miou"].item(),
+        "global_accuracy": global_sem["total_accuracy"].item(),
+        "global_class_accuracy": global_sem["class_average_accuracy"].item(),
+        "seconds": seconds,
+    }
+    print("Overall PSNR: {}, LPIPS: {}, SSIM: {}, mIoU: {} (mean of the scenes)".format(
+        summary["psnr"], summary["lpips"], summary["ssim"], summary["iou"]))
+    print("Global mIoU: {}, accuracy: {}, class accuracy: {} (all views of all scenes)".format(
+        summary["global_iou"], summary["global_accuracy"], summary["global_class_accuracy"]))
+    prune_psnr_deltas = [r["prune_psnr_delta"] for r in results if "prune_psnr_delta" in r]
+    if prune_psnr_deltas:
+        print("fine pruning PSNR delta: mean {:.4f}, min {:.4f}".format(
+            np.mean(prune_psnr_deltas), np.min(prune_psnr_deltas)))
+    return summary
+
+
+def print_scores(prefix, future):
+    if future.exception() is None:
+        scores = future.result()
+        print(prefix + "psnr_image: ", scores["psnr"])
+        print(prefix + "lpips_image: ", scores["lpips"])
+        print(prefix + "ssim_image: ", scores["ssim"])
 
 
 @torch.no_grad()
@@ -143,14 +290,41 @@ def log_view(
     out_folder="",
     ret_alpha=False,
     single_net=True,
+    ref_feat_cache=None,
+    chunk_sizer=None,
+    occupancy=None,
+    pruner=None,
+    metrics=None,
+    confusion=None,
 ):
+    """
+    renders a view and writes its images
+    :param metrics: MetricsEngine the scores are submitted to, the synchronous utils.metrics_engine if None
+    :param confusion: ConfusionMatrix the semantics of the view are added to, if any
+    :return: Future of the psnr/ssim/lpips of the view
+    """
+    if metrics is None:
+        metrics = metrics_engine
     model.switch_to_eval()
-    with torch.no_grad():
+    with torch.no_grad(), model.autocast():
         ray_batch = ray_sampler.get_all()
-        
-        ref_coarse_feats, fine_feats, ref_deep_semantics = model.feature_net(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
-        ref_deep_semantics = model.feature_fpn(ref_deep_semantics)
+
+        def encode_reference(src_imgs):
+            ref_coarse_feats, _, ref_deep_semantics = model.feature_net(src_imgs)
+            return ref_coarse_feats, model.reference_fpn(ref_deep_semantics)
+
+        src_imgs = ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2)
+        if ref_feat_cache is not None and ray_sampler.src_rgb_paths is not None:
+            ref_coarse_feats, ref_deep_semantics = ref_feat_cache.lookup(
+                ray_sampler.src_rgb_paths, src_imgs, encode_reference, step=model.start_step
+            )
+        else:
+            ref_coarse_feats, ref_deep_semantics = encode_reference(src_imgs)
         device = ref_coarse_feats.device
+        if args.fused_sampling:
+            ref_stack = projector.stack_reference(ref_coarse_feats, ref_deep_semantics)
+        else:
+            ref_stack = None
         ret = render_single_image(
             ray_sampler=ray_sampler,
             ray_batch=ray_batch,
@@ -167,6 +341,10 @@ def log_view(
             deep_semantics=ref_deep_semantics, # encoder的语义输出
             ret_alpha=ret_alpha,
             single_net=single_net,
+            ref_stack=ref_stack,
+            chunk_sizer=chunk_sizer,
+            occupancy=occupancy,
+            pruner=pruner,
         )
 
         # ret['outputs_coarse']['sems'] = model.sem_seg_head(ret['outputs_coarse']['feats_out'].permute(2,0,1).unsqueeze(0).to(device), None, None).permute(0,2,3,1)
@@ -224,18 +402,12 @@ def log_view(
         if ret["outputs_fine"] is not None else ret["outputs_coarse"]["rgb"]
     )
 
-    lpips_curr_img = lpips(pred_rgb, gt_img, format="HWC").item()
-    ssim_curr_img = ssim(pred_rgb, gt_img, format="HWC").item()
-    psnr_curr_img = img2psnr(pred_rgb.detach().cpu(), gt_img)
-    iou_metric = evaluator[0](ret, ray_batch, global_step)
+    scores = metrics.submit(pred_rgb, gt_img, format="HWC")
+    scores.add_done_callback(lambda future: print_scores(prefix, future))
+    evaluator[0](ret, ray_batch, global_step, metric=confusion)
     sem_imgs = evaluator[1].plot_semantic_results(ret["outputs_coarse"], ray_batch, global_step)
-
-    print(prefix + "psnr_image: ", psnr_curr_img)
-    print(prefix + "lpips_image: ", lpips_curr_img)
-    print(prefix + "ssim_image: ", ssim_curr_img)
-    print(prefix + "iou: ", iou_metric['miou'].item())
     model.switch_to_train()
-    return psnr_curr_img, lpips_curr_img, ssim_curr_img, iou_metric['miou'].item()
+    return scores
 
 
 
@@ -243,32 +415,13 @@ if __name__ == "__main__":
     parser = config.config_parser()
     parser.add_argument("--run_val", action="store_true", help="run on val set")
     args = parser.parse_args()
-    args.semantic_color_map=[
-        [174, 199, 232],  # wall
-        [152, 223, 138],  # floor
-        [31, 119, 180],   # cabinet
-        [255, 187, 120],  # bed
-        [188, 189, 34],   # chair
-        [140, 86, 75],    # sofa
-        [255, 152, 150],  # table
-        [214, 39, 40],    # door
-        [197, 176, 213],  # window
-        [148, 103, 189],  # bookshelf
-        [196, 156, 148],  # picture
-        [23, 190, 207],   # counter
-        [247, 182, 210],  # desk
-        [219, 219, 141],  # curtain
-        [255, 127, 14],   # refrigerator
-        [91, 163, 138],   # shower curtain
-        [44, 160, 44],    # toilet
-        [112, 128, 144],  # sink
-        [227, 119, 194],  # bathtub
-        [82, 84, 163],    # otherfurn
-        [248, 166, 116]  # invalid
-    ]
+    args.semantic_color_map = SEMANTIC_COLOR_MAP
     if args.distributed:
-        torch.cuda.set_device(args.local_rank)
-        torch.distributed.init_process_group(backend="nccl", init_method="env://")
+        if torch.cuda.is_available():
+            torch.cuda.set_device(args.local_rank)
+        # gloo for cpu-only ranks
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+        torch.distributed.init_process_group(backend=backend, init_method="env://")
         synchronize()
 
     eval(args)
@@ -165,7 +165,7 @@ def train(args):
 
                 # reference feature extractor
                 ref_coarse_feats, ref_fine_feats, ref_deep_semantics = model.feature_net(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
-                ref_deep_semantics = model.feature_fpn(ref_deep_semantics)
+                ref_deep_semantics = model.reference_fpn(ref_deep_semantics)
 
                 # novel view feature extractor
                 _, _, que_deep_semantics = model.feature_net(train_data["rgb"].permute(0, 3, 1, 2).to(device))
@@ -292,6 +292,8 @@ def train(args):
                 if global_step > model.start_step + args.total_step + 1:
                     break
             epoch += 1
+    # the last checkpoint of --async_ckpt is on disk before the process exits
+    model.wait_for_checkpoint()
     if args.expname != 'debug':
         print("All Scenes best IoU results: {}".format(all_iou_scores))
         wandb.log(all_iou_scores) # 输出所有的最优iou
@@ -321,7 +323,7 @@ def log_view(
         ray_batch = ray_sampler.get_all()
 
         ref_coarse_feats, fine_feats, ref_deep_semantics = model.feature_net(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
-        ref_deep_semantics = model.feature_fpn(ref_deep_semantics)
+        ref_deep_semantics = model.reference_fpn(ref_deep_semantics)
 
         _, _, que_deep_semantics = model.feature_net(gt_img.unsqueeze(0).permute(0, 3, 1, 2).to(ref_coarse_feats.device))
         que_deep_semantics = model.feature_fpn(que_deep_semantics)
@@ -344,8 +346,8 @@ def log_view(
             single_net=single_net,
         )
         
-        ret['outputs_coarse']['sems'] = model.sem_seg_head(ret['outputs_coarse']['feats_out'].permute(2,0,1).unsqueeze(0).to(ref_coarse_feats.device), None, None).permute(0,2,3,1)
-        ret['outputs_fine']['sems'] = model.sem_seg_head(ret['outputs_fine']['feats_out'].permute(2,0,1).unsqueeze(0).to(ref_coarse_feats.device), None, None).permute(0,2,3,1)
+        ret['outputs_coarse']['sems'] = model.sem_seg_head(ret['outputs_coarse']['feats_out'].permute(2,0,1).unsqueeze(0).to(ref_coarse_feats.device), None, None, out_size=(ray_sampler.H, ray_sampler.W)).permute(0,2,3,1)
+        ret['outputs_fine']['sems'] = model.sem_seg_head(ret['outputs_fine']['feats_out'].permute(2,0,1).unsqueeze(0).to(ref_coarse_feats.device), None, None, out_size=(ray_sampler.H, ray_sampler.W)).permute(0,2,3,1)
 
 
     average_im = ray_sampler.src_rgbs.cpu().mean(dim=(0, 1))
@@ -0,0 +1,51 @@
+import torch
+
+########################################################################################################################
+# mixed precision and channels-last helpers
+########################################################################################################################
+
+AMP_DTYPES = {"none": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def amp_dtype(name):
+    """
+    :param name: none|bf16|fp16, the --amp option
+    :return: the autocast dtype, None if mixed precision is disabled
+    """
+    if name not in AMP_DTYPES:
+        raise ValueError("unknown amp mode {}, expected one of {}".format(name, list(AMP_DTYPES)))
+    return AMP_DTYPES[name]
+
+
+def autocast(device, dtype):
+    """
+    autocast context for the forward pass (and the loss), a no-op if dtype is None.
+    parameters stay in fp32, so checkpoints of amp and fp32 runs are interchangeable
+    :param device: torch.device the model runs on, cpu supports bf16 only
+    :param dtype: torch.bfloat16 | torch.float16 | None
+    """
+    return torch.autocast(device_type=device.type, dtype=dtype, enabled=dtype is not None)
+
+
+def make_grad_scaler(device, dtype):
+    """
+    fp16 gradients need loss scaling, bf16 has the fp32 exponent range and does not.
+    a disabled scaler passes scale/step/update straight through to the optimizer
+    """
+    return torch.amp.GradScaler(device.type, enabled=dtype == torch.float16)
+
+
+def to_channels_last(*nets):
+    """
+    move the conv nets to channels-last memory format, None entries are skipped
+    """
+    for net in nets:
+        if net is not None:
+            net.to(memory_format=torch.channels_last)
+
+
+def contiguous_state_dict(net):
+    """
+    state dict with contiguous tensors, so that a checkpoint does not depend on the memory format used for training
+    """
+    return {k: v.contiguous() for k, v in net.state_dict().items()}
@@ -0,0 +1,164 @@
+import os
+import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+########################################################################################################################
+# asynchronous checkpoint writing
+########################################################################################################################
+
+# checkpoints of the save_interval, the ones the retention policy applies to (not e.g. best_<scene>.pth)
+CKPT_PATTERN = re.compile(r"model_\d+\.pth$")
+SHARD_DIR = "shards"
+
+
+def load_checkpoint(filename, map_location=None):
+    """
+    torch.load of a checkpoint, with the sub-networks written to shards (AsyncCheckpointWriter with skip_unchanged)
+    read back into it. shards are kept in <checkpoint dir>/shards/ and referenced by relative path
+    """
+    to_load = torch.load(filename, map_location=map_location)
+    for name, shard in to_load.pop("shards", {}).items():
+        to_load[name] = torch.load(os.path.join(os.path.dirname(filename), shard), map_location=map_location)
+    return to_load
+
+
+def module_version(net):
+    """
+    changes whenever a tensor of the state of net is replaced or modified in place (optimizer steps, running
+    statistics, load_state_dict), without reading the tensors
+    """
+    return tuple((k, v.data_ptr(), v._version) for k, v in net.state_dict(keep_vars=True).items())
+
+
+def atomic_save(obj, filename):
+    # a crash while writing never leaves a truncated checkpoint that load_from_ckpt would pick up
+    tmp = filename + ".tmp"
+    torch.save(obj, tmp)
+    os.replace(tmp, filename)
+
+
+class AsyncCheckpointWriter(object):
+    """
+    saves checkpoints from a background thread. save() only copies the state to (pinned) host buffers, reused
+    from one save to the next, and returns while the file is written; a save first waits for the previous one.
+    files are written under a temporary name and renamed, and only the newest keep model_<step>.pth are kept.
+    with skip_unchanged every sub-network goes to its own shard file and a sub-network whose state did not
+    change since the last save (e.g. a frozen backbone) is neither copied nor written again, the checkpoint
+    references its previous shard
+    """
+
+    def __init__(self, keep=0, skip_unchanged=False):
+        self.keep = keep
+        self.skip_unchanged = skip_unchanged
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+        self.pending = None
+        self.buffers = {}
+        # name -> (module_version, shard) of the last save
+        self.shards = {}
+        # checkpoint -> shards it references, of the checkpoints written by this writer
+        self.refs = {}
+
+    @classmethod
+    def from_args(cls, args):
+        if not args.async_ckpt:
+            return None
+        return cls(keep=args.ckpt_keep, skip_unchanged=args.ckpt_skip_unchanged)
+
+    def snapshot(self, obj, key=()):
+        """
+        copy of the tensors of a nested state dict in host buffers, device copies are issued without a sync.
+        the buffers are contiguous, the checkpoint does not depend on the memory format used for training
+        """
+        if isinstance(obj, dict):
+            return {k: self.snapshot(v, key + (k,)) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.snapshot(v, key + (i,)) for i, v in enumerate(obj))
+        if not torch.is_tensor(obj):
+            return obj
+        buf = self.buffers.get(key)
+        if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+            buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+            self.buffers[key] = buf
+        return buf.copy_(obj, non_blocking=obj.is_cuda)
+
+    def wait(self):
+        """
+        blocks until the last checkpoint is written, raises its error if writing failed
+        """
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def save(self, filename, state, modules):
+        """
+        :param state: optimizer, scheduler, ... state dicts
+        :param modules: name -> sub-network, saved as its state dict
+        """
+        # the buffers of the previous save are reused
+        self.wait()
+        to_save = self.snapshot(state, ("state",))
+        shards, shard_states = {}, {}
+        for name, net in modules.items():
+            if not self.skip_unchanged:
+                to_save[name] = self.snapshot(net.state_dict(), ("module", name))
+                continue
+            version = module_version(net)
+            if name in self.shards and self.shards[name][0] == version:
+                shards[name] = self.shards[name][1]
+                continue
+            # a fresh name, the shards of older checkpoints are never overwritten
+            shard = os.path.join(SHARD_DIR, "{}-{}-{}.pt".format(
+                name, os.path.splitext(os.path.basename(filename))[0], uuid.uuid4().hex[:8]))
+            shard_states[shard] = self.snapshot(net.state_dict(), ("module", name))
+            shards[name] = shard
+            self.shards[name] = (version, shard)
+        if self.skip_unchanged:
+            to_save["shards"] = shards
+
+        copied = None
+        if torch.cuda.is_available():
+            copied = torch.cuda.Event()
+            copied.record()
+        self.pending = self.executor.submit(self.write, filename, to_save, shard_states, copied)
+
+    def write(self, filename, to_save, shard_states, copied):
+        if copied is not None:
+            copied.synchronize()
+        folder = os.path.dirname(filename)
+        for shard, shard_state in shard_states.items():
+            os.makedirs(os.path.join(folder, SHARD_DIR), exist_ok=True)
+            atomic_save(shard_state, os.path.join(folder, shard))
+        atomic_save(to_save, filename)
+        self.refs[os.path.normpath(filename)] = set(to_save.get("shards", {}).values())
+        self.retain(folder)
+
+    def retain(self, folder):
+        """
+        removes all but the newest keep model_<step>.pth of the folder, and the shards no checkpoint references
+        """
+        ckpts = sorted(f for f in os.listdir(folder) if f.endswith(".pth"))
+        if self.keep > 0:
+            steps = [f for f in ckpts if CKPT_PATTERN.match(f)]
+            for f in steps[: -self.keep]:
+                os.remove(os.path.join(folder, f))
+                self.refs.pop(os.path.normpath(os.path.join(folder, f)), None)
+                ckpts.remove(f)
+
+        shard_dir = os.path.join(folder, SHARD_DIR)
+        if not self.skip_unchanged or not os.path.isdir(shard_dir):
+            return
+        ckpts = [os.path.normpath(os.path.join(folder, f)) for f in ckpts]
+        # shards of checkpoints of an earlier run are unknown, they are kept until these checkpoints are removed
+        if any(f not in self.refs for f in ckpts):
+            return
+        referenced = set().union(*[self.refs[f] for f in ckpts])
+        for f in os.listdir(shard_dir):
+            if f.endswith(".pt") and os.path.join(SHARD_DIR, f) not in referenced:
+                os.remove(os.path.join(shard_dir, f))
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown(wait=True)
@@ -16,6 +16,7 @@ from .nmr_dataset import *
 from .rffr import RFFRDataset
 from .rffr_test import RFFRTestDataset
 from .scannet_dataset import ScannetTrainDataset, ScannetValDataset
+from .scannet_store import ScannetStoreTrainDataset
 
 dataset_dict = {
     "spaces": SpacesFreeDataset,
@@ -35,4 +36,5 @@ dataset_dict = {
     "rffr": RFFRTestDataset,
     "train_scannet": ScannetTrainDataset,  # for train semanitc segmentation
     "val_scannet": ScannetValDataset,  # for val semanitc segmentation
+    "train_scannet_store": ScannetStoreTrainDataset,  # train_scannet read from scripts/build_scannet_store.py
 }
@@ -2,6 +2,7 @@ import numpy as np
 from . import dataset_dict
 from torch.utils.data import Dataset, Sampler
 from torch.utils.data import DistributedSampler, WeightedRandomSampler
+from torch.utils.data.dataloader import default_collate
 from typing import Optional
 from operator import itemgetter
 import torch
@@ -82,6 +83,25 @@ class DistributedSamplerWrapper(DistributedSampler):
         return iter(itemgetter(*indexes_of_indexes)(subsampler_indexes))
 
 
+def collate_targets(batch):
+    """
+    collate several target views, each with its own set of source views, into one training batch.
+    the source views of every target are trimmed to the smallest number of source views in the batch,
+    so that datasets drawing a random number of source views can be batched as well
+    :param batch: list of dataset items
+    :return: dict of batched tensors, e.g. 'src_rgbs': [batch, n_views, h, w, 3]
+    """
+    assert len(set(tuple(item["rgb"].shape) for item in batch)) == 1, (
+        "all target views of a batch need the same image size"
+    )
+    num_views = min(len(item["src_cameras"]) for item in batch)
+    for item in batch:
+        for key in ["src_rgbs", "src_cameras", "src_labels", "src_depths", "src_rgb_paths"]:
+            if key in item:
+                item[key] = item[key][:num_views]
+    return default_collate(batch)
+
+
 def create_training_dataset(args):
     # parse args.train_dataset, "+" indicates that multiple datasets are used, for example "ibrnet_collect+llff+spaces"
     # otherwise only one dataset is used
@@ -1,3 +1,5 @@
+import os
+import hashlib
 import numpy as np
 import math
 from PIL import Image
@@ -74,11 +76,15 @@ def rectify_inplane_rotation(src_pose, tar_pose, src_img, th=40):
     h, w = src_img.shape[:2]
     center = ((w - 1.0) / 2.0, (h - 1.0) / 2.0)
     M = cv2.getRotationMatrix2D(center, -euler_z, 1)
-    src_img = np.clip((255 * src_img).astype(np.uint8), a_max=255, a_min=0)
+    # uint8 frames (from the shared frame pool) are rotated and returned as uint8
+    is_uint8 = src_img.dtype == np.uint8
+    if not is_uint8:
+        src_img = np.clip((255 * src_img).astype(np.uint8), a_max=255, a_min=0)
     rotated = cv2.warpAffine(
         src_img, M, (w, h), borderValue=(255, 255, 255), flags=cv2.INTER_LANCZOS4
     )
-    rotated = rotated.astype(np.float32) / 255.0
+    if not is_uint8:
+        rotated = rotated.astype(np.float32) / 255.0
     return out_pose, rotated
 
 
@@ -265,3 +271,140 @@ def get_nearest_pose_ids(
     selected_ids = sorted_ids[:num_select]
     # print(angular_dists[selected_ids] * 180 / np.pi)
     return selected_ids
+
+
+def get_nearest_pose_table(
+    poses,
+    num_select,
+    angular_dist_method="vector",
+    scene_center=(0, 0, 0),
+    chunk_size=1024,
+):
+    """
+    rank the nearest views of every pose of a scene at once, row i is the same as
+    get_nearest_pose_ids(poses[i], poses, num_select, tar_id=i, angular_dist_method)
+    Args:
+        poses: camera poses [N, 4, 4]
+        num_select: the number of nearest views to keep for every pose
+        chunk_size: number of target poses whose distances are computed together
+    Returns: the selected indices [N, num_select], nearest first
+    """
+    num_cams = len(poses)
+    num_select = min(num_select, num_cams - 1)
+    table = np.zeros((num_cams, num_select), dtype=np.int64)
+
+    if angular_dist_method == "vector":
+        vectors = poses[:, :3, 3] - np.array(scene_center)[None, ...]
+        units = vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + TINY_NUMBER)
+    elif angular_dist_method not in ["matrix", "dist"]:
+        raise Exception("unknown angular distance calculation method!")
+
+    for start in range(0, num_cams, chunk_size):
+        end = min(start + chunk_size, num_cams)
+        if angular_dist_method == "matrix":
+            # trace(R_ref^T R_tar) for every (target, reference) pair
+            traces = np.einsum("aij,bij->ab", poses[start:end, :3, :3], poses[:, :3, :3])
+            dists = np.arccos(
+                np.clip((traces - 1) / 2.0, a_min=-1 + TINY_NUMBER, a_max=1 - TINY_NUMBER)
+            )
+        elif angular_dist_method == "vector":
+            dists = np.arccos(np.clip(units[start:end] @ units.T, -1.0, 1.0))
+        else:
+            dists = np.linalg.norm(
+                poses[start:end, None, :3, 3] - poses[None, :, :3, 3], axis=-1
+            )
+        # make sure not to select the target id itself
+        dists[np.arange(end - start), np.arange(start, end)] = 1e3
+        table[start:end] = np.argsort(dists, axis=1)[:, :num_select]
+    return table
+
+
+class NearestPoseIndex(object):
+    """
+    per-scene tables of the nearest views of every frame, built once with get_nearest_pose_table and
+    cached to disk, so that a dataset looks up the source views of a target frame in O(K)
+    instead of ranking all cameras of the scene in every __getitem__
+    """
+
+    def __init__(self, cache_dir="", num_neighbors=64):
+        """
+        :param cache_dir: directory of the cached tables, empty keeps them in memory only
+        :param num_neighbors: number of ranked neighbors kept per frame, grown on demand
+        """
+        self.cache_dir = cache_dir
+        self.num_neighbors = num_neighbors
+        self.tables = {}
+
+    def _key(self, scene_key, angular_dist_method, scene_center):
+        # the scene center only enters the "vector" distance
+        if angular_dist_method != "vector":
+            scene_center = ()
+        return (scene_key, angular_dist_method, tuple(np.asarray(scene_center).tolist()))
+
+    def _cache_file(self, key):
+        name = "{}|{}|{}".format(*key)
+        return os.path.join(self.cache_dir, hashlib.sha1(name.encode()).hexdigest() + "_" + key[1] + ".npz")
+
+    def table(self, scene_key, poses, num_select, angular_dist_method="vector", scene_center=(0, 0, 0)):
+        """
+        :param scene_key: unique name of the scene, e.g. its directory
+        :param poses: all camera poses of the scene [N, 4, 4]
+        :return: [N, K] nearest views of every frame with K >= min(num_select, N - 1)
+        """
+        num_select = min(num_select, len(poses) - 1)
+        key = self._key(scene_key, angular_dist_method, scene_center)
+        table = self.tables.get(key)
+        if table is not None and table.shape[1] >= num_select:
+            return table
+
+        num_neighbors = min(max(self.num_neighbors, num_select), len(poses) - 1)
+        digest = hashlib.sha1(np.ascontiguousarray(poses, dtype=np.float64).tobytes()).hexdigest()
+        table = None
+        if self.cache_dir:
+            cache_file = self._cache_file(key)
+            if os.path.isfile(cache_file):
+                cached = np.load(cache_file)
+                # the poses of the scene have to match and the table has to be deep enough
+                if str(cached["digest"]) == digest and cached["table"].shape[1] >= num_select:
+                    table = cached["table"]
+
+        if table is None:
+            table = get_nearest_pose_table(
+                poses, num_neighbors, angular_dist_method=angular_dist_method, scene_center=scene_center
+            ).astype(np.int32)
+            if self.cache_dir:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                # write and rename, several dataloader workers may build the same table
+                tmp_file = "{}.{}.tmp.npz".format(cache_file[:-4], os.getpid())
+                np.savez(tmp_file, table=table, digest=digest)
+                os.replace(tmp_file, cache_file)
+
+        self.tables[key] = table
+        return table
+
+    def query(
+        self,
+        scene_key,
+        poses,
+        tar_pose,
+        num_select,
+        tar_id=-1,
+        angular_dist_method="vector",
+        scene_center=(0, 0, 0),
+    ):
+        """
+        same arguments and result as get_nearest_pose_ids(tar_pose, poses, num_select, tar_id, ...),
+        targets that are not one of the poses (tar_id < 0) are ranked on the fly
+        """
+        if tar_id < 0:
+            return get_nearest_pose_ids(
+                tar_pose,
+                poses,
+                num_select,
+                tar_id=tar_id,
+                angular_dist_method=angular_dist_method,
+                scene_center=scene_center,
+            )
+        assert tar_id < len(poses)
+        table = self.table(scene_key, poses, num_select, angular_dist_method, scene_center)
+        return table[tar_id, : min(num_select, len(poses) - 1)].astype(np.int64)
@@ -11,6 +11,7 @@ from natsort import natsorted
 
 from .utils.base_utils import downsample_gaussian_blur, pose_inverse
 from .semantic_utils import PointSegClassMapping
+from .depth_bounds import DEFAULT_DEPTH_RANGE
 from .asset import *
 
 
@@ -140,7 +141,7 @@ class ScannetDatabase(BaseDatabase):
         return np.ones([h, w], bool)
 
     def get_depth_range(self, img_id):
-        return np.asarray((0.1, 10.0), np.float32)
+        return np.asarray(DEFAULT_DEPTH_RANGE, np.float32)
 
     def get_label(self, img_id):
         h, w, _ = self.get_image(img_id).shape
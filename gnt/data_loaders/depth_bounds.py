@@ -0,0 +1,115 @@
+import os
+
+import cv2
+import numpy as np
+
+# Per-frame near/far bounds of a ScanNet scene, written once by scripts/compute_scannet_depth_bounds.py:
+#   <scene>/depth_bounds.txt  one line per frame: frame id, near, far (meters, z-depth in the color camera)
+# The training loaders use them with --depth_bounds instead of the fixed DEFAULT_DEPTH_RANGE. A held-out view is
+# never given its own bounds, the val loader derives them from its source views (source_depth_range).
+DEFAULT_DEPTH_RANGE = (0.1, 10.0)
+BOUNDS_FILE = "depth_bounds.txt"
+
+
+def frame_id(path):
+    """
+    ScanNet frame id of a pose/color/depth/label file, e.g. .../pose/123.txt -> 123
+    """
+    return int(os.path.splitext(os.path.basename(path))[0])
+
+
+def frame_depth_bounds(depth, percentile=1.0, margin=0.1, min_valid=0.05, min_near=0.1):
+    """
+    robust [near, far] of one depth frame: the low and high percentiles of the valid depths, widened by margin
+    :param depth: depth map in meters, 0 where the sensor has no depth
+    :param min_valid: minimal share of valid pixels, below it the frame gets no bounds
+    :return: (near, far) or None
+    """
+    valid = depth[depth > 0]
+    if valid.size < min_valid * depth.size:
+        return None
+    lo, hi = np.percentile(valid, [percentile, 100 - percentile])
+    near = max(min_near, lo * (1 - margin))
+    far = max(hi * (1 + margin), near + 0.1)
+    return near, far
+
+
+def compute_scene_depth_bounds(scene_path, percentile=1.0, margin=0.1, min_valid=0.05):
+    """
+    bounds of every frame of an exported ScanNet scene (pose/, depth/) written to <scene>/depth_bounds.txt.
+    frames without enough valid depth get the median bounds of the scene
+    :return: [N, 3] array of frame id, near, far
+    """
+    ids, bounds = [], []
+    for f in sorted(os.listdir(os.path.join(scene_path, "pose")), key=frame_id):
+        depth = cv2.imread(os.path.join(scene_path, "depth", "{}.png".format(frame_id(f))), cv2.IMREAD_UNCHANGED)
+        # uint16 millimeters
+        b = None if depth is None else frame_depth_bounds(depth.astype(np.float32) / 1000.0, percentile, margin, min_valid)
+        ids.append(frame_id(f))
+        bounds.append(b)
+
+    measured = np.array([b for b in bounds if b is not None], dtype=np.float64).reshape(-1, 2)
+    fallback = np.median(measured, axis=0) if len(measured) > 0 else np.array(DEFAULT_DEPTH_RANGE)
+    table = np.array(
+        [[i] + list(b if b is not None else fallback) for i, b in zip(ids, bounds)], dtype=np.float64
+    ).reshape(-1, 3)
+    np.savetxt(os.path.join(scene_path, BOUNDS_FILE), table, fmt=["%d", "%.4f", "%.4f"])
+    return table
+
+
+def load_depth_bounds(scene_path):
+    """
+    :return: {frame id: float32 [near, far]} of a scene, None if its bounds were not computed
+    """
+    path = os.path.join(scene_path, BOUNDS_FILE)
+    if not os.path.isfile(path):
+        return None
+    table = np.loadtxt(path, ndmin=2)
+    return {int(row[0]): row[1:3].astype(np.float32) for row in table}
+
+
+def depth_range_of(bounds, path):
+    """
+    :param bounds: output of load_depth_bounds, may be None
+    :param path: any file of the frame (pose, color, ...)
+    :return: [near, far] of the frame, DEFAULT_DEPTH_RANGE if it has no bounds
+    """
+    if bounds is not None:
+        b = bounds.get(frame_id(path))
+        if b is not None:
+            return b
+    return np.asarray(DEFAULT_DEPTH_RANGE, dtype=np.float32)
+
+
+def source_depth_range(bounds, src_paths, src_poses, tar_pose, intrinsics, image_size, min_near=DEFAULT_DEPTH_RANGE[0]):
+    """
+    [near, far] of a held-out target view from the bounds of its source views only, the target's own depth is
+    ground truth at evaluation. the frustum of every source view, cut at its near and far, is moved to the
+    target camera and the z-range of the corners is taken; it contains all the surfaces the sources see
+    :param src_paths: any file of each source frame, src_poses: [S, 4, 4] camera-to-world poses of the sources
+    :param tar_pose: [4, 4] camera-to-world pose of the target
+    :param intrinsics: [4, 4] or [3, 3] intrinsics of the image size, shared by the sources
+    :param image_size: (h, w)
+    :return: [near, far], DEFAULT_DEPTH_RANGE if no source has bounds
+    """
+    if bounds is None:
+        return np.asarray(DEFAULT_DEPTH_RANGE, dtype=np.float32)
+    h, w = image_size
+    corners = np.array([[0, 0, 1], [w, 0, 1], [0, h, 1], [w, h, 1]], dtype=np.float64)
+    rays = corners @ np.linalg.inv(np.asarray(intrinsics, dtype=np.float64)[:3, :3]).T
+    w2c_tar = np.linalg.inv(tar_pose)
+    zs = []
+    for path, pose in zip(src_paths, src_poses):
+        b = bounds.get(frame_id(path))
+        if b is None:
+            continue
+        # [8, 4] homogeneous corners of the frustum slab in the source camera, z = near or far
+        pts = np.concatenate([rays * b[0], rays * b[1]])
+        pts = np.concatenate([pts, np.ones((len(pts), 1))], axis=1)
+        zs.append((pts @ (w2c_tar @ pose).T)[:, 2])
+    if len(zs) == 0:
+        return np.asarray(DEFAULT_DEPTH_RANGE, dtype=np.float32)
+    zs = np.concatenate(zs)
+    near = float(np.clip(zs.min(), min_near, DEFAULT_DEPTH_RANGE[1]))
+    far = float(np.clip(zs.max(), near + 0.1, DEFAULT_DEPTH_RANGE[1]))
+    return np.asarray((near, far), dtype=np.float32)
@@ -0,0 +1,160 @@
+import atexit
+import contextlib
+import fcntl
+import hashlib
+import os
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+
+HEADER_WORDS = 8  # magic, n_slots, slot_bytes, clock, hits, misses, evictions, reserved
+MAGIC = 0x474E5446  # "GNTF"
+
+
+class SharedFramePool(object):
+    """
+    size-bounded pool of decoded frames (uint8 arrays of one fixed shape) in POSIX shared memory, shared by
+    every process of a node that opens the same name: all DataLoader workers of all ranks.
+    a frame is looked up by a key (e.g. its file path), missing frames are decoded by the caller and inserted,
+    the least recently used frame is evicted when the pool is full.
+
+    layout: [header | slot keys | slot ticks | slot data], keys are 64-bit hashes (0 marks an empty slot) and
+    ticks the pool clock at the last use of a slot. a flock on a lock file in /dev/shm serializes the updates.
+    the segment is created by the first process and unlinked when that process exits
+    """
+
+    def __init__(self, name, capacity_mb, shape, dtype=np.uint8):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slot_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.n_slots = max(1, int(capacity_mb * 2**20) // self.slot_bytes)
+        self.lock_file = os.path.join("/dev/shm", name + ".lock")
+        self._pid = None
+
+    def __getstate__(self):
+        # workers attach by name, handles are per process
+        state = self.__dict__.copy()
+        for k in ["_shm", "_lock", "_header", "_keys", "_ticks", "_data"]:
+            state.pop(k, None)
+        state["_pid"] = None
+        return state
+
+    def attach(self):
+        """
+        create or open the shared segment and the lock file of this process, called lazily on first use
+        """
+        if self._pid == os.getpid():
+            return
+        size = 8 * (HEADER_WORDS + 2 * self.n_slots) + self.n_slots * self.slot_bytes
+        try:
+            shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+            created = True
+        except FileExistsError:
+            shm = shared_memory.SharedMemory(name=self.name)
+            created = False
+        # the pool outlives single workers, only its creator unlinks it
+        resource_tracker.unregister(shm._name, "shared_memory")
+        if shm.size < size:
+            raise RuntimeError(
+                "shared frame pool {} has {} bytes, {} are needed; remove /dev/shm/{} or use another name".format(
+                    self.name, shm.size, size, self.name
+                )
+            )
+        words = np.ndarray((HEADER_WORDS + 2 * self.n_slots,), dtype=np.int64, buffer=shm.buf)
+        self._shm = shm
+        self._header = words[:HEADER_WORDS]
+        self._keys = words[HEADER_WORDS : HEADER_WORDS + self.n_slots]
+        self._ticks = words[HEADER_WORDS + self.n_slots :]
+        self._data = np.ndarray(
+            (self.n_slots,) + self.shape, dtype=self.dtype, buffer=shm.buf, offset=8 * words.size
+        )
+        # flock is per open file description, every process needs its own
+        self._lock = open(self.lock_file, "a+")
+        self._pid = os.getpid()
+        with self.locked():
+            if self._header[0] == 0:
+                self._header[:3] = [MAGIC, self.n_slots, self.slot_bytes]
+            elif tuple(self._header[:3]) != (MAGIC, self.n_slots, self.slot_bytes):
+                raise RuntimeError(
+                    "shared frame pool {} was created with another layout; remove /dev/shm/{}".format(
+                        self.name, self.name
+                    )
+                )
+        if created:
+            atexit.register(self.unlink)
+
+    @contextlib.contextmanager
+    def locked(self):
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def hash_key(key):
+        h = int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), "little", signed=True)
+        return h if h != 0 else 1
+
+    def find(self, h):
+        slots = np.flatnonzero(self._keys == h)
+        return int(slots[0]) if len(slots) > 0 else -1
+
+    def get(self, key, load_fn):
+        """
+        :param key: identifies the frame, including everything that changes the decoded result
+        :param load_fn: decodes the frame on a miss, returns an array of the pool shape and dtype
+        :return: a private copy of the frame
+        """
+        self.attach()
+        h = self.hash_key(key)
+        with self.locked():
+            slot = self.find(h)
+            if slot >= 0:
+                self._header[3] += 1
+                self._header[4] += 1
+                self._ticks[slot] = self._header[3]
+                return self._data[slot].copy()
+            self._header[5] += 1
+
+        # decode outside the lock, other processes keep going
+        frame = np.asarray(load_fn(), dtype=self.dtype)
+        assert frame.shape == self.shape, "frame {} has shape {}, the pool holds {}".format(
+            key, frame.shape, self.shape
+        )
+        with self.locked():
+            if self.find(h) < 0:
+                slot = int(np.argmin(self._ticks))
+                if self._keys[slot] != 0:
+                    self._header[6] += 1
+                # invalidate while writing, a crash in between leaves an empty slot
+                self._keys[slot] = 0
+                self._data[slot] = frame
+                self._header[3] += 1
+                self._ticks[slot] = self._header[3]
+                self._keys[slot] = h
+        return frame
+
+    def stats(self):
+        self.attach()
+        hits, misses, evictions = (int(v) for v in self._header[4:7])
+        return {
+            "name": self.name,
+            "frames": int(np.count_nonzero(self._keys)),
+            "capacity": self.n_slots,
+            "hits": hits,
+            "misses": misses,
+            "evictions": evictions,
+            "hit_rate": hits / max(hits + misses, 1),
+        }
+
+    def unlink(self):
+        if self._pid != os.getpid():
+            return
+        # unregistered on attach, register again so that unlink() finds it in the resource tracker
+        resource_tracker.register(self._shm._name, "shared_memory")
+        self._shm.unlink()
+        if os.path.exists(self.lock_file):
+            os.remove(self.lock_file)
@@ -0,0 +1,95 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def gaussian_blur_params(ratio):
+    """
+    sigma and kernel size of utils.base_utils.downsample_gaussian_blur for a downsampling ratio (output / input)
+    """
+    sigma = (1 / ratio) / 3
+    ksize = int(np.ceil(((sigma - 0.8) / 0.3 + 1) * 2 + 1))
+    ksize = ksize + 1 if ksize % 2 == 0 else ksize
+    return sigma, ksize
+
+
+class GPUFramePreprocessor(object):
+    """
+    second half of the ScanNet frame decoding with --gpu_preprocess, run on the batch inside the training step.
+    the data loader workers return the frames as uint8 at the reduced jpeg decoding size and the labels as raw
+    ScanNet ids (int16) at the output size; here the target and all source frames of the batch are blurred,
+    resized, normalized and the labels mapped to classes in one call each.
+    the output size is the image size of the cameras
+    """
+
+    def __init__(self, label_table, device):
+        """
+        :param label_table: class of every raw ScanNet label id, see ScannetFrameReader.label_table
+        :param device: where the frames are processed
+        """
+        self.device = device
+        self.label_table = torch.as_tensor(label_table, dtype=torch.long, device=device)
+        self.kernels = {}
+
+    def blur_kernel(self, ratio):
+        sigma, ksize = gaussian_blur_params(ratio)
+        if ksize not in self.kernels:
+            # the kernel of cv2.getGaussianKernel
+            x = torch.arange(ksize, dtype=torch.float32, device=self.device) - (ksize - 1) / 2
+            kernel = torch.exp(-(x ** 2) / (2 * sigma ** 2))
+            self.kernels[ksize] = kernel / kernel.sum()
+        return self.kernels[ksize]
+
+    def blur(self, imgs, ratio):
+        """
+        separable gaussian blur with reflect-101 borders (cv2.BORDER_REFLECT101), a no-op for kernels of size 1
+        :param imgs: [n, c, h, w]
+        """
+        kernel = self.blur_kernel(ratio)
+        k, c = kernel.shape[0], imgs.shape[1]
+        if k == 1:
+            return imgs
+        pad = k // 2
+        imgs = F.pad(imgs, (pad, pad, 0, 0), mode="reflect")
+        imgs = F.conv2d(imgs, kernel.view(1, 1, 1, k).expand(c, 1, 1, k), groups=c)
+        imgs = F.pad(imgs, (0, 0, pad, pad), mode="reflect")
+        return F.conv2d(imgs, kernel.view(1, 1, k, 1).expand(c, 1, k, 1), groups=c)
+
+    def frames(self, rgbs, H, W):
+        """
+        :param rgbs: [n, h, w, 3] uint8
+        :return: [n, H, W, 3] float32 in [0, 1] on the device
+        """
+        imgs = rgbs.to(self.device, non_blocking=True).permute(0, 3, 1, 2).float().div_(255.0)
+        if imgs.shape[-2:] != (H, W):
+            imgs = self.blur(imgs, W / imgs.shape[-1])
+            # align_corners=False samples at pixel centers, as cv2.INTER_LINEAR
+            imgs = F.interpolate(imgs, size=(H, W), mode="bilinear", align_corners=False)
+        return imgs.clamp_(0, 1).permute(0, 2, 3, 1).contiguous()
+
+    def labels(self, labels):
+        """
+        :param labels: raw ScanNet ids, int16
+        :return: classes, int64 on the device
+        """
+        labels = labels.to(self.device, non_blocking=True).long().clamp_(0, len(self.label_table) - 1)
+        return self.label_table[labels]
+
+    def __call__(self, data):
+        """
+        :param data: collated batch, 'rgb' [batch, h, w, 3] and 'src_rgbs' [batch, n_views, h, w, 3] uint8,
+                     'labels' [batch, H, W] and 'src_labels' [batch, n_views, H, W] int16
+        :return: copy of the batch with the frames and labels replaced by their processed versions on the device
+        """
+        data = dict(data)
+        H, W = int(data["camera"][0, 0]), int(data["camera"][0, 1])
+        batch_size, n_views = data["src_rgbs"].shape[:2]
+        # target and source frames of all target views in one stack
+        rgbs = self.frames(torch.cat([data["rgb"].unsqueeze(1), data["src_rgbs"]], dim=1).flatten(0, 1), H, W)
+        rgbs = rgbs.unflatten(0, (batch_size, n_views + 1))
+        data["rgb"], data["src_rgbs"] = rgbs[:, 0], rgbs[:, 1:]
+        if "labels" in data:
+            data["labels"] = self.labels(data["labels"])
+        if "src_labels" in data:
+            data["src_labels"] = self.labels(data["src_labels"])
+        return data
@@ -7,7 +7,7 @@ import glob
 import sys
 
 sys.path.append("../")
-from .data_utils import rectify_inplane_rotation, random_crop, random_flip, get_nearest_pose_ids
+from .data_utils import rectify_inplane_rotation, random_crop, random_flip, get_nearest_pose_ids, NearestPoseIndex
 from .llff_data_utils import load_llff_data, batch_parse_llff_poses
 
 
@@ -18,6 +18,7 @@ class IBRNetCollectedDataset(Dataset):
         self.rectify_inplane_rotation = args.rectify_inplane_rotation
         self.mode = mode  # train / test / validation
         self.num_source_views = args.num_source_views
+        self.nearest_index = NearestPoseIndex(args.nearest_index_dir)
         self.random_crop = random_crop
 
         all_scenes = glob.glob(self.folder_path1 + "*") + glob.glob(self.folder_path2 + "*")
@@ -98,9 +99,10 @@ class IBRNetCollectedDataset(Dataset):
             subsample_factor = 1
             num_select = self.num_source_views
 
-        nearest_pose_ids = get_nearest_pose_ids(
-            render_pose,
+        nearest_pose_ids = self.nearest_index.query(
+            "{}:{}".format(os.path.dirname(train_rgb_files[0]), self.mode),
             train_poses,
+            render_pose,
             min(self.num_source_views * subsample_factor, 22),
             tar_id=id_render,
             angular_dist_method="dist",
@@ -6,7 +6,7 @@ from torch.utils.data import Dataset
 import sys
 
 sys.path.append("../")
-from .data_utils import random_crop, random_flip, get_nearest_pose_ids
+from .data_utils import random_crop, random_flip, get_nearest_pose_ids, NearestPoseIndex
 from .llff_data_utils import load_llff_data, batch_parse_llff_poses
 
 
@@ -16,6 +16,7 @@ class LLFFDataset(Dataset):
         self.args = args
         self.mode = mode  # train / test / validation
         self.num_source_views = args.num_source_views
+        self.nearest_index = NearestPoseIndex(args.nearest_index_dir)
         self.render_rgb_files = []
         self.render_intrinsics = []
         self.render_poses = []
@@ -89,9 +90,10 @@ class LLFFDataset(Dataset):
             subsample_factor = 1
             num_select = self.num_source_views
 
-        nearest_pose_ids = get_nearest_pose_ids(
-            render_pose,
+        nearest_pose_ids = self.nearest_index.query(
+            "{}:{}".format(os.path.dirname(train_rgb_files[0]), self.mode),
             train_poses,
+            render_pose,
             min(self.num_source_views * subsample_factor, 20),
             tar_id=id_render,
             angular_dist_method="dist",
@@ -104,6 +104,7 @@ class LLFFRenderDataset(Dataset):
         return {
             "camera": torch.from_numpy(camera),
             "rgb_path": "",
+            "src_rgb_paths": [train_rgb_files[id] for id in nearest_pose_ids],
             "src_rgbs": torch.from_numpy(src_rgbs[..., :3]),
             "src_cameras": torch.from_numpy(src_cameras),
             "depth_range": depth_range,
@@ -7,7 +7,7 @@ from PIL import Image
 
 sys.path.append("../")
 from torch.utils.data import Dataset
-from .data_utils import random_crop, get_nearest_pose_ids
+from .data_utils import random_crop, get_nearest_pose_ids, NearestPoseIndex
 from .llff_data_utils import load_llff_data, batch_parse_llff_poses
 
 class RFFRTestDataset(Dataset):
@@ -16,6 +16,7 @@ class RFFRTestDataset(Dataset):
         self.args = args
         self.mode = mode
         self.num_source_views = args.num_source_views
+        self.nearest_index = NearestPoseIndex(args.nearest_index_dir)
         self.random_crop = random_crop
         self.render_rgb_files = []
         self.render_intrinsics = []
@@ -111,9 +112,10 @@ class RFFRTestDataset(Dataset):
             subsample_factor = 1
             num_select = self.num_source_views
 
-        nearest_pose_ids = get_nearest_pose_ids(
-            render_pose,
+        nearest_pose_ids = self.nearest_index.query(
+            "{}:{}".format(os.path.dirname(train_rgb_files[0]), self.mode),
             train_poses,
+            render_pose,
             min(self.num_source_views * subsample_factor, 28),
             tar_id=id_render,
             angular_dist_method="dist",
@@ -8,14 +8,16 @@ import torch
 from torch.utils.data import Dataset
 import glob
 from PIL import Image
-import pandas as pd
 import sys
 
 sys.path.append("../")
-from .data_utils import rectify_inplane_rotation, get_nearest_pose_ids
+from .data_utils import rectify_inplane_rotation, get_nearest_pose_ids, NearestPoseIndex
 from .utils.base_utils import downsample_gaussian_blur
 from .asset import *
 from .semantic_utils import PointSegClassMapping
+from .frame_pool import SharedFramePool
+from .depth_bounds import load_depth_bounds, depth_range_of, source_depth_range
+from .scene_manifest import load_scene_manifest
 
 def set_seed(index,is_train):
     if is_train:
@@ -28,8 +30,131 @@ def set_seed(index,is_train):
         torch.random.manual_seed(index % (2 ** 16) + 1)
 
 
+# size of the ScanNet color frames
+SCANNET_COLOR_SIZE = (968, 1296)
+
+
+def make_frame_pools(args, rgb_shape, label_shape, label_dtype=np.uint8, label_kind="label"):
+    """
+    node-wide pools of decoded uint8 frames and labels, shared by all workers and ranks
+    :return: (rgb pool, label pool), (None, None) if --frame_pool_mb is 0
+    """
+    if args.frame_pool_mb <= 0:
+        return None, None
+    rgb_pool = SharedFramePool(
+        "{}_rgb_{}x{}".format(args.frame_pool_name, *rgb_shape[:2]), args.frame_pool_mb * 3 / 4, rgb_shape
+    )
+    label_pool = SharedFramePool(
+        "{}_{}_{}x{}".format(args.frame_pool_name, label_kind, *label_shape),
+        args.frame_pool_mb / 4,
+        label_shape,
+        dtype=label_dtype,
+    )
+    # created by the main process, before the DataLoader workers start
+    rgb_pool.attach()
+    label_pool.attach()
+    return rgb_pool, label_pool
+
+
+class ScannetFrameReader(object):
+    """
+    decoding of ScanNet frames and labels at the dataset resolution (self.h, self.w).
+    with the shared pools the rgb frames are returned as uint8 and converted to float on the device
+    (see sample_ray.image_to_float), otherwise as float32.
+    with --gpu_preprocess the rgb frames are only decoded, at the largest jpeg reduction (1/2, 1/4, 1/8) that
+    keeps them above the dataset resolution, and the labels are returned as raw ScanNet ids (int16);
+    blur, resize, normalization and the class mapping run on the batch in gpu_preprocess.GPUFramePreprocessor
+    """
+
+    def init_frame_reader(self, args, gpu_preprocess=False):
+        self.gpu_preprocess = gpu_preprocess
+        if self.gpu_preprocess:
+            self.jpeg_reduction = max(r for r in [1, 2, 4, 8] if r * self.ratio <= 1)
+            rgb_shape = tuple(-(-s // self.jpeg_reduction) for s in SCANNET_COLOR_SIZE) + (3,)
+            self.rgb_pool, self.label_pool = make_frame_pools(
+                args, rgb_shape, (self.h, self.w), label_dtype=np.int16, label_kind="rawlabel"
+            )
+        else:
+            self.rgb_pool, self.label_pool = make_frame_pools(args, (self.h, self.w, 3), (self.h, self.w))
+
+    def label_table(self):
+        """
+        class of every raw ScanNet label id, scan2nyu and label_mapping in one lookup
+        """
+        return self.label_mapping(self.scan2nyu)
+
+    def read_rgb(self, rgb_file):
+        if self.gpu_preprocess:
+            return self.read_rgb_reduced(rgb_file)
+
+        def decode():
+            rgb = imageio.imread(rgb_file).astype(np.float32) / 255.0
+            if self.w != 1296:
+                rgb = cv2.resize(downsample_gaussian_blur(
+                    rgb, self.ratio), (self.w, self.h), interpolation=cv2.INTER_LINEAR)
+            return rgb
+
+        if self.rgb_pool is None:
+            return decode()
+        return self.rgb_pool.get(
+            rgb_file, lambda: np.clip(np.round(decode() * 255.0), 0, 255).astype(np.uint8)
+        )
+
+    def read_rgb_reduced(self, rgb_file):
+        flags = {
+            1: cv2.IMREAD_COLOR,
+            2: cv2.IMREAD_REDUCED_COLOR_2,
+            4: cv2.IMREAD_REDUCED_COLOR_4,
+            8: cv2.IMREAD_REDUCED_COLOR_8,
+        }[self.jpeg_reduction]
+
+        def decode():
+            # the jpeg decoder downscales in the DCT domain, much cheaper than a full decode
+            return cv2.cvtColor(cv2.imread(rgb_file, flags), cv2.COLOR_BGR2RGB)
+
+        if self.rgb_pool is None:
+            return decode()
+        return self.rgb_pool.get(rgb_file, decode)
+
+    def read_label(self, label_file):
+        if self.gpu_preprocess:
+            return self.read_raw_label(label_file)
+
+        def decode():
+            img = Image.open(label_file)
+            label = np.asarray(img, dtype=np.int32)
+            label = np.ascontiguousarray(label)
+            label = cv2.resize(label, (self.w, self.h), interpolation=cv2.INTER_NEAREST)
+            label = label.astype(np.int32)
+            label = self.scan2nyu[label]
+            return self.label_mapping(label)
+
+        if self.label_pool is None:
+            return decode()
+        # mapped labels are in [0, num_classes], stored as uint8
+        return self.label_pool.get(label_file, decode).astype(np.int32)
+
+    def read_depth(self, depth_file):
+        """
+        depth in meters at the dataset resolution, 0 where the sensor has no depth
+        """
+        depth = cv2.imread(depth_file, cv2.IMREAD_UNCHANGED).astype(np.float32) / 1000.0
+        return cv2.resize(depth, (self.w, self.h), interpolation=cv2.INTER_NEAREST)
+
+    def read_raw_label(self, label_file):
+        def decode():
+            # uint16 png, the nearest neighbour resize is a gather and stays here: it shrinks what is sent to the gpu
+            label = cv2.imread(label_file, cv2.IMREAD_UNCHANGED)
+            label = cv2.resize(label, (self.w, self.h), interpolation=cv2.INTER_NEAREST)
+            return np.minimum(label, len(self.scan2nyu) - 1).astype(np.int16)
+
+        if self.label_pool is None:
+            return decode()
+        return self.label_pool.get(label_file, decode)
+
+
 # only for training
-class ScannetTrainDataset(Dataset):
+class ScannetTrainDataset(Dataset, ScannetFrameReader):
     def __init__(self, args, is_train, **kwargs):
         if kwargs['train_set'] == 'code':
             self.scene_path_list = scannet_train_scans_320
@@ -38,48 +163,51 @@ class ScannetTrainDataset(Dataset):
 
         self.num_source_views = args.num_source_views
         self.rectify_inplane_rotation = args.rectify_inplane_rotation
+        # source depth maps for the empty-space skipping of render_rays, not rotated with rectified source views
+        self.load_depth = args.skip_empty and args.occupancy_depth and not self.rectify_inplane_rotation
+        self.nearest_index = NearestPoseIndex(args.nearest_index_dir)
 
         image_size = 320
         self.ratio = image_size / 1296
         self.h, self.w = int(self.ratio*972), int(image_size)
+        self.init_frame_reader(args, gpu_preprocess=args.gpu_preprocess)
+
+        # frames with finite poses, their poses and intrinsics from the cached manifest of the scene list
+        scene_paths = [os.path.join(args.rootdir + 'data', scene_path[:-10]) for scene_path in self.scene_path_list]
+        manifest = load_scene_manifest(scene_paths, args.manifest_dir)
 
         all_rgb_files, all_pose_files, all_label_files, all_intrinsics_files = [],[],[],[]
-        for i, scene_path in enumerate(self.scene_path_list):
-            scene_path = os.path.join(args.rootdir + 'data', scene_path[:-10])
-            pose_files = []
-            for f in sorted(os.listdir(os.path.join(scene_path, "pose"))):
-                path = os.path.join(scene_path, "pose", f)
-                pose = np.loadtxt(path)
-                if np.isinf(pose).any() or np.isnan(pose).any():
-                    continue
-                else:
-                    pose_files.append(path)
-                    
+        all_depth_files, all_depth_bounds, all_poses, all_intrinsics = [], [], [], []
+        for scene_path in scene_paths:
+            pose_files = manifest.pose_files(scene_path)
+            all_poses.append(manifest.poses(scene_path))
+            all_intrinsics.append(manifest.intrinsics(scene_path))
+
             rgb_files = [f.replace("pose", "color").replace("txt", "jpg") for f in pose_files]
             intrinsics_files = [
                 os.path.join(scene_path, 'intrinsic/intrinsic_color.txt') for f in rgb_files
             ]
             label_files = [f.replace("pose", "label-filt").replace("txt", "png") for f in pose_files]
+            depth_files = [f.replace("pose", "depth").replace("txt", "png") for f in pose_files]
 
             all_rgb_files.append(rgb_files)
             all_label_files.append(label_files)
+            all_depth_files.append(depth_files)
+            all_depth_bounds.append(load_depth_bounds(scene_path) if args.depth_bounds else None)
             all_pose_files.append(pose_files)
             all_intrinsics_files.append(intrinsics_files)
 
         index = np.arange(len(all_rgb_files))
         self.all_rgb_files = np.array(all_rgb_files, dtype=object)[index]
         self.all_label_files = np.array(all_label_files, dtype=object)[index]
+        self.all_depth_files = np.array(all_depth_files, dtype=object)[index]
+        self.all_depth_bounds = [all_depth_bounds[i] for i in index]
         self.all_pose_files = np.array(all_pose_files, dtype=object)[index]
         self.all_intrinsics_files = np.array(all_intrinsics_files, dtype=object)[index]
+        self.all_poses = [all_poses[i] for i in index]
+        self.all_intrinsics = [all_intrinsics[i] for i in index]
 
-        mapping_file = 'data/scannet/scannetv2-labels.combined.tsv'
-        mapping_file = pd.read_csv(mapping_file, sep='\t', header=0)
-        scan_ids = mapping_file['id'].values
-        nyu40_ids = mapping_file['nyu40id'].values
-        scan2nyu = np.zeros(max(scan_ids) + 1, dtype=np.int32)
-        for i in range(len(scan_ids)):
-            scan2nyu[scan_ids[i]] = nyu40_ids[i]
-        self.scan2nyu = scan2nyu
+        self.scan2nyu = manifest.scan2nyu
         self.label_mapping = PointSegClassMapping(
             valid_cat_ids=[1, 2, 3, 4, 5, 6, 7, 8, 9, 10,
                            11, 12, 14, 16, 24, 28, 33, 34, 36, 39],
@@ -104,17 +232,18 @@ class ScannetTrainDataset(Dataset):
         rgb_files = self.all_rgb_files[real_idx]
         pose_files = self.all_pose_files[real_idx]
         label_files = self.all_label_files[real_idx]
-        intrinsics_files = self.all_intrinsics_files[real_idx]
+        depth_files = self.all_depth_files[real_idx]
 
         id_render = np.random.choice(np.arange(len(pose_files)))
-        train_poses = np.stack([np.loadtxt(file).reshape(4, 4) for file in pose_files], axis=0)
+        train_poses = self.all_poses[real_idx]
         render_pose = train_poses[id_render]
 
         subsample_factor = np.random.choice(np.arange(1, 6), p=[0.3, 0.25, 0.2, 0.2, 0.05])
 
-        id_feat_pool = get_nearest_pose_ids(
-            render_pose,
+        id_feat_pool = self.nearest_index.query(
+            os.path.dirname(os.path.dirname(pose_files[0])),
             train_poses,
+            render_pose,
             self.num_source_views * subsample_factor,
             tar_id=id_render,
             angular_dist_method="vector",
@@ -127,27 +256,18 @@ class ScannetTrainDataset(Dataset):
         if np.random.choice([0, 1], p=[0.995, 0.005]):
             id_feat[np.random.choice(len(id_feat))] = id_render
 
-        rgb = imageio.imread(rgb_files[id_render]).astype(np.float32) / 255.0
+        rgb = self.read_rgb(rgb_files[id_render])
 
-        if self.w != 1296:
-            rgb = cv2.resize(downsample_gaussian_blur(
-                rgb, self.ratio), (self.w, self.h), interpolation=cv2.INTER_LINEAR)
-            
-        intrinsics = np.loadtxt(intrinsics_files[id_render]).reshape([4, 4])
+        intrinsics = self.all_intrinsics[real_idx].copy()
         intrinsics[:2, :] *= self.ratio
 
-        img_size = rgb.shape[:2]
+        # the output size, also with --gpu_preprocess where rgb is still at the decoding size
+        img_size = (self.h, self.w)
         camera = np.concatenate((list(img_size), intrinsics.flatten(), render_pose.flatten())).astype(
             np.float32
         )
 
-        img = Image.open(label_files[id_render])
-        label = np.asarray(img, dtype=np.int32)
-        label = np.ascontiguousarray(label)
-        label = cv2.resize(label, (self.w, self.h), interpolation=cv2.INTER_NEAREST)
-        label = label.astype(np.int32)
-        label = self.scan2nyu[label]
-        label = self.label_mapping(label)
+        label = self.read_label(label_files[id_render])
 
         all_poses = [render_pose]
         # get depth range
@@ -157,34 +277,28 @@ class ScannetTrainDataset(Dataset):
         near_depth = max(origin_depth - max_radius, min_ratio * origin_depth)
         far_depth = origin_depth + max_radius
         # depth_range = torch.tensor([near_depth, far_depth])
-        depth_range = torch.tensor([0.1, 10.0])
+        # per-frame bounds of scripts/compute_scannet_depth_bounds.py, [0.1, 10.0] without them
+        depth_range = torch.from_numpy(depth_range_of(self.all_depth_bounds[real_idx], pose_files[id_render]))
 
         src_rgbs = []
         src_cameras = []
         src_labels = []
+        src_depths = []
         for id in id_feat:
-            src_rgb = imageio.imread(rgb_files[id]).astype(np.float32) / 255.0
-            if self.w != 1296:
-                src_rgb = cv2.resize(downsample_gaussian_blur(
-                    src_rgb, self.ratio), (self.w, self.h), interpolation=cv2.INTER_LINEAR)
-            pose = np.loadtxt(pose_files[id]).reshape(4, 4)
+            src_rgb = self.read_rgb(rgb_files[id])
+            pose = train_poses[id]
 
             if self.rectify_inplane_rotation:
                 pose, src_rgb = rectify_inplane_rotation(pose.reshape(4, 4), render_pose, src_rgb)
             src_rgbs.append(src_rgb)
 
-            img = Image.open(label_files[id])
-            label = np.asarray(img, dtype=np.int32)
-            label = np.ascontiguousarray(label)
-            label = cv2.resize(label, (self.w, self.h), interpolation=cv2.INTER_NEAREST)
-            label = label.astype(np.int32)
-            label = self.scan2nyu[label]
-            label = self.label_mapping(label)
-            src_labels.append(label)
+            src_labels.append(self.read_label(label_files[id]))
+            if self.load_depth:
+                src_depths.append(self.read_depth(depth_files[id]))
 
-            intrinsics = np.loadtxt(intrinsics_files[id]).reshape([4, 4])
+            intrinsics = self.all_intrinsics[real_idx].copy()
             intrinsics[:2, :] *= self.ratio
-            img_size = src_rgb.shape[:2]
+            img_size = (self.h, self.w)
             src_camera = np.concatenate((list(img_size), intrinsics.flatten(), pose.flatten())).astype(
                 np.float32
             )
@@ -195,7 +309,7 @@ class ScannetTrainDataset(Dataset):
         src_rgbs = np.stack(src_rgbs)
         src_cameras = np.stack(src_cameras)
 
-        return {
+        ret = {
             "rgb": torch.from_numpy(rgb),
             "labels": torch.from_numpy(label),
             "camera": torch.from_numpy(camera),
@@ -205,50 +319,58 @@ class ScannetTrainDataset(Dataset):
             "src_cameras": torch.from_numpy(src_cameras),
             "depth_range": depth_range,
         }
+        if self.load_depth:
+            ret["src_depths"] = torch.from_numpy(np.stack(src_depths))
+        return ret
 
 
 
 # only for validation
-class ScannetValDataset(Dataset):
+class ScannetValDataset(Dataset, ScannetFrameReader):
     def __init__(self, args, is_train, scenes=None, **kwargs):
         self.is_train = is_train
         self.num_source_views = args.num_source_views
         self.rectify_inplane_rotation = args.rectify_inplane_rotation
+        # source depth maps for the empty-space skipping of render_rays, not rotated with rectified source views
+        self.load_depth = args.skip_empty and args.occupancy_depth and not self.rectify_inplane_rotation
+        self.nearest_index = NearestPoseIndex(args.nearest_index_dir)
 
         image_size = 320
         self.ratio = image_size / 1296
         self.h, self.w = int(self.ratio*972), int(image_size)
+        # the target frames are the cpu ground truth of the evaluation, always fully decoded here
+        self.init_frame_reader(args)
 
         scene_path = os.path.join(args.rootdir + 'data', scenes[:-10])
-        pose_files = []
-        for f in sorted(os.listdir(os.path.join(scene_path, "pose"))):
-            path = os.path.join(scene_path, "pose", f)
-            pose = np.loadtxt(path)
-            if np.isinf(pose).any() or np.isnan(pose).any():
-                continue
-            else:
-                pose_files.append(path)
-                
+        # one manifest for the whole validation split, loaded once per process and shared by its scenes;
+        # a scene outside the split gets its own
+        scene_paths = [
+            os.path.join(args.rootdir + 'data', name[:-10])
+            for name in np.loadtxt(args.val_set_list, dtype=str, ndmin=1).tolist()
+        ]
+        if scene_path not in scene_paths:
+            scene_paths = [scene_path]
+        manifest = load_scene_manifest(scene_paths, args.manifest_dir)
+        pose_files = manifest.pose_files(scene_path)
+        self.train_poses = manifest.poses(scene_path)
+        self.intrinsics = manifest.intrinsics(scene_path)
+
         rgb_files = [f.replace("pose", "color").replace("txt", "jpg") for f in pose_files]
         intrinsics_files = [
             os.path.join(scene_path, 'intrinsic/intrinsic_color.txt') for f in rgb_files
         ]
         label_files = [f.replace("pose", "label-filt").replace("txt", "png") for f in pose_files]
+        depth_files = [f.replace("pose", "depth").replace("txt", "png") for f in pose_files]
 
         index = np.arange(len(rgb_files))
         self.rgb_files = np.array(rgb_files, dtype=object)[index]
         self.label_files = np.array(label_files, dtype=object)[index]
+        self.depth_files = np.array(depth_files, dtype=object)[index]
+        self.depth_bounds = load_depth_bounds(scene_path) if args.depth_bounds else None
         self.pose_files = np.array(pose_files, dtype=object)[index]
         self.intrinsics_files = np.array(intrinsics_files, dtype=object)[index]
 
-        mapping_file = 'data/scannet/scannetv2-labels.combined.tsv'
-        mapping_file = pd.read_csv(mapping_file, sep='\t', header=0)
-        scan_ids = mapping_file['id'].values
-        nyu40_ids = mapping_file['nyu40id'].values
-        scan2nyu = np.zeros(max(scan_ids) + 1, dtype=np.int32)
-        for i in range(len(scan_ids)):
-            scan2nyu[scan_ids[i]] = nyu40_ids[i]
-        self.scan2nyu = scan2nyu
+        self.scan2nyu = manifest.scan2nyu
         self.label_mapping = PointSegClassMapping(
             valid_cat_ids=[1, 2, 3, 4, 5, 6, 7, 8, 9, 10,
                            11, 12, 14, 16, 24, 28, 33, 34, 36, 39],
@@ -277,16 +399,16 @@ class ScannetValDataset(Dataset):
         rgb_files = self.rgb_files
         pose_files = self.pose_files
         label_files = self.label_files
-        intrinsics_files = self.intrinsics_files
 
-        train_poses = np.stack([np.loadtxt(file).reshape(4, 4) for file in pose_files], axis=0)
+        train_poses = self.train_poses
         render_pose = train_poses[que_idx]
 
         subsample_factor = np.random.choice(np.arange(1, 6), p=[0.3, 0.25, 0.2, 0.2, 0.05])
 
-        id_feat_pool = get_nearest_pose_ids(
-            render_pose,
+        id_feat_pool = self.nearest_index.query(
+            os.path.dirname(os.path.dirname(pose_files[0])),
             train_poses,
+            render_pose,
             self.num_source_views * subsample_factor,
             tar_id=que_idx,
             angular_dist_method="vector",
@@ -299,27 +421,18 @@ class ScannetValDataset(Dataset):
         if np.random.choice([0, 1], p=[0.995, 0.005]):
             id_feat[np.random.choice(len(id_feat))] = que_idx
 
-        rgb = imageio.imread(rgb_files[que_idx]).astype(np.float32) / 255.0
+        rgb = self.read_rgb(rgb_files[que_idx])
 
-        if self.w != 1296:
-            rgb = cv2.resize(downsample_gaussian_blur(
-                rgb, self.ratio), (self.w, self.h), interpolation=cv2.INTER_LINEAR)
-            
-        intrinsics = np.loadtxt(intrinsics_files[que_idx]).reshape([4, 4])
+        intrinsics = self.intrinsics.copy()
         intrinsics[:2, :] *= self.ratio
 
-        img_size = rgb.shape[:2]
+        # the output size, also with --gpu_preprocess where rgb is still at the decoding size
+        img_size = (self.h, self.w)
         camera = np.concatenate((list(img_size), intrinsics.flatten(), render_pose.flatten())).astype(
             np.float32
         )
 
-        img = Image.open(label_files[que_idx])
-        label = np.asarray(img, dtype=np.int32)
-        label = np.ascontiguousarray(label)
-        label = cv2.resize(label, (self.w, self.h), interpolation=cv2.INTER_NEAREST)
-        label = label.astype(np.int32)
-        label = self.scan2nyu[label]
-        label = self.label_mapping(label)
+        label = self.read_label(label_files[que_idx])
 
         all_poses = [render_pose]
         # get depth range
@@ -329,24 +442,29 @@ class ScannetValDataset(Dataset):
         near_depth = max(origin_depth - max_radius, min_ratio * origin_depth)
         far_depth = origin_depth + max_radius
         # depth_range = torch.tensor([near_depth, far_depth])
-        depth_range = torch.tensor([0.1, 10.0])
+        # from the bounds of the source views, the sensor depth of the query frame is not an input
+        src_ids = [id for id in id_feat if id != que_idx]
+        depth_range = torch.from_numpy(source_depth_range(
+            self.depth_bounds, [pose_files[id] for id in src_ids], train_poses[src_ids], render_pose,
+            self.intrinsics, SCANNET_COLOR_SIZE,
+        ))
 
         src_rgbs = []
         src_cameras = []
+        src_depths = []
         for id in id_feat:
-            src_rgb = imageio.imread(rgb_files[id]).astype(np.float32) / 255.0
-            if self.w != 1296:
-                src_rgb = cv2.resize(downsample_gaussian_blur(
-                    src_rgb, self.ratio), (self.w, self.h), interpolation=cv2.INTER_LINEAR)
-            pose = np.loadtxt(pose_files[id]).reshape(4, 4)
+            src_rgb = self.read_rgb(rgb_files[id])
+            pose = train_poses[id]
 
             if self.rectify_inplane_rotation:
                 pose, src_rgb = rectify_inplane_rotation(pose.reshape(4, 4), render_pose, src_rgb)
 
             src_rgbs.append(src_rgb)
-            intrinsics = np.loadtxt(intrinsics_files[id]).reshape([4, 4])
+            if self.load_depth:
+                src_depths.append(self.read_depth(self.depth_files[id]))
+            intrinsics = self.intrinsics.copy()
             intrinsics[:2, :] *= self.ratio
-            img_size = src_rgb.shape[:2]
+            img_size = (self.h, self.w)
             src_camera = np.concatenate((list(img_size), intrinsics.flatten(), pose.flatten())).astype(
                 np.float32
             )
@@ -356,13 +474,17 @@ class ScannetValDataset(Dataset):
         src_rgbs = np.stack(src_rgbs)
         src_cameras = np.stack(src_cameras)
 
-        return {
+        ret = {
             "rgb": torch.from_numpy(rgb),
             "labels": torch.from_numpy(label),
             "camera": torch.from_numpy(camera),
             "rgb_path": rgb_files[que_idx],
+            "src_rgb_paths": [rgb_files[id] for id in id_feat],
             "src_rgbs": torch.from_numpy(src_rgbs),
             "src_cameras": torch.from_numpy(src_cameras),
             "depth_range": depth_range,
         }
+        if self.load_depth:
+            ret["src_depths"] = torch.from_numpy(np.stack(src_depths))
+        return ret
 
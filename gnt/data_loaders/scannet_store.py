@@ -0,0 +1,226 @@
+import os
+import json
+import numpy as np
+import imageio
+import cv2
+import torch
+from torch.utils.data import Dataset
+from PIL import Image
+import pandas as pd
+import sys
+
+sys.path.append("../")
+from .data_utils import rectify_inplane_rotation, get_nearest_pose_table
+from .utils.base_utils import downsample_gaussian_blur
+from .asset import *
+from .semantic_utils import PointSegClassMapping
+from .scannet_dataset import set_seed
+from .depth_bounds import load_depth_bounds, depth_range_of
+
+# Compact per-scene ScanNet store, written once by scripts/build_scannet_store.py:
+#   <store_root>/<scene>/meta.json    image size, frame paths and table sizes
+#   <store_root>/<scene>/cameras.npy  float32 [N, 34], img_size(2) + intrinsics(16) + pose(16)
+#   <store_root>/<scene>/rgbs.npy     uint8 [N, h, w, 3], blurred and resized like ScannetTrainDataset
+#   <store_root>/<scene>/labels.npy   uint8 [N, h, w], already mapped through scan2nyu and label_mapping
+#   <store_root>/<scene>/nearest.npy  int32 [N, K], nearest views of every frame ("vector" distance)
+# Frames with inf/nan poses are dropped when the store is built.
+STORE_VERSION = 1
+# largest subsample_factor of the source view sampler, the pool of a target is num_source_views * this many views
+MAX_SUBSAMPLE_FACTOR = 5
+
+
+def load_label_mapping(mapping_file="data/scannet/scannetv2-labels.combined.tsv"):
+    mapping_file = pd.read_csv(mapping_file, sep="\t", header=0)
+    scan_ids = mapping_file["id"].values
+    nyu40_ids = mapping_file["nyu40id"].values
+    scan2nyu = np.zeros(max(scan_ids) + 1, dtype=np.int32)
+    for i in range(len(scan_ids)):
+        scan2nyu[scan_ids[i]] = nyu40_ids[i]
+    label_mapping = PointSegClassMapping(
+        valid_cat_ids=[1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 14, 16, 24, 28, 33, 34, 36, 39],
+        max_cat_id=40,
+    )
+    return scan2nyu, label_mapping
+
+
+def build_scene_store(
+    scene_path, store_dir, scan2nyu, label_mapping, image_size=320, num_neighbors=64
+):
+    """
+    convert one exported ScanNet scene (color/, pose/, label-filt/, intrinsic/) into the store format
+    :param scene_path: e.g. data/scannet/scene0000_00
+    :param store_dir: output directory of this scene
+    :return: number of frames written
+    """
+    ratio = image_size / 1296
+    h, w = int(ratio * 972), int(image_size)
+
+    pose_files, poses = [], []
+    for f in sorted(os.listdir(os.path.join(scene_path, "pose"))):
+        path = os.path.join(scene_path, "pose", f)
+        pose = np.loadtxt(path).reshape(4, 4)
+        if np.isinf(pose).any() or np.isnan(pose).any():
+            continue
+        pose_files.append(path)
+        poses.append(pose)
+    poses = np.stack(poses, axis=0)
+    rgb_files = [f.replace("pose", "color").replace("txt", "jpg") for f in pose_files]
+    label_files = [f.replace("pose", "label-filt").replace("txt", "png") for f in pose_files]
+    num_frames = len(pose_files)
+
+    intrinsics = np.loadtxt(os.path.join(scene_path, "intrinsic/intrinsic_color.txt")).reshape([4, 4])
+    intrinsics[:2, :] *= ratio
+    cameras = np.concatenate(
+        (
+            np.tile(np.array([h, w], dtype=np.float64), (num_frames, 1)),
+            np.tile(intrinsics.flatten(), (num_frames, 1)),
+            poses.reshape(num_frames, 16),
+        ),
+        axis=1,
+    ).astype(np.float32)
+
+    os.makedirs(store_dir, exist_ok=True)
+    # meta.json is written last and marks the store as complete
+    if os.path.exists(os.path.join(store_dir, "meta.json")):
+        os.remove(os.path.join(store_dir, "meta.json"))
+    np.save(os.path.join(store_dir, "cameras.npy"), cameras)
+
+    rgbs = np.lib.format.open_memmap(
+        os.path.join(store_dir, "rgbs.npy"), mode="w+", dtype=np.uint8, shape=(num_frames, h, w, 3)
+    )
+    labels = np.lib.format.open_memmap(
+        os.path.join(store_dir, "labels.npy"), mode="w+", dtype=np.uint8, shape=(num_frames, h, w)
+    )
+    for i in range(num_frames):
+        rgb = imageio.imread(rgb_files[i]).astype(np.float32) / 255.0
+        if w != 1296:
+            rgb = cv2.resize(
+                downsample_gaussian_blur(rgb, ratio), (w, h), interpolation=cv2.INTER_LINEAR
+            )
+        rgbs[i] = np.clip(np.round(rgb * 255.0), 0, 255).astype(np.uint8)
+
+        label = np.asarray(Image.open(label_files[i]), dtype=np.int32)
+        label = cv2.resize(np.ascontiguousarray(label), (w, h), interpolation=cv2.INTER_NEAREST)
+        labels[i] = label_mapping(scan2nyu[label.astype(np.int32)]).astype(np.uint8)
+    rgbs.flush()
+    labels.flush()
+    del rgbs, labels
+
+    nearest = get_nearest_pose_table(poses, num_neighbors, angular_dist_method="vector")
+    np.save(os.path.join(store_dir, "nearest.npy"), nearest.astype(np.int32))
+
+    with open(os.path.join(store_dir, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "version": STORE_VERSION,
+                "h": h,
+                "w": w,
+                "ratio": ratio,
+                "num_neighbors": int(nearest.shape[1]),
+                "rgb_files": rgb_files,
+            },
+            f,
+        )
+    return num_frames
+
+
+# only for training, same sampling as ScannetTrainDataset but reading from the preprocessed store
+class ScannetStoreTrainDataset(Dataset):
+    def __init__(self, args, is_train, **kwargs):
+        if kwargs["train_set"] == "code":
+            self.scene_path_list = scannet_train_scans_320
+        elif kwargs["train_set"] == "org":
+            self.scene_path_list = org_train_scans_320
+
+        self.num_source_views = args.num_source_views
+        self.rectify_inplane_rotation = args.rectify_inplane_rotation
+
+        self.store_dirs, self.metas, self.depth_bounds = [], [], []
+        for scene_path in self.scene_path_list:
+            store_dir = os.path.join(args.scannet_store, os.path.basename(scene_path[:-10]))
+            meta_file = os.path.join(store_dir, "meta.json")
+            assert os.path.isfile(meta_file), (
+                "missing scene store {}, build it with scripts/build_scannet_store.py".format(store_dir)
+            )
+            with open(meta_file) as f:
+                meta = json.load(f)
+            assert meta["version"] == STORE_VERSION, "outdated scene store {}".format(store_dir)
+            # a shallower table would silently shrink the pool of the larger subsample factors
+            pool_size = min(self.num_source_views * MAX_SUBSAMPLE_FACTOR, len(meta["rgb_files"]) - 1)
+            assert meta["num_neighbors"] >= pool_size, (
+                "scene store {} keeps {} nearest views per frame, {} source views need {}, rebuild it with "
+                "scripts/build_scannet_store.py --num_source_views {}".format(
+                    store_dir, meta["num_neighbors"], self.num_source_views, pool_size, self.num_source_views
+                )
+            )
+            self.store_dirs.append(store_dir)
+            self.metas.append(meta)
+            # bounds of compute_scannet_depth_bounds.py are kept next to the poses of the exported scene
+            scene_dir = os.path.dirname(os.path.dirname(meta["rgb_files"][0]))
+            self.depth_bounds.append(load_depth_bounds(scene_dir) if args.depth_bounds else None)
+
+        # memory maps are opened lazily, so that every dataloader worker opens its own
+        self.scenes = {}
+
+    def open_scene(self, scene_idx):
+        if scene_idx not in self.scenes:
+            store_dir = self.store_dirs[scene_idx]
+            self.scenes[scene_idx] = {
+                "cameras": np.load(os.path.join(store_dir, "cameras.npy")),
+                "nearest": np.load(os.path.join(store_dir, "nearest.npy")),
+                "rgbs": np.load(os.path.join(store_dir, "rgbs.npy"), mmap_mode="r"),
+                "labels": np.load(os.path.join(store_dir, "labels.npy"), mmap_mode="r"),
+            }
+        return self.scenes[scene_idx]
+
+    def __len__(self):
+        return 999999  # 确保不会中断
+
+    def __getitem__(self, idx):
+        set_seed(idx, is_train=True)
+
+        real_idx = idx % len(self.store_dirs)
+        scene = self.open_scene(real_idx)
+        rgb_files = self.metas[real_idx]["rgb_files"]
+        cameras = scene["cameras"]
+
+        id_render = np.random.choice(np.arange(len(cameras)))
+        render_pose = cameras[id_render, -16:].reshape(4, 4).astype(np.float64)
+
+        subsample_factor = np.random.choice(np.arange(1, MAX_SUBSAMPLE_FACTOR + 1), p=[0.3, 0.25, 0.2, 0.2, 0.05])
+
+        # nearest views of the target, precomputed when the store was built
+        id_feat_pool = scene["nearest"][id_render, : self.num_source_views * subsample_factor]
+        id_feat = np.random.choice(id_feat_pool, self.num_source_views, replace=False)
+
+        if id_render in id_feat:
+            assert id_render not in id_feat
+        # occasionally include input image
+        if np.random.choice([0, 1], p=[0.995, 0.005]):
+            id_feat[np.random.choice(len(id_feat))] = id_render
+
+        rgb = scene["rgbs"][id_render].astype(np.float32) / 255.0
+        label = scene["labels"][id_render].astype(np.int64)
+        camera = cameras[id_render].copy()
+
+        depth_range = torch.from_numpy(depth_range_of(self.depth_bounds[real_idx], rgb_files[id_render]))
+
+        src_rgbs = scene["rgbs"][id_feat].astype(np.float32) / 255.0
+        src_labels = scene["labels"][id_feat].astype(np.int64)
+        src_cameras = cameras[id_feat].copy()
+        if self.rectify_inplane_rotation:
+            for i in range(len(id_feat)):
+                pose = src_cameras[i, -16:].reshape(4, 4).astype(np.float64)
+                pose, src_rgbs[i] = rectify_inplane_rotation(pose, render_pose, src_rgbs[i])
+                src_cameras[i, -16:] = pose.flatten()
+
+        return {
+            "rgb": torch.from_numpy(rgb),
+            "labels": torch.from_numpy(label),
+            "camera": torch.from_numpy(camera),
+            "rgb_path": rgb_files[id_render],
+            "src_rgbs": torch.from_numpy(src_rgbs),
+            "src_labels": torch.from_numpy(src_labels),
+            "src_cameras": torch.from_numpy(src_cameras),
+            "depth_range": depth_range,
+        }
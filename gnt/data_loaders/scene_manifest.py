@@ -0,0 +1,169 @@
+import hashlib
+import os
+
+import numpy as np
+
+# Manifest of a list of exported ScanNet scenes, one binary file per list (split) under the manifest directory:
+#   <manifest_dir>/scannet_<hash of the scene list>.npz
+# It holds the pose file names of every scene in listing order with their poses and an inf/nan flag, the color
+# intrinsics of every scene and the scan2nyu table, so that the datasets build their indices without listing
+# the scenes or parsing a pose file. A scene is rescanned when its stamp changes: a digest of the name, size and
+# mtime of every pose file (frames added, removed or rewritten in place) and of its intrinsics. scan2nyu is
+# reloaded when the label tsv changes. A manifest is validated once per process, later loads reuse it.
+MANIFEST_VERSION = 2
+MANIFEST_DIR = "data/manifests"
+LABEL_MAPPING_FILE = "data/scannet/scannetv2-labels.combined.tsv"
+INTRINSICS_FILE = "intrinsic/intrinsic_color.txt"
+
+# manifests already loaded by this process, keyed by their file
+_manifests = {}
+
+
+def scene_stamp(scene_path):
+    """
+    digest of the name, size and mtime of the pose files and the intrinsics of a scene, one stat per file
+    """
+    files = [(e.name, e.stat()) for e in os.scandir(os.path.join(scene_path, "pose"))]
+    files = sorted(files) + [(INTRINSICS_FILE, os.stat(os.path.join(scene_path, INTRINSICS_FILE)))]
+    digest = hashlib.sha1()
+    for name, st in files:
+        digest.update("{}:{}:{};".format(name, st.st_size, st.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+def scan_scene(scene_path):
+    """
+    :return: pose file names (sorted like os.listdir order of the loaders), [N, 4, 4] poses, [N] valid flags,
+             [4, 4] color intrinsics of one exported scene
+    """
+    frames = sorted(os.listdir(os.path.join(scene_path, "pose")))
+    poses = np.array([np.loadtxt(os.path.join(scene_path, "pose", f)).reshape(4, 4) for f in frames])
+    poses = poses.reshape(-1, 4, 4)
+    valid = ~(np.isinf(poses).any(axis=(1, 2)) | np.isnan(poses).any(axis=(1, 2)))
+    intrinsics = np.loadtxt(os.path.join(scene_path, INTRINSICS_FILE)).reshape(4, 4)
+    return frames, poses, valid, intrinsics
+
+
+def load_scan2nyu(mapping_file=LABEL_MAPPING_FILE):
+    """
+    nyu40 class of every raw ScanNet label id
+    """
+    import pandas as pd
+
+    mapping_file = pd.read_csv(mapping_file, sep="\t", header=0)
+    scan_ids = mapping_file["id"].values
+    nyu40_ids = mapping_file["nyu40id"].values
+    scan2nyu = np.zeros(max(scan_ids) + 1, dtype=np.int32)
+    for i in range(len(scan_ids)):
+        scan2nyu[scan_ids[i]] = nyu40_ids[i]
+    return scan2nyu
+
+
+class SceneManifest(object):
+    """
+    frames, poses and intrinsics of a list of scenes, see load_scene_manifest
+    """
+
+    def __init__(self, scenes, scan2nyu):
+        # scene path -> {"frames", "poses", "valid", "intrinsics", "stamp"}
+        self.scenes = scenes
+        self.scan2nyu = scan2nyu
+
+    def pose_files(self, scene_path, valid_only=True):
+        scene = self.scenes[scene_path]
+        frames = np.asarray(scene["frames"])
+        if valid_only:
+            frames = frames[scene["valid"]]
+        return [os.path.join(scene_path, "pose", f) for f in frames]
+
+    def poses(self, scene_path, valid_only=True):
+        """
+        :return: [N, 4, 4] float64 poses, in the order of pose_files
+        """
+        scene = self.scenes[scene_path]
+        return scene["poses"][scene["valid"]] if valid_only else scene["poses"]
+
+    def intrinsics(self, scene_path):
+        return self.scenes[scene_path]["intrinsics"]
+
+    def save(self, path):
+        paths = list(self.scenes)
+        scenes = [self.scenes[p] for p in paths]
+        tmp_path = "{}.{}.tmp.npz".format(path[: -len(".npz")], os.getpid())
+        np.savez(
+            tmp_path,
+            version=MANIFEST_VERSION,
+            scene_paths=np.array(paths, dtype=str),
+            stamps=np.array([s["stamp"] for s in scenes], dtype=str),
+            counts=np.array([len(s["frames"]) for s in scenes], dtype=np.int64),
+            frames=np.array([f for s in scenes for f in s["frames"]], dtype=str),
+            poses=np.concatenate([s["poses"] for s in scenes]).reshape(-1, 4, 4),
+            valid=np.concatenate([s["valid"] for s in scenes]).astype(bool),
+            intrinsics=np.stack([s["intrinsics"] for s in scenes]).reshape(-1, 4, 4),
+            scan2nyu=self.scan2nyu,
+        )
+        # ranks and workers building the same manifest never see a partial file
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :return: SceneManifest of a manifest file, None if it is missing or of another version
+        """
+        if not os.path.isfile(path):
+            return None
+        with np.load(path, allow_pickle=False) as f:
+            if int(f["version"]) != MANIFEST_VERSION:
+                return None
+            data = {k: f[k] for k in f.files}
+        scenes = {}
+        ends = np.cumsum(data["counts"])
+        for i, scene_path in enumerate(data["scene_paths"].tolist()):
+            frames = slice(ends[i] - data["counts"][i], ends[i])
+            scenes[scene_path] = {
+                "frames": data["frames"][frames].tolist(),
+                "poses": data["poses"][frames],
+                "valid": data["valid"][frames],
+                "intrinsics": data["intrinsics"][i],
+                "stamp": str(data["stamps"][i]),
+            }
+        return cls(scenes, data["scan2nyu"])
+
+
+def manifest_file(scene_paths, manifest_dir=MANIFEST_DIR):
+    key = hashlib.sha1("\n".join(os.path.abspath(p) for p in scene_paths).encode()).hexdigest()[:16]
+    return os.path.join(manifest_dir, "scannet_{}.npz".format(key))
+
+
+def load_scene_manifest(scene_paths, manifest_dir=MANIFEST_DIR, mapping_file=LABEL_MAPPING_FILE):
+    """
+    manifest of the given exported scenes, loaded from its file under manifest_dir; scenes that changed since
+    (or the whole manifest, for another scene list) are rescanned and the file is rewritten
+    :param scene_paths: scene directories, e.g. data/scannet/scene0000_00
+    :param manifest_dir: where the manifests are cached, '' scans the scenes without caching (and on every call)
+    :return: SceneManifest
+    """
+    path = manifest_file(scene_paths, manifest_dir) if manifest_dir else None
+    if path is not None and path in _manifests:
+        return _manifests[path]
+    cached = None if path is None else SceneManifest.load(path)
+
+    scenes, changed = {}, cached is None
+    for scene_path in scene_paths:
+        stamp = scene_stamp(scene_path)
+        scene = None if cached is None else cached.scenes.get(scene_path)
+        if scene is None or scene["stamp"] != stamp:
+            frames, poses, valid, intrinsics = scan_scene(scene_path)
+            scene = {"frames": frames, "poses": poses, "valid": valid, "intrinsics": intrinsics, "stamp": stamp}
+            changed = True
+        scenes[scene_path] = scene
+
+    mapping_changed = cached is None or os.path.getmtime(mapping_file) > os.path.getmtime(path)
+    scan2nyu = load_scan2nyu(mapping_file) if mapping_changed else cached.scan2nyu
+    manifest = SceneManifest(scenes, scan2nyu)
+    if path is not None:
+        if changed or mapping_changed:
+            os.makedirs(manifest_dir, exist_ok=True)
+            manifest.save(path)
+        _manifests[path] = manifest
+    return manifest
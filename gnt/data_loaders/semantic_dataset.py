@@ -4,7 +4,6 @@ import imageio
 import cv2
 import random
 import time
-import pandas as pd
 from PIL import Image
 import torch
 from torch.utils.data import Dataset
@@ -12,6 +11,7 @@ from torch.utils.data import Dataset
 from .utils.base_utils import downsample_gaussian_blur
 from .asset import *
 from .semantic_utils import PointSegClassMapping
+from .scene_manifest import load_scene_manifest
 
 scannet_set = scannet_train_scans_320
 
@@ -40,13 +40,12 @@ class OrderRendererDataset(Dataset):
         self.all_rgb_files = []
         self.all_label_files = []
         self.all_pose_files = []
-        for i, scene_path in enumerate(self.scene_path_list):
-            scene_path = os.path.join('data', scene_path[:-10])
-            pose_files = []
-            for f in sorted(os.listdir(os.path.join(scene_path, "pose"))):
-                path = os.path.join(scene_path, "pose", f)
-                pose_files.append(path)
-                    
+        # all frames, also those with inf/nan poses
+        scene_paths = [os.path.join('data', scene_path[:-10]) for scene_path in self.scene_path_list]
+        manifest = load_scene_manifest(scene_paths)
+        for scene_path in scene_paths:
+            pose_files = manifest.pose_files(scene_path, valid_only=False)
+
             rgb_files = [f.replace("pose", "color").replace("txt", "jpg") for f in pose_files]
             label_files = [f.replace("pose", "label-filt").replace("txt", "png") for f in pose_files]
 
@@ -57,14 +56,7 @@ class OrderRendererDataset(Dataset):
         self.all_rgb_files = np.concatenate(self.all_rgb_files)
         self.all_label_files = np.concatenate(self.all_label_files)
 
-        mapping_file = 'data/scannet/scannetv2-labels.combined.tsv'
-        mapping_file = pd.read_csv(mapping_file, sep='\t', header=0)
-        scan_ids = mapping_file['id'].values
-        nyu40_ids = mapping_file['nyu40id'].values
-        scan2nyu = np.zeros(max(scan_ids) + 1, dtype=np.int32)
-        for i in range(len(scan_ids)):
-            scan2nyu[scan_ids[i]] = nyu40_ids[i]
-        self.scan2nyu = scan2nyu
+        self.scan2nyu = manifest.scan2nyu
         self.label_mapping = PointSegClassMapping(
             valid_cat_ids=[1, 2, 3, 4, 5, 6, 7, 8, 9, 10,
                            11, 12, 14, 16, 24, 28, 33, 34, 36, 39],
@@ -114,13 +106,12 @@ class RandomRendererDataset(Dataset):
         all_rgb_files = []
         all_label_files = []
         all_pose_files = []
-        for i, scene_path in enumerate(self.scene_path_list):
-            scene_path = os.path.join('data', scene_path[:-10])
-            pose_files = []
-            for f in sorted(os.listdir(os.path.join(scene_path, "pose"))):
-                path = os.path.join(scene_path, "pose", f)
-                pose_files.append(path)
-                    
+        # all frames, also those with inf/nan poses
+        scene_paths = [os.path.join('data', scene_path[:-10]) for scene_path in self.scene_path_list]
+        manifest = load_scene_manifest(scene_paths)
+        for scene_path in scene_paths:
+            pose_files = manifest.pose_files(scene_path, valid_only=False)
+
             rgb_files = [f.replace("pose", "color").replace("txt", "jpg") for f in pose_files]
             label_files = [f.replace("pose", "label-filt").replace("txt", "png") for f in pose_files]
 
@@ -132,14 +123,7 @@ class RandomRendererDataset(Dataset):
         self.all_rgb_files = np.array(all_rgb_files)[index]
         self.all_label_files = np.array(all_label_files)[index]
 
-        mapping_file = 'data/scannet/scannetv2-labels.combined.tsv'
-        mapping_file = pd.read_csv(mapping_file, sep='\t', header=0)
-        scan_ids = mapping_file['id'].values
-        nyu40_ids = mapping_file['nyu40id'].values
-        scan2nyu = np.zeros(max(scan_ids) + 1, dtype=np.int32)
-        for i in range(len(scan_ids)):
-            scan2nyu[scan_ids[i]] = nyu40_ids[i]
-        self.scan2nyu = scan2nyu
+        self.scan2nyu = manifest.scan2nyu
         self.label_mapping = PointSegClassMapping(
             valid_cat_ids=[1, 2, 3, 4, 5, 6, 7, 8, 9, 10,
                            11, 12, 14, 16, 24, 28, 33, 34, 36, 39],
@@ -193,13 +177,12 @@ class StatisticRendererDataset(Dataset):
         all_rgb_files = []
         all_label_files = []
         all_pose_files = []
-        for i, scene_path in enumerate(self.scene_path_list):
-            scene_path = os.path.join('data', scene_path[:-10])
-            pose_files = []
-            for f in sorted(os.listdir(os.path.join(scene_path, "pose"))):
-                path = os.path.join(scene_path, "pose", f)
-                pose_files.append(path)
-                    
+        # all frames, also those with inf/nan poses
+        scene_paths = [os.path.join('data', scene_path[:-10]) for scene_path in self.scene_path_list]
+        manifest = load_scene_manifest(scene_paths)
+        for scene_path in scene_paths:
+            pose_files = manifest.pose_files(scene_path, valid_only=False)
+
             rgb_files = [f.replace("pose", "color").replace("txt", "jpg") for f in pose_files]
             label_files = [f.replace("pose", "label-filt").replace("txt", "png") for f in pose_files]
 
@@ -211,14 +194,7 @@ class StatisticRendererDataset(Dataset):
         self.all_rgb_files = np.array(all_rgb_files)[index]
         self.all_label_files = np.array(all_label_files)[index]
 
-        mapping_file = 'data/scannet/scannetv2-labels.combined.tsv'
-        mapping_file = pd.read_csv(mapping_file, sep='\t', header=0)
-        scan_ids = mapping_file['id'].values
-        nyu40_ids = mapping_file['nyu40id'].values
-        scan2nyu = np.zeros(max(scan_ids) + 1, dtype=np.int32)
-        for i in range(len(scan_ids)):
-            scan2nyu[scan_ids[i]] = nyu40_ids[i]
-        self.scan2nyu = scan2nyu
+        self.scan2nyu = manifest.scan2nyu
         self.label_mapping = PointSegClassMapping(
             valid_cat_ids=[1, 2, 3, 4, 5, 6, 7, 8, 9, 10,
                            11, 12, 14, 16, 24, 28, 33, 34, 36, 39],
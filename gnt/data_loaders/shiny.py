@@ -6,7 +6,7 @@ import sys
 
 sys.path.append("../")
 from torch.utils.data import Dataset
-from .data_utils import random_crop, get_nearest_pose_ids
+from .data_utils import random_crop, get_nearest_pose_ids, NearestPoseIndex
 from .shiny_data_utils import load_llff_data, batch_parse_llff_poses
 
 
@@ -16,6 +16,7 @@ class ShinyDataset(Dataset):
         self.args = args
         self.mode = mode  # train / test / validation
         self.num_source_views = args.num_source_views
+        self.nearest_index = NearestPoseIndex(args.nearest_index_dir)
         self.random_crop = random_crop
         self.render_rgb_files = []
         self.render_intrinsics = []
@@ -130,9 +131,10 @@ class ShinyDataset(Dataset):
             subsample_factor = 1
             num_select = self.num_source_views
 
-        nearest_pose_ids = get_nearest_pose_ids(
-            render_pose,
+        nearest_pose_ids = self.nearest_index.query(
+            "{}:{}".format(os.path.dirname(train_rgb_files[0]), self.mode),
             train_poses,
+            render_pose,
             min(self.num_source_views * subsample_factor, 28),
             tar_id=id_render,
             angular_dist_method="dist",
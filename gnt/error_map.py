@@ -0,0 +1,98 @@
+import math
+
+import torch
+
+
+class ErrorMapStore(object):
+    """
+    per-frame low resolution maps of the recent training error, keyed by rgb_path, for sample_mode importance.
+    a map holds ceil(H / stride) x ceil(W / stride) cells in float16 (kept on the cpu, 2.4KB for a 240x320 frame
+    at stride 8); after every step the cells hit by rays move towards the mean error of those rays with an
+    exponential moving average. the sampling weights of a frame are its map spread over the pixels, mixed with a
+    uniform share so that converged regions are still visited
+    """
+
+    def __init__(self, device, stride=8, decay=0.9, uniform=0.2):
+        """
+        :param stride: pixels per cell side
+        :param decay: weight of the previous value of a cell in the moving average
+        :param uniform: share of the sampling probability spread uniformly over the image
+        """
+        self.device = device
+        self.stride = stride
+        self.decay = decay
+        self.uniform = uniform
+        self.maps = {}
+        self.cell_index = {}
+
+    @classmethod
+    def from_args(cls, args, device):
+        return cls(device, stride=args.error_map_stride, decay=args.error_map_decay, uniform=args.error_map_uniform)
+
+    def grid_size(self, H, W):
+        return math.ceil(H / self.stride), math.ceil(W / self.stride)
+
+    def pixel_cells(self, H, W):
+        """
+        :return: [H*W] cell of every pixel, on the device
+        """
+        if (H, W) not in self.cell_index:
+            gw = self.grid_size(H, W)[1]
+            ys = torch.arange(H, device=self.device) // self.stride
+            xs = torch.arange(W, device=self.device) // self.stride
+            self.cell_index[(H, W)] = (ys[:, None] * gw + xs[None, :]).flatten()
+        return self.cell_index[(H, W)]
+
+    def weights(self, rgb_paths, H, W):
+        """
+        :param rgb_paths: target view of every batch element
+        :return: [batch, H*W] sampling weights on the device, None if no frame of the batch has a map yet
+        """
+        if not any(path in self.maps for path in rgb_paths):
+            return None
+        cells = self.pixel_cells(H, W)
+        weights = []
+        for path in rgb_paths:
+            if path in self.maps:
+                err = self.maps[path].to(self.device, non_blocking=True).float()[cells]
+                p = (1 - self.uniform) * err / err.sum().clamp_min(1e-12) + self.uniform / (H * W)
+            else:
+                p = torch.full((H * W,), 1.0 / (H * W), device=self.device)
+            weights.append(p)
+        return torch.stack(weights)
+
+    @torch.no_grad()
+    def update(self, rgb_paths, H, W, select_inds, errors):
+        """
+        :param select_inds: [batch*N_rand] indices into the flattened [batch*H*W] pixels of the step
+        :param errors: [batch*N_rand] loss of every ray
+        """
+        gh, gw = self.grid_size(H, W)
+        select_inds = torch.as_tensor(select_inds, device=self.device)
+        errors = errors.detach().float().to(self.device)
+        cells = self.pixel_cells(H, W)[select_inds % (H * W)]
+        batch_inds = select_inds // (H * W)
+        for b, path in enumerate(rgb_paths):
+            mask = batch_inds == b
+            err_b = errors[mask]
+            sums = torch.zeros(gh * gw, device=self.device).index_add_(0, cells[mask], err_b)
+            counts = torch.bincount(cells[mask], minlength=gh * gw)
+            if path in self.maps:
+                err_map = self.maps[path].to(self.device).float()
+            else:
+                # a new frame starts from its mean ray error everywhere
+                err_map = torch.full((gh * gw,), err_b.mean().item(), device=self.device)
+            hit = counts > 0
+            err_map[hit] = self.decay * err_map[hit] + (1 - self.decay) * sums[hit] / counts[hit]
+            self.maps[path] = err_map.half().cpu()
+
+    def stats(self):
+        if len(self.maps) == 0:
+            return {"frames": 0}
+        means = torch.stack([m.float().mean() for m in self.maps.values()])
+        return {
+            "frames": len(self.maps),
+            "mean_error": means.mean().item(),
+            "max_frame_error": means.max().item(),
+            "size_mb": sum(m.numel() * m.element_size() for m in self.maps.values()) / 2**20,
+        }
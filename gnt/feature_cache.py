@@ -0,0 +1,111 @@
+import torch
+from collections import OrderedDict
+
+
+def _apply(fn, feats):
+    """
+    fn on every map of a tuple of feature maps, which may nest tuples (the FPN levels of --native_fpn)
+    """
+    return tuple(_apply(fn, f) if isinstance(f, tuple) else fn(f) for f in feats)
+
+
+def _nbytes(feats):
+    return sum(_nbytes(f) if isinstance(f, tuple) else f.numel() * f.element_size() for f in feats)
+
+
+def _stack(entries):
+    # per-view tuples of maps to a tuple of stacked maps
+    if isinstance(entries[0], tuple):
+        return tuple(_stack(list(f)) for f in zip(*entries))
+    return torch.stack(entries, dim=0)
+
+
+class ReferenceFeatureCache(object):
+    """
+    LRU cache of per-source-image feature maps, used by full-image evaluation and rendering where
+    consecutive target views share most of their source views.
+    Entries are keyed by (image path, resolution, checkpoint step) and kept within a memory budget,
+    either on the compute device or offloaded to (pinned) host memory.
+    The feature networks are per-image (instance norm / eval-mode batch norm), so the cached maps are
+    identical to encoding the whole source stack at once.
+    """
+
+    def __init__(self, budget_mb, storage="cuda"):
+        """
+        :param budget_mb: memory budget of the cached feature maps in MB
+        :param storage: 'cuda' keeps the entries on the compute device, 'cpu' offloads them to host memory
+        """
+        assert storage in ["cuda", "cpu"], "unknown feature cache storage {}".format(storage)
+        self.budget = int(budget_mb * 1024**2)
+        self.storage = storage
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.step = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def _store(self, feats):
+        if self.storage == "cpu":
+            feats = _apply(lambda f: f.to("cpu", copy=True), feats)
+            if torch.cuda.is_available():
+                feats = _apply(lambda f: f.pin_memory(), feats)
+        else:
+            # copy, a view would keep the whole batched output alive
+            feats = _apply(lambda f: f.clone(), feats)
+        return feats
+
+    def lookup(self, paths, images, encode_fn, step=0):
+        """
+        :param paths: n_views source image paths
+        :param images: [n_views, 3, h, w] source images on the compute device
+        :param encode_fn: maps [n, 3, h, w] images to a tuple of feature maps, each [n, c, h', w'] (or a tuple of them)
+        :param step: checkpoint step the model weights come from
+        :return: tuple of [n_views, c, h', w'] feature maps, ordered as paths
+        """
+        assert len(paths) == images.shape[0]
+        # entries of another checkpoint can never be hit again
+        if step != self.step:
+            self.clear()
+            self.step = step
+
+        h, w = images.shape[-2:]
+        keys = [(path, int(h), int(w), step) for path in paths]
+        feats = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                feats[i] = _apply(lambda f: f.to(images.device, non_blocking=True), self.entries[key])
+                self.hits += 1
+            else:
+                missing.append(i)
+                self.misses += 1
+
+        if len(missing) > 0:
+            # encode all misses of this frame in one batch
+            outs = encode_fn(images[missing])
+            for j, i in enumerate(missing):
+                feats[i] = _apply(lambda o: o[j], outs)
+                if keys[i] not in self.entries:
+                    entry = self._store(feats[i])
+                    self.entries[keys[i]] = entry
+                    self.nbytes += _nbytes(entry)
+
+        while self.nbytes > self.budget and len(self.entries) > 0:
+            _, entry = self.entries.popitem(last=False)
+            self.nbytes -= _nbytes(entry)
+
+        return _stack(feats)
+
+    def stats(self):
+        total = max(self.hits + self.misses, 1)
+        return "reference feature cache: {} entries, {:.1f} MB, hits {}, misses {}, hit rate {:.3f}".format(
+            len(self.entries), self.nbytes / 1024**2, self.hits, self.misses, self.hits / total
+        )
@@ -158,12 +158,15 @@ class FPN(BaseModule):
                     inplace=False)
                 self.fpn_convs.append(extra_fpn_conv)
 
-    def forward(self, inputs: Tuple[Tensor]) -> tuple:
+    def forward(self, inputs: Tuple[Tensor], levels: bool = False) -> tuple:
         """Forward function.
 
         Args:
             inputs (tuple[Tensor]): Features from the upstream network, each
                 is a 4D-tensor.
+            levels (bool): Return the outputs at their native strides even
+                if ``concat_out`` is set, for consumers that sample every
+                level themselves (see ``Projector.compute``).
 
         Returns:
             tuple: Feature maps, each is a 4D-tensor.
@@ -218,10 +221,17 @@ class FPN(BaseModule):
                         outs.append(self.fpn_convs[i](F.relu(outs[-1])))
                     else:
                         outs.append(self.fpn_convs[i](outs[-1]))
-        if self.concat_out is True:
-            outs[1] = F.interpolate(outs[1], outs[0].shape[-2:], mode='bilinear', align_corners=True)  # 上采样到和rgb feat一样的维度
-            outs[2] = F.interpolate(outs[2], outs[0].shape[-2:], mode='bilinear', align_corners=True)  # 上采样到和rgb feat一样的维度
-            outs[3] = F.interpolate(outs[3], outs[0].shape[-2:], mode='bilinear', align_corners=True)  # 上采样到和rgb feat一样的维度
-            return torch.cat(outs, dim=1)
+        if self.concat_out is True and levels is False:
+            return concat_levels(outs)
         else:
             return tuple(outs)
+
+
+def concat_levels(outs):
+    """
+    upsample the FPN outputs to the resolution of the first (largest) one and concatenate them along channels
+    """
+    outs = list(outs)
+    for i in range(1, len(outs)):
+        outs[i] = F.interpolate(outs[i], outs[0].shape[-2:], mode='bilinear', align_corners=True)  # 上采样到和rgb feat一样的维度
+    return torch.cat(outs, dim=1)
@@ -2,7 +2,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from pathlib import Path
-from sklearn.metrics import confusion_matrix
 from skimage.io import imsave
 from utils import concat_images_list
 import numpy as np
@@ -44,6 +43,13 @@ class RenderLoss(nn.Module):
             results["train/rgb-loss"] += self.compute_rgb_loss(rgb_fine, rgb_gt)
             # results = {"train/fine-psnr-training-batch": mse2psnr(results["train/fine-loss"])}
         return results
+
+    def ray_losses(self, data_pred, data_gt):
+        """
+        squared error of every ray, of the fine output if there is one, e.g. for the error maps of importance sampling
+        """
+        outputs = data_pred["outputs_fine"] if data_pred["outputs_fine"] is not None else data_pred["outputs_coarse"]
+        return torch.sum((outputs["rgb"].float() - data_gt["rgb"]) ** 2, -1) * self.render_loss_scale
     
 class SemanticLoss(Loss):
     def __init__(self, args):
@@ -89,6 +95,18 @@ class SemanticLoss(Loss):
             return F.cross_entropy(label_pr, label_gt, reduction='mean', label_smoothing=0).unsqueeze(0)
 
     
+    def ray_losses(self, label_pr, label_gt, select_inds=None):
+        """
+        cross entropy of every ray, 0 for ignored labels
+        :param select_inds: gathers the rays from full-image predictions and labels
+        """
+        label_pr = label_pr.reshape(-1, self.num_classes)
+        label_gt = label_gt.reshape(-1).long()
+        if select_inds is not None:
+            label_pr, label_gt = label_pr[select_inds], label_gt[select_inds]
+        loss = F.cross_entropy(label_pr.float(), label_gt, reduction='none', ignore_index=self.ignore_label)
+        return loss * self.semantic_loss_scale
+
     def __call__(self, data_pred, data_gt, step, **kwargs):
         
         pixel_label_gt = data_gt['labels']
@@ -169,62 +187,117 @@ class DepthLoss(nn.Module):
         return outputs
     
 # From https://github.com/Harry-Zhi/semantic_nerf/blob/a0113bb08dc6499187c7c48c3f784c2764b8abf1/SSR/training/training_utils.py
+class ConfusionMatrix(object):
+    """
+    streaming semantic segmentation metric: an int64 [num_classes, num_classes] confusion matrix (rows: true
+    labels) kept on the device of the predictions and updated with one bincount per batch, so accumulating it
+    never waits for the host. pixels labeled ignore_label, and pixels whose true or predicted class is outside
+    [0, num_classes), are not counted (as sklearn.metrics.confusion_matrix with labels=range(num_classes))
+    """
+
+    def __init__(self, num_classes, ignore_label=-1, device=None):
+        self.num_classes = num_classes
+        self.ignore_label = ignore_label
+        self.mat = None if device is None else torch.zeros(num_classes, num_classes, dtype=torch.int64, device=device)
+
+    @classmethod
+    def from_args(cls, args, device=None):
+        return cls(args.num_classes, args.ignore_label, device)
+
+    def batch_matrix(self, pred, target):
+        """
+        :param pred: predicted classes, any shape
+        :param target: true classes, same number of elements
+        :return: [num_classes, num_classes] confusion matrix of the batch
+        """
+        C = self.num_classes
+        pred = pred.reshape(-1).long()
+        target = target.reshape(-1).long().to(pred.device)
+        valid = (target >= 0) & (target < C) & (pred >= 0) & (pred < C)
+        if self.ignore_label != -1:
+            valid &= target != self.ignore_label
+        # invalid pixels land in an extra bin that is dropped, no boolean indexing (and no sync for its size)
+        inds = torch.where(valid, target * C + pred, torch.full_like(pred, C * C))
+        return torch.bincount(inds, minlength=C * C + 1)[: C * C].view(C, C)
+
+    @torch.no_grad()
+    def update(self, pred, target):
+        """
+        adds a batch to the matrix
+        :return: the confusion matrix of the batch
+        """
+        batch_mat = self.batch_matrix(pred, target)
+        if self.mat is None:
+            self.mat = torch.zeros_like(batch_mat)
+        self.mat += batch_mat.to(self.mat.device)
+        return batch_mat
+
+    def reset(self):
+        if self.mat is not None:
+            self.mat.zero_()
+
+    def all_reduce(self):
+        """
+        sums the matrices of all ranks of the default process group
+        """
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(self.mat)
+        return self
+
+    def compute(self):
+        return confusion_scores(self.mat)
+
+
+def confusion_scores(conf_mat):
+    """
+    :param conf_mat: [num_classes, num_classes] confusion matrix (rows: true labels), tensor or array
+    :return: {'miou', 'total_accuracy', 'class_average_accuracy'} as float32 tensors of shape [1]; classes that do
+             not occur in the ground truth are left out of the means, all are 0 for an empty matrix
+    """
+    conf_mat = torch.as_tensor(conf_mat).double()
+    tp = torch.diagonal(conf_mat)
+    true_count = conf_mat.sum(dim=1)
+    existing = true_count > 0
+    ious = tp / (true_count + conf_mat.sum(dim=0) - tp).clamp_min(1)
+    n_existing = existing.sum().clamp_min(1)
+    empty = ~existing.any()
+    output = {
+        'miou': torch.where(empty, 0.0, ious[existing].sum() / n_existing),
+        'total_accuracy': torch.where(empty, 0.0, tp.sum() / conf_mat.sum().clamp_min(1)),
+        'class_average_accuracy': torch.where(empty, 0.0, (tp / true_count.clamp_min(1))[existing].sum() / n_existing),
+    }
+    return {k: v.float().reshape(1) for k, v in output.items()}
+
+
 class IoU(Loss):
 
     def __init__(self, args):
         super().__init__([])
         self.num_classes = args.num_classes
         self.ignore_label = args.ignore_label
+        self.metric = ConfusionMatrix(self.num_classes, self.ignore_label)
 
 
     def __call__(self, data_pred, data_gt, step, **kwargs):
-        true_labels = data_gt['labels'].reshape([-1]).long().detach().cpu().numpy()
+        """
+        scores of a single view, on the device of the predictions; 'conf_mat' is the confusion matrix of the view.
+        with metric=<ConfusionMatrix> the view is also added to that matrix, for dataset-level scores
+        """
         if 'outputs_fine' in data_pred:
-            predicted_labels = data_pred['outputs_fine']['sems'].argmax(
-                dim=-1).reshape([-1]).long().detach().cpu().numpy()
+            predicted_labels = data_pred['outputs_fine']['sems'].argmax(dim=-1)
         else:
-            predicted_labels = data_pred['outputs_coarse']['sems'].argmax(
-                dim=-1).reshape([-1]).long().detach().cpu().numpy()
+            predicted_labels = data_pred['outputs_coarse']['sems'].argmax(dim=-1)
 
-        if self.ignore_label != -1:
-            valid_pix_ids = true_labels != self.ignore_label
+        metric = kwargs.get('metric')
+        if metric is not None:
+            conf_mat = metric.update(predicted_labels, data_gt['labels'])
         else:
-            valid_pix_ids = np.ones_like(true_labels, dtype=bool)
-
-        predicted_labels = predicted_labels[valid_pix_ids]
-        true_labels = true_labels[valid_pix_ids]
-
-        conf_mat = confusion_matrix(
-            true_labels, predicted_labels, labels=list(range(self.num_classes)))
-        norm_conf_mat = np.transpose(np.transpose(
-            conf_mat) / conf_mat.astype(float).sum(axis=1))
-
-        # missing class will have NaN at corresponding class
-        missing_class_mask = np.isnan(norm_conf_mat.sum(1))
-        exsiting_class_mask = ~ missing_class_mask
-
-        class_average_accuracy = nanmean(np.diagonal(norm_conf_mat))
-        total_accuracy = (np.sum(np.diagonal(conf_mat)) / np.sum(conf_mat))
-        ious = np.zeros(self.num_classes)
-        for class_id in range(self.num_classes):
-            ious[class_id] = (conf_mat[class_id, class_id] / (
-                np.sum(conf_mat[class_id, :]) + np.sum(conf_mat[:, class_id]) -
-                conf_mat[class_id, class_id]))
-        miou = np.mean(ious[exsiting_class_mask])
-        if np.isnan(miou):
-            miou = 0.
-            total_accuracy = 0.
-            class_average_accuracy = 0.
-        output = {
-            'miou': torch.tensor([miou], dtype=torch.float32),
-            'total_accuracy': torch.tensor([total_accuracy], dtype=torch.float32),
-            'class_average_accuracy': torch.tensor([class_average_accuracy], dtype=torch.float32)
-        }
+            conf_mat = self.metric.batch_matrix(predicted_labels, data_gt['labels'])
+        output = confusion_scores(conf_mat)
+        output['conf_mat'] = conf_mat
         return output
 
 
-
-
 def interpolate_feats(feats, points, h=None, w=None, padding_mode='zeros', align_corners=False, inter_mode='bilinear'):
     """
 
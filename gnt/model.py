@@ -5,6 +5,8 @@ from gnt.transformer_network import GNT
 from gnt.feature_network import ResUNet, resnet50
 from gnt.fpn import FPN
 from gnt.semantic_branch import NeRFSemSegFPNHead
+from gnt.amp import amp_dtype, autocast, make_grad_scaler, to_channels_last, contiguous_state_dict
+from gnt.checkpoint import AsyncCheckpointWriter, load_checkpoint
 import torchvision.models as models
 
 def de_parallel(model):
@@ -19,7 +21,9 @@ def de_parallel(model):
 class GNTModel(object):
     def __init__(self, args, load_opt=True, load_scheduler=True):
         self.args = args
-        device = torch.device("cuda:{}".format(args.local_rank))
+        device = torch.device("cuda:{}".format(args.local_rank) if torch.cuda.is_available() else "cpu")
+        self.device = device
+        self.amp_dtype = amp_dtype(args.amp)
         # create coarse GNT
         self.net_coarse = GNT(
             args,
@@ -57,6 +61,9 @@ class GNTModel(object):
 
         self.sem_seg_head = NeRFSemSegFPNHead(args).to(device)
 
+        if args.channels_last:
+            to_channels_last(self.feature_net, self.sem_feature_net, self.feature_fpn, self.sem_seg_head)
+
         # optimizer and learning rate scheduler
         learnable_params = list(self.net_coarse.parameters())
         learnable_params += list(self.feature_net.parameters())
@@ -113,6 +120,9 @@ class GNTModel(object):
         self.scheduler = torch.optim.lr_scheduler.StepLR(
             self.optimizer, step_size=args.lrate_decay_steps, gamma=args.lrate_decay_factor
         )
+        self.scaler = make_grad_scaler(device, self.amp_dtype)
+        # background checkpoint writing with --async_ckpt, None saves synchronously
+        self.ckpt_writer = AsyncCheckpointWriter.from_args(args)
 
         out_folder = os.path.join(args.rootdir, "out", args.expname)
         self.start_step = self.load_from_ckpt(
@@ -146,6 +156,28 @@ class GNTModel(object):
                     self.sem_feature_net, device_ids=[args.local_rank], output_device=args.local_rank
                 )
 
+    def autocast(self):
+        """
+        mixed precision context for forward passes and losses, a no-op unless --amp is bf16|fp16
+        """
+        return autocast(self.device, self.amp_dtype)
+
+    def reference_fpn(self, deep_semantics):
+        """
+        FPN of the source view encoder outputs: all levels upsampled to the largest one and concatenated, or with
+        --native_fpn the tuple of levels at their own strides, which the projector samples level by level
+        """
+        return self.feature_fpn(deep_semantics, levels=self.args.native_fpn)
+
+    def backward_step(self, loss):
+        """
+        backward and optimizer step, through the grad scaler for fp16
+        """
+        self.optimizer.zero_grad()
+        self.scaler.scale(loss).backward()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+
     def switch_to_eval(self):
         self.net_coarse.eval()
         self.feature_net.eval()
@@ -166,30 +198,52 @@ class GNTModel(object):
         if self.sem_feature_net is not None:
             self.sem_feature_net.train()
 
+    def checkpoint_modules(self):
+        modules = {
+            "net_coarse": de_parallel(self.net_coarse),
+            "feature_net": de_parallel(self.feature_net),
+            "feature_fpn": de_parallel(self.feature_fpn),
+            "sem_seg_head": de_parallel(self.sem_seg_head),
+        }
+        if self.net_fine is not None:
+            modules["net_fine"] = de_parallel(self.net_fine)
+        if self.sem_feature_net is not None:
+            modules["sem_feature_net"] = de_parallel(self.sem_feature_net)
+        return modules
+
     def save_model(self, filename):
         to_save = {
             "optimizer": self.optimizer.state_dict(),
             "scheduler": self.scheduler.state_dict(),
-            "net_coarse": de_parallel(self.net_coarse).state_dict(),
-            "feature_net": de_parallel(self.feature_net).state_dict(),
-            "feature_fpn": de_parallel(self.feature_fpn).state_dict(),
-            "sem_seg_head": de_parallel(self.sem_seg_head).state_dict(),
         }
-
-        if self.net_fine is not None:
-            to_save["net_fine"] = de_parallel(self.net_fine).state_dict()
-        if self.sem_feature_net is not None:
-            to_save["sem_feature_net"] = de_parallel(self.sem_feature_net).state_dict()
-
+        if self.scaler.is_enabled():
+            to_save["scaler"] = self.scaler.state_dict()
+
+        if self.ckpt_writer is not None:
+            # returns once the state is copied to host memory, the file is written in the background
+            self.ckpt_writer.save(filename, to_save, self.checkpoint_modules())
+            return
+        for name, net in self.checkpoint_modules().items():
+            to_save[name] = contiguous_state_dict(net)
         torch.save(to_save, filename)
 
+    def wait_for_checkpoint(self):
+        """
+        blocks until the last checkpoint of --async_ckpt is on disk
+        """
+        if self.ckpt_writer is not None:
+            self.ckpt_writer.wait()
+
     def load_model(self, filename, load_opt=True, load_scheduler=True):
         if self.args.distributed:
-            to_load = torch.load(filename, map_location="cuda:{}".format(self.args.local_rank))
+            to_load = load_checkpoint(filename, map_location="cuda:{}".format(self.args.local_rank))
         else:
-            to_load = torch.load(filename)
+            to_load = load_checkpoint(filename, map_location=self.device)
         if load_opt:
             self.optimizer.load_state_dict(to_load["optimizer"])
+            # fp32 checkpoints have no scaler state, the scaler then starts from its initial scale
+            if self.scaler.is_enabled() and "scaler" in to_load.keys():
+                self.scaler.load_state_dict(to_load["scaler"])
         if load_scheduler:
             self.scheduler.load_state_dict(to_load["scheduler"])
 
@@ -0,0 +1,121 @@
+import math
+
+import torch
+
+
+########################################################################################################################
+# training pixel sampling
+########################################################################################################################
+
+
+class PixelSampler(object):
+    """
+    draws N_rand distinct pixels from every target view, on the device and in O(N_rand) (no permutation of all
+    H*W pixels). the random stream is seeded from (seed, rank), so runs are reproducible and ranks draw differently.
+    modes:
+        uniform     uniform over the image
+        center      uniform over the central center_ratio crop
+        stratified  one pixel in each of N_rand random cells of a grid of about N_rand cells
+        patch       square patch_size x patch_size patches of a randomly shifted patch grid
+        importance  proportional to per-pixel weights (e.g. an error map), uniform if none are given
+    """
+
+    MODES = ["uniform", "center", "stratified", "patch", "importance"]
+
+    def __init__(self, device, seed=234, rank=0, patch_size=8):
+        self.device = torch.device(device)
+        self.patch_size = patch_size
+        self.generator = torch.Generator(device=self.device)
+        # distinct, reproducible streams per rank
+        self.generator.manual_seed(seed * 1000003 + rank)
+
+    @classmethod
+    def from_args(cls, args, device):
+        return cls(device, seed=args.sampler_seed, rank=getattr(args, "rank", 0), patch_size=args.sample_patch_size)
+
+    def randint(self, high, size):
+        return torch.randint(high, size, generator=self.generator, device=self.device)
+
+    def choice(self, n, k):
+        """
+        k distinct integers of [0, n): rejection of duplicates, a permutation only if k is a large part of n
+        """
+        assert k <= n, "cannot draw {} distinct pixels from {}".format(k, n)
+        if 2 * k > n:
+            return torch.randperm(n, generator=self.generator, device=self.device)[:k]
+        inds = self.randint(n, (k + k // 4 + 16,)).unique()
+        while len(inds) < k:
+            inds = torch.cat([inds, self.randint(n, (k,))]).unique()
+        # unique() sorts, a random subset keeps the selection unbiased
+        return inds[torch.randperm(len(inds), generator=self.generator, device=self.device)[:k]]
+
+    def uniform(self, N_rand, H, W):
+        return self.choice(H * W, N_rand)
+
+    def center(self, N_rand, H, W, center_ratio):
+        border_H = int(H * (1 - center_ratio) / 2.0)
+        border_W = int(W * (1 - center_ratio) / 2.0)
+        h, w = H - 2 * border_H, W - 2 * border_W
+        inds = self.choice(h * w, N_rand)
+        return (inds // w + border_H) * W + inds % w + border_W
+
+    def stratified(self, N_rand, H, W):
+        # a grid of at least N_rand cells with about the aspect ratio of the image
+        gx = min(W, math.ceil(math.sqrt(N_rand * W / H)))
+        gy = min(H, math.ceil(N_rand / gx))
+        assert gx * gy >= N_rand, "cannot stratify {} pixels over a {}x{} image".format(N_rand, H, W)
+        cells = self.choice(gx * gy, N_rand)
+        cy, cx = cells // gx, cells % gx
+        # integer cell bounds, every cell holds at least one pixel
+        y0, y1 = cy * H // gy, (cy + 1) * H // gy
+        x0, x1 = cx * W // gx, (cx + 1) * W // gx
+        u = torch.rand(N_rand, 2, generator=self.generator, device=self.device)
+        y = y0 + (u[:, 0] * (y1 - y0)).long()
+        x = x0 + (u[:, 1] * (x1 - x0)).long()
+        return y * W + x
+
+    def patch(self, N_rand, H, W):
+        p = self.patch_size
+        # patches of a grid shifted by a random offset, so that the patch borders move between steps
+        oy, ox = (int(v) for v in self.randint(p, (2,)).tolist())
+        ny, nx = (H - oy) // p, (W - ox) // p
+        n_patches = math.ceil(N_rand / (p * p))
+        patches = self.choice(ny * nx, n_patches)
+        dy, dx = torch.meshgrid(
+            torch.arange(p, device=self.device), torch.arange(p, device=self.device), indexing="ij"
+        )
+        y = (oy + patches // nx * p).unsqueeze(-1) + dy.flatten()
+        x = (ox + patches % nx * p).unsqueeze(-1) + dx.flatten()
+        return (y * W + x).flatten()[:N_rand]
+
+    def importance(self, N_rand, H, W, weights):
+        """
+        :param weights: [H*W] non-negative sampling weights of the pixels
+        """
+        if weights is None:
+            return self.uniform(N_rand, H, W)
+        weights = weights.to(self.device, torch.float32).flatten()
+        if int((weights > 0).sum()) < N_rand:
+            # not enough pixels with weight, the rest is uniform
+            weights = weights + weights.sum() / len(weights) + 1e-8
+        inds = torch.multinomial(weights, N_rand + N_rand // 4, replacement=True, generator=self.generator).unique()
+        while len(inds) < N_rand:
+            more = torch.multinomial(weights, N_rand, replacement=True, generator=self.generator)
+            inds = torch.cat([inds, more]).unique()
+        return inds[torch.randperm(len(inds), generator=self.generator, device=self.device)[:N_rand]]
+
+    def sample(self, N_rand, H, W, sample_mode, center_ratio=0.8, weights=None):
+        """
+        :return: [N_rand] distinct indices into the H*W pixels of one view, long tensor on the device
+        """
+        if sample_mode == "uniform":
+            return self.uniform(N_rand, H, W)
+        elif sample_mode == "center":
+            return self.center(N_rand, H, W, center_ratio)
+        elif sample_mode == "stratified":
+            return self.stratified(N_rand, H, W)
+        elif sample_mode == "patch":
+            return self.patch(N_rand, H, W)
+        elif sample_mode == "importance":
+            return self.importance(N_rand, H, W, weights)
+        raise Exception("unknown sample mode {}, expected one of {}".format(sample_mode, self.MODES))
@@ -21,119 +21,225 @@ class Projector:
             & (pixel_locations[..., 1] >= 0)
         )
 
-    def normalize(self, pixel_locations, h, w):
-        resize_factor = torch.tensor([w - 1.0, h - 1.0]).to(pixel_locations.device)[None, None, :]
+    def normalize(self, pixel_locations, h, w, resize_factor=None):
+        if resize_factor is None:
+            resize_factor = torch.tensor([w - 1.0, h - 1.0]).to(pixel_locations.device)
         normalized_pixel_locations = (
-            2 * pixel_locations / resize_factor - 1.0
+            2 * pixel_locations / resize_factor[None, None, :] - 1.0
         )  # [n_views, n_points, 2]
         return normalized_pixel_locations
 
-    def compute_projections(self, xyz, train_cameras):
+    def prepare(self, query_camera, train_cameras):
+        """
+        precompute everything that only depends on the cameras, so that it can be shared by all
+        chunks of rays rendered against the same query and reference views
+        :param query_camera: [batch, 34], 34 = img_size(2) + intrinsics(16) + extrinsics(16)
+        :param train_cameras: [batch, n_views, 34], every target view has its own source views
+        :return: projection context {'proj_mats': [batch, n_views, 3, 4], 'train_centers': [batch, n_views, 3],
+                 'query_center': [batch, 3], 'h', 'w', 'resize_factor': [2, ]}
+        """
+        assert train_cameras.shape[0] == query_camera.shape[0]
+        batch, num_views = train_cameras.shape[:2]
+
+        train_intrinsics = train_cameras[..., 2:18].reshape(batch, num_views, 4, 4)
+        train_poses = train_cameras[..., -16:].reshape(batch, num_views, 4, 4)
+        query_poses = query_camera[:, -16:].reshape(batch, 4, 4)
+
+        # all images of a batch share the same size
+        h, w = train_cameras[0, 0][:2]
+        proj_mats = train_intrinsics.matmul(torch.inverse(train_poses))[:, :, :3]  # [batch, n_views, 3, 4]
+        return {
+            "proj_mats": proj_mats,
+            "train_centers": train_poses[:, :, :3, 3],
+            "query_center": query_poses[:, :3, 3],
+            "h": h,
+            "w": w,
+            "resize_factor": torch.stack([w - 1.0, h - 1.0]),
+        }
+
+    def stack_reference(self, featmaps, deep_semantics, size=None):
+        """
+        resample the coarse feature maps and deep semantic maps to a common resolution and concatenate them along
+        channels, so that compute() samples both with a single grid_sample. the reference rgb is not stacked, it
+        keeps its own grid_sample at image resolution so that the rgb inputs of the network are unchanged
+        :param featmaps: [batch*n_views, d, h', w']
+        :param deep_semantics: [batch*n_views, d_sem, h'', w''], encoder's output, or a tuple of FPN levels at
+                               their native strides, of which only the first (largest) one is stacked
+        :param size: (h, w) of the stacked maps, defaults to the resolution of deep_semantics so that the
+                     widest map is not resampled
+        :return: {'stack': [batch*n_views, d+d_sem, h, w], 'splits': [d, d_sem], 'levels': remaining FPN levels}
+        """
+        levels = ()
+        if isinstance(deep_semantics, (tuple, list)):
+            deep_semantics, levels = deep_semantics[0], tuple(deep_semantics[1:])
+        size = tuple(deep_semantics.shape[-2:]) if size is None else tuple(size)
+
+        maps = []
+        for x in [featmaps, deep_semantics]:
+            if tuple(x.shape[-2:]) != size:
+                # align_corners=True keeps the map nodes where grid_sample(align_corners=True) expects them
+                x = F.interpolate(x, size=size, mode="bilinear", align_corners=True)
+            maps.append(x)
+        return {
+            "stack": torch.cat(maps, dim=1),
+            "splits": [featmaps.shape[1], deep_semantics.shape[1]],
+            "levels": levels,
+        }
+
+    def sample_maps(self, maps, normalized_pixel_locations):
+        """
+        :param maps: [batch*n_views, c, h, w], or a tuple of such maps at different resolutions (FPN levels)
+        :param normalized_pixel_locations: [batch*n_views, n_rays, n_samples, 2]
+        :return: [batch*n_views, c, n_rays, n_samples], the sampled levels concatenated along channels
+        """
+        if not isinstance(maps, (tuple, list)):
+            return F.grid_sample(maps, normalized_pixel_locations, align_corners=True)
+        # align_corners=True normalized coordinates address the same image point at every resolution, so a level is
+        # sampled directly instead of being upsampled to the largest level first (same bilinear interpolant of the
+        # level, without the second interpolation of the upsampled map)
+        return torch.cat([F.grid_sample(x, normalized_pixel_locations, align_corners=True) for x in maps], dim=1)
+
+    def compute_projections(self, xyz, train_cameras, proj_ctx=None):
         """
         project 3D points into cameras
-        :param xyz: [..., 3]
+        :param xyz: [batch*n_rays, n_samples, 3], rays grouped by target view
         :param train_cameras: [n_views, 34], 34 = img_size(2) + intrinsics(16) + extrinsics(16)
-        :return: pixel locations [..., 2], mask [...]
+        :param proj_ctx: optional projection context from prepare(), train_cameras is ignored if given
+        :return: pixel locations [batch*n_views, n_rays, n_samples, 2], mask [batch*n_views, n_rays, n_samples]
         """
-        original_shape = xyz.shape[:2]
-        xyz = xyz.reshape(-1, 3)
-        num_views = len(train_cameras)
-        train_intrinsics = train_cameras[:, 2:18].reshape(-1, 4, 4)  # [n_views, 4, 4]
-        train_poses = train_cameras[:, -16:].reshape(-1, 4, 4)  # [n_views, 4, 4]
-        xyz_h = torch.cat([xyz, torch.ones_like(xyz[..., :1])], dim=-1)  # [n_points, 4]
-        projections = train_intrinsics.bmm(torch.inverse(train_poses)).bmm(
-            xyz_h.t()[None, ...].repeat(num_views, 1, 1)
-        )  # [n_views, 4, n_points]
-        projections = projections.permute(0, 2, 1)  # [n_views, n_points, 4]
+        if proj_ctx is None:
+            train_intrinsics = train_cameras[:, 2:18].reshape(-1, 4, 4)  # [n_views, 4, 4]
+            train_poses = train_cameras[:, -16:].reshape(-1, 4, 4)  # [n_views, 4, 4]
+            proj_mats = train_intrinsics.bmm(torch.inverse(train_poses))[None, :, :3]  # [1, n_views, 3, 4]
+        else:
+            proj_mats = proj_ctx["proj_mats"]
+        batch, num_views = proj_mats.shape[:2]
+        original_shape = (xyz.shape[0] // batch, xyz.shape[1])
+        xyz = xyz.reshape(batch, -1, 3)
+        # broadcast the points against every view instead of copying them once per view
+        projections = (
+            torch.einsum("bvij,bnj->bvni", proj_mats[..., :3], xyz) + proj_mats[:, :, None, :, 3]
+        )  # [batch, n_views, n_points, 3]
         pixel_locations = projections[..., :2] / torch.clamp(
             projections[..., 2:3], min=1e-8
-        )  # [n_views, n_points, 2]
+        )  # [batch, n_views, n_points, 2]
         pixel_locations = torch.clamp(pixel_locations, min=-1e6, max=1e6)
         mask = projections[..., 2] > 0  # a point is invalid if behind the camera
-        return pixel_locations.reshape((num_views,) + original_shape + (2,)), mask.reshape(
-            (num_views,) + original_shape
+        return pixel_locations.reshape((batch * num_views,) + original_shape + (2,)), mask.reshape(
+            (batch * num_views,) + original_shape
         )
 
-    def compute_angle(self, xyz, query_camera, train_cameras):
+    def compute_angle(self, xyz, query_camera, train_cameras, proj_ctx=None):
         """
-        :param xyz: [..., 3]
+        :param xyz: [batch*n_rays, n_samples, 3], rays grouped by target view
         :param query_camera: [34, ]
         :param train_cameras: [n_views, 34]
-        :return: [n_views, ..., 4]; The first 3 channels are unit-length vector of the difference between
-        query and target ray directions, the last channel is the inner product of the two directions.
+        :param proj_ctx: optional projection context from prepare(), the cameras are ignored if given
+        :return: [batch*n_views, n_rays, n_samples, 4]; The first 3 channels are unit-length vector of the
+        difference between query and target ray directions, the last channel is the inner product of the two directions.
         """
-        original_shape = xyz.shape[:2]
-        xyz = xyz.reshape(-1, 3)
-        train_poses = train_cameras[:, -16:].reshape(-1, 4, 4)  # [n_views, 4, 4]
-        num_views = len(train_poses)
-        query_pose = (
-            query_camera[-16:].reshape(-1, 4, 4).repeat(num_views, 1, 1)
-        )  # [n_views, 4, 4]
-        ray2tar_pose = query_pose[:, :3, 3].unsqueeze(1) - xyz.unsqueeze(0)
-        ray2tar_pose /= torch.norm(ray2tar_pose, dim=-1, keepdim=True) + 1e-6
-        ray2train_pose = train_poses[:, :3, 3].unsqueeze(1) - xyz.unsqueeze(0)
-        ray2train_pose /= torch.norm(ray2train_pose, dim=-1, keepdim=True) + 1e-6
+        if proj_ctx is None:
+            train_centers = train_cameras[:, -16:].reshape(-1, 4, 4)[None, :, :3, 3]  # [1, n_views, 3]
+            query_center = query_camera[-16:].reshape(4, 4)[None, :3, 3]  # [1, 3]
+        else:
+            train_centers = proj_ctx["train_centers"]
+            query_center = proj_ctx["query_center"]
+        batch, num_views = train_centers.shape[:2]
+        original_shape = (xyz.shape[0] // batch, xyz.shape[1])
+        xyz = xyz.reshape(batch, 1, -1, 3)
+        # the query direction is the same for every view, compute it once and broadcast
+        ray2tar_pose = query_center[:, None, None, :] - xyz  # [batch, 1, n_points, 3]
+        ray2tar_pose = ray2tar_pose / (torch.norm(ray2tar_pose, dim=-1, keepdim=True) + 1e-6)
+        ray2train_pose = train_centers.unsqueeze(2) - xyz  # [batch, n_views, n_points, 3]
+        ray2train_pose = ray2train_pose / (torch.norm(ray2train_pose, dim=-1, keepdim=True) + 1e-6)
         ray_diff = ray2tar_pose - ray2train_pose
         ray_diff_norm = torch.norm(ray_diff, dim=-1, keepdim=True)
         ray_diff_dot = torch.sum(ray2tar_pose * ray2train_pose, dim=-1, keepdim=True)
         ray_diff_direction = ray_diff / torch.clamp(ray_diff_norm, min=1e-6)
         ray_diff = torch.cat([ray_diff_direction, ray_diff_dot], dim=-1)
-        ray_diff = ray_diff.reshape((num_views,) + original_shape + (4,))
+        ray_diff = ray_diff.reshape((batch * num_views,) + original_shape + (4,))
         return ray_diff
 
-    def compute(self, xyz, query_camera, train_imgs, train_cameras, featmaps, deep_semantics):
+    def compute(
+        self,
+        xyz,
+        query_camera,
+        train_imgs,
+        train_cameras,
+        featmaps,
+        deep_semantics,
+        proj_ctx=None,
+        ref_stack=None,
+    ):
         """
-        :param xyz: [n_rays, n_samples, 3]
-        :param query_camera: [1, 34], 34 = img_size(2) + intrinsics(16) + extrinsics(16)
-        :param train_imgs: [1, n_views, h, w, 3]
-        :param train_cameras: [1, n_views, 34]
-        :param featmaps: [n_views, d, h, w]
-        :param deep_semantics: [n_views, d, h, w], encoder's output
-        :return: rgb_feat_sampled: [n_rays, n_samples, 3+n_feat],
-                 ray_diff: [n_rays, n_samples, 4],
-           
-                       mask: [n_rays, n_samples, 1]
+        :param xyz: [batch*n_rays, n_samples, 3], the n_rays rays of each target view are contiguous
+        :param query_camera: [batch, 34], 34 = img_size(2) + intrinsics(16) + extrinsics(16)
+        :param train_imgs: [batch, n_views, h, w, 3]
+        :param train_cameras: [batch, n_views, 34]
+        :param featmaps: [batch*n_views, d, h, w]
+        :param deep_semantics: [batch*n_views, d, h, w], encoder's output, or a tuple of FPN levels (--native_fpn)
+        :param proj_ctx: projection context from prepare(), built here if not given
+        :param ref_stack: optional output of stack_reference(), replaces featmaps and deep_semantics
+        :return: rgb_feat_sampled: [batch*n_rays, n_samples, n_views, 3+n_feat],
+                 ray_diff: [batch*n_rays, n_samples, n_views, 4],
+                 mask: [batch*n_rays, n_samples, n_views, 1]
         """
         assert (
-            (train_imgs.shape[0] == 1)
-            and (train_cameras.shape[0] == 1)
-            and (query_camera.shape[0] == 1)
-        ), "only support batch_size=1 for now"
+            (train_imgs.shape[0] == train_cameras.shape[0])
+            and (query_camera.shape[0] == train_cameras.shape[0])
+        ), "every target view needs its own source views"
+        batch, num_views = train_cameras.shape[:2]
 
-        train_imgs = train_imgs.squeeze(0)  # [n_views, h, w, 3]
-        train_cameras = train_cameras.squeeze(0)  # [n_views, 34]
-        query_camera = query_camera.squeeze(0)  # [34, ]
+        if proj_ctx is None:
+            proj_ctx = self.prepare(query_camera, train_cameras)
 
-        train_imgs = train_imgs.permute(0, 3, 1, 2)  # [n_views, 3, h, w]
+        train_imgs = train_imgs.flatten(0, 1).permute(0, 3, 1, 2)  # [batch*n_views, 3, h, w]
 
-        h, w = train_cameras[0][:2]
+        h, w = proj_ctx["h"], proj_ctx["w"]
 
         # compute the projection of the query points to each reference image
-        pixel_locations, mask_in_front = self.compute_projections(xyz, train_cameras)
+        pixel_locations, mask_in_front = self.compute_projections(xyz, train_cameras, proj_ctx)
         normalized_pixel_locations = self.normalize(
-            pixel_locations, h, w
+            pixel_locations, h, w, proj_ctx["resize_factor"]
         )  # [n_views, n_rays, n_samples, 2]
 
-        # rgb sampling
+        def to_rays(x):
+            # [batch*n_views, c, n_rays, n_samples] -> [batch*n_rays, n_samples, n_views, c]
+            x = x.reshape((batch, num_views) + x.shape[1:]).permute(0, 3, 4, 1, 2)
+            return x.reshape((-1,) + x.shape[2:])
+
+        # rgb sampling, at image resolution in both paths
         rgbs_sampled = F.grid_sample(train_imgs, normalized_pixel_locations, align_corners=True)
-        rgb_sampled = rgbs_sampled.permute(2, 3, 0, 1)  # [n_rays, n_samples, n_views, 3]
+        rgb_sampled = to_rays(rgbs_sampled)  # [n_rays, n_samples, n_views, 3]
 
-        # deep feature sampling
-        feat_sampled = F.grid_sample(featmaps, normalized_pixel_locations, align_corners=True)
-        feat_sampled = feat_sampled.permute(2, 3, 0, 1)  # [n_rays, n_samples, n_views, d]
-        rgb_feat_sampled = torch.cat(
-            [rgb_sampled, feat_sampled], dim=-1
-        )  # [n_rays, n_samples, n_views, d+3]
+        if ref_stack is not None:
+            # fused deep feature and deep semantic sampling, split with views instead of copies
+            stack_sampled = F.grid_sample(
+                ref_stack["stack"], normalized_pixel_locations, align_corners=True
+            )
+            stack_sampled = to_rays(stack_sampled)  # [n_rays, n_samples, n_views, d+d_sem]
+            feat_sampled, deep_sem_sampled = torch.split(stack_sampled, ref_stack["splits"], dim=-1)
+            rgb_feat_sampled = torch.cat([rgb_sampled, feat_sampled], dim=-1)  # [n_rays, n_samples, n_views, d+3]
+            if len(ref_stack.get("levels", ())) > 0:
+                levels_sampled = to_rays(self.sample_maps(ref_stack["levels"], normalized_pixel_locations))
+                deep_sem_sampled = torch.cat([deep_sem_sampled, levels_sampled], dim=-1)
+        else:
+            # deep feature sampling
+            feat_sampled = F.grid_sample(featmaps, normalized_pixel_locations, align_corners=True)
+            feat_sampled = to_rays(feat_sampled)  # [n_rays, n_samples, n_views, d]
+            rgb_feat_sampled = torch.cat(
+                [rgb_sampled, feat_sampled], dim=-1
+            )  # [n_rays, n_samples, n_views, d+3]
 
-        # deep semantic feature sampling
-        deep_sem_sampled = F.grid_sample(deep_semantics, normalized_pixel_locations, align_corners=True)
-        deep_sem_sampled = deep_sem_sampled.permute(2, 3, 0, 1)  # [n_rays, n_samples, n_views, d]
+            # deep semantic feature sampling
+            deep_sem_sampled = self.sample_maps(deep_semantics, normalized_pixel_locations)
+            deep_sem_sampled = to_rays(deep_sem_sampled)  # [n_rays, n_samples, n_views, d]
 
         # mask
         inbound = self.inbound(pixel_locations, h, w)
-        ray_diff = self.compute_angle(xyz, query_camera, train_cameras)
-        ray_diff = ray_diff.permute(1, 2, 0, 3)
-        mask = (
-            (inbound * mask_in_front).float().permute(1, 2, 0)[..., None]
+        ray_diff = self.compute_angle(xyz, query_camera, train_cameras, proj_ctx)
+        ray_diff = to_rays(ray_diff.permute(0, 3, 1, 2))
+        mask = to_rays(
+            (inbound * mask_in_front).float()[:, None]
         )  # [n_rays, n_samples, n_views, 1]
         return rgb_feat_sampled, deep_sem_sampled, ray_diff, mask
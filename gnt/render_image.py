@@ -3,6 +3,88 @@ from collections import OrderedDict
 from gnt.render_ray import render_rays
 
 
+class ChunkSizer(object):
+    """
+    picks the number of rays rendered per chunk from a memory budget and adapts it while rendering:
+    the first size comes from an estimate of the per-ray memory of the largest pass, then the per-ray memory
+    measured on CUDA replaces the estimate (grows into headroom), and an out-of-memory error halves the chunk.
+    the state is kept across images, so one instance should be shared by all renders of a run
+    """
+
+    def __init__(
+        self,
+        budget_mb,
+        N_samples,
+        N_importance,
+        num_source_views,
+        feat_dim,
+        sem_dim,
+        netwidth,
+        min_chunk=64,
+        max_chunk=1 << 16,
+    ):
+        self.budget = budget_mb * 2**20
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        # fp32 activations of the largest pass, per ray: projected rgb/features, deep semantics and ray_diff/mask
+        # of every sample and view, the view transformer k/v/pos/attn with the attn_fc hidden layer and the
+        # weighted deep semantics, plus the [samples, samples] ray attention of 4 heads
+        n_samples = N_samples + N_importance
+        per_sample_view = (feat_dim + 3) + 2 * sem_dim + 5 + 5 * netwidth + netwidth // 8
+        self.bytes_per_ray = 4 * n_samples * (num_source_views * per_sample_view + 4 * n_samples)
+        self.chunk_size = self.clamp(self.budget / self.bytes_per_ray)
+        self.n_oom = 0
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            args.chunk_mem_mb,
+            args.N_samples,
+            args.N_importance,
+            args.num_source_views,
+            args.coarse_feat_dim,
+            args.netwidth * 8,
+            args.netwidth,
+        )
+
+    def clamp(self, chunk_size):
+        return int(min(max(chunk_size, self.min_chunk), self.max_chunk))
+
+    def on_oom(self):
+        if self.chunk_size <= self.min_chunk:
+            return False
+        self.n_oom += 1
+        self.chunk_size = self.clamp(self.chunk_size // 2)
+        self.bytes_per_ray = max(self.bytes_per_ray, self.budget / self.chunk_size)
+        return True
+
+    def on_chunk(self, n_rays, peak_bytes):
+        """
+        :param n_rays: rays of the chunk just rendered
+        :param peak_bytes: its peak memory above what was allocated before it, None if unknown (cpu)
+        """
+        # the tail chunk of an image is dominated by fixed costs, do not learn from it
+        if peak_bytes is None or n_rays < self.chunk_size // 2:
+            return
+        self.bytes_per_ray = peak_bytes / n_rays
+        # grow at most 2x per chunk, the measured peak is only accurate near the measured size
+        self.chunk_size = self.clamp(min(self.budget / self.bytes_per_ray, 2 * self.chunk_size))
+
+    def __repr__(self):
+        return "ChunkSizer(chunk_size={}, bytes_per_ray={:.0f}, budget={:.0f}MB, n_oom={})".format(
+            self.chunk_size, self.bytes_per_ray, self.budget / 2**20, self.n_oom
+        )
+
+
+def make_chunk_sizer(args):
+    """
+    :return: a ChunkSizer with --chunk_mem_mb > 0, otherwise None and the fixed --chunk_size is used
+    """
+    if args.chunk_mem_mb > 0:
+        return ChunkSizer.from_args(args)
+    return None
+
+
 def render_single_image(
     ray_sampler,
     ray_batch,
@@ -19,6 +101,10 @@ def render_single_image(
     deep_semantics=None,
     ret_alpha=False,
     single_net=False,
+    ref_stack=None,
+    chunk_sizer=None,
+    occupancy=None,
+    pruner=None,
 ):
     """
     :param ray_sampler: RaySamplingSingleImage for this view
@@ -29,60 +115,90 @@ def render_single_image(
     :param N_importance: additional samples along each ray produced by importance sampling (for fine model)
     :param ret_alpha: if True, will return learned 'density' values inferred from the attention maps
     :param single_net: if True, will use single network, can be cued with both coarse and fine points
+    :param ref_stack: channel-stacked reference maps from projector.stack_reference(), enables fused sampling
+    :param chunk_sizer: ChunkSizer choosing and adapting the chunk size, chunk_size is ignored if given
+    :param occupancy: OccupancyProxy for empty-space skipping, see render_ray.render_rays
+    :param pruner: FineSamplePruner for early ray termination in the fine pass, see render_ray.render_rays
     :return: {'outputs_coarse': {'rgb': numpy, 'depth': numpy, ...}, 'outputs_fine': {}}
     """
 
     all_ret = OrderedDict([("outputs_coarse", OrderedDict()), ("outputs_fine", OrderedDict())])
 
     N_rays = ray_batch["ray_o"].shape[0]
+    device = ray_batch["ray_o"].device
+    # the cameras are the same for every chunk, prepare the projections once per image
+    proj_ctx = projector.prepare(ray_batch["camera"], ray_batch["src_cameras"])
 
-    for i in range(0, N_rays, chunk_size):
+    i = 0
+    while i < N_rays:
+        n = chunk_sizer.chunk_size if chunk_sizer is not None else chunk_size
         chunk = OrderedDict()
         for k in ray_batch:
-            if k in ["camera", "depth_range", "src_rgbs", "src_cameras", "labels", "src_labels"]:
+            if k in ["camera", "depth_range", "src_rgbs", "src_cameras", "labels", "src_labels", "src_depths"]:
                 chunk[k] = ray_batch[k]
             elif ray_batch[k] is not None:
-                chunk[k] = ray_batch[k][i : i + chunk_size]
+                chunk[k] = ray_batch[k][i : i + n]
             else:
                 chunk[k] = None
 
-        ret = render_rays(
-            chunk,
-            model,
-            featmaps,
-            ref_deep_semantics = deep_semantics, # reference encoder的语义输出
-            projector=projector,
-            N_samples=N_samples,
-            inv_uniform=inv_uniform,
-            N_importance=N_importance,
-            det=det,
-            white_bkgd=white_bkgd,
-            ret_alpha=ret_alpha,
-            single_net=single_net,
-        )
+        if chunk_sizer is not None and device.type == "cuda":
+            allocated = torch.cuda.memory_allocated(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        try:
+            ret = render_rays(
+                chunk,
+                model,
+                featmaps,
+                ref_deep_semantics = deep_semantics, # reference encoder的语义输出
+                projector=projector,
+                N_samples=N_samples,
+                inv_uniform=inv_uniform,
+                N_importance=N_importance,
+                det=det,
+                white_bkgd=white_bkgd,
+                ret_alpha=ret_alpha,
+                single_net=single_net,
+                proj_ctx=proj_ctx,
+                ref_stack=ref_stack,
+                occupancy=occupancy,
+                pruner=pruner,
+            )
+        except torch.cuda.OutOfMemoryError:
+            if chunk_sizer is None or not chunk_sizer.on_oom():
+                raise
+            # retry the same rays with a smaller chunk
+            torch.cuda.empty_cache()
+            continue
+        if chunk_sizer is not None:
+            peak = torch.cuda.max_memory_allocated(device) - allocated if device.type == "cuda" else None
+            chunk_sizer.on_chunk(len(chunk["ray_o"]), peak)
 
         # handle both coarse and fine outputs
-        # cache chunk results on cpu
+        # preallocate the outputs of the whole image on the cpu (pinned for cuda) once the shapes are known,
+        # chunk results are copied without blocking and synchronized once at the end
         if i == 0:
-            for k in ret["outputs_coarse"]:
-                if ret["outputs_coarse"][k] is not None:
-                    all_ret["outputs_coarse"][k] = []
+            for level in ["outputs_coarse", "outputs_fine"]:
+                if ret[level] is None:
+                    all_ret[level] = None
+                    continue
+                for k in ret[level]:
+                    if ret[level][k] is not None:
+                        all_ret[level][k] = torch.empty(
+                            (N_rays,) + tuple(ret[level][k].shape[1:]),
+                            dtype=ret[level][k].dtype,
+                            pin_memory=device.type == "cuda",
+                        )
 
-            if ret["outputs_fine"] is None:
-                all_ret["outputs_fine"] = None
-            else:
-                for k in ret["outputs_fine"]:
-                    if ret["outputs_fine"][k] is not None:
-                        all_ret["outputs_fine"][k] = []
-
-        for k in ret["outputs_coarse"]:
-            if ret["outputs_coarse"][k] is not None:
-                all_ret["outputs_coarse"][k].append(ret["outputs_coarse"][k].cpu())
+        for level in ["outputs_coarse", "outputs_fine"]:
+            if ret[level] is None:
+                continue
+            for k in ret[level]:
+                if ret[level][k] is not None:
+                    all_ret[level][k][i : i + n].copy_(ret[level][k].detach(), non_blocking=True)
+        i += n
 
-        if ret["outputs_fine"] is not None:
-            for k in ret["outputs_fine"]:
-                if ret["outputs_fine"][k] is not None:
-                    all_ret["outputs_fine"][k].append(ret["outputs_fine"][k].cpu())
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
 
     rgb_strided = torch.ones(ray_sampler.H, ray_sampler.W, 3)[::render_stride, ::render_stride, :]
     feat_strided = torch.ones(ray_sampler.H, ray_sampler.W, 3)[::render_stride, ::render_stride, :]
@@ -91,12 +207,12 @@ def render_single_image(
         if k == "random_sigma":
             continue
         elif k == "feats_out" and all_ret["outputs_coarse"][k] is not None:
-            feat_tmp = torch.cat(all_ret["outputs_coarse"][k], dim=0).reshape(
+            feat_tmp = all_ret["outputs_coarse"][k].reshape(
                 (feat_strided.shape[0], feat_strided.shape[1], 512, -1)   # 256是深层语义的维度
             )
             all_ret["outputs_coarse"][k] = feat_tmp.squeeze()      
         else:      
-            tmp = torch.cat(all_ret["outputs_coarse"][k], dim=0).reshape(
+            tmp = all_ret["outputs_coarse"][k].reshape(
                 (rgb_strided.shape[0], rgb_strided.shape[1], -1)
             )
             all_ret["outputs_coarse"][k] = tmp.squeeze()
@@ -108,12 +224,12 @@ def render_single_image(
             if k == "random_sigma":
                 continue
             elif k == "feats_out" and all_ret["outputs_fine"][k] is not None:
-                feat_tmp = torch.cat(all_ret["outputs_fine"][k], dim=0).reshape(
+                feat_tmp = all_ret["outputs_fine"][k].reshape(
                     (feat_strided.shape[0], feat_strided.shape[1], 512, -1)   # 256是深层语义的维度
                 )
                 all_ret["outputs_fine"][k] = feat_tmp.squeeze() 
             else:
-                tmp = torch.cat(all_ret["outputs_fine"][k], dim=0).reshape(
+                tmp = all_ret["outputs_fine"][k].reshape(
                     (rgb_strided.shape[0], rgb_strided.shape[1], -1)
                 )
                 all_ret["outputs_fine"][k] = tmp.squeeze()
@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 from collections import OrderedDict
 
 ########################################################################################################################
@@ -6,17 +7,19 @@ from collections import OrderedDict
 ########################################################################################################################
 
 
-def sample_pdf(bins, weights, N_samples, det=False):
+def sample_pdf(bins, weights, N_samples, det=False, stratified=False):
     """
     :param bins: tensor of shape [N_rays, M+1], M is the number of bins
     :param weights: tensor of shape [N_rays, M]
     :param N_samples: number of samples along each ray
     :param det: if True, will perform deterministic sampling
+    :param stratified: if True (and det is False), draw one jittered sample inside each of
+                       N_samples equal-width strata of [0, 1) instead of i.i.d. uniform samples
     :return: [N_rays, N_samples]
     """
 
-    M = weights.shape[1]
-    weights += 1e-5
+    N_rays, M = weights.shape
+    weights = weights + 1e-5
     # Get pdf
     pdf = weights / torch.sum(weights, dim=-1, keepdim=True)  # [N_rays, M]
     cdf = torch.cumsum(pdf, dim=-1)  # [N_rays, M]
@@ -24,25 +27,23 @@ def sample_pdf(bins, weights, N_samples, det=False):
 
     # Take uniform samples
     if det:
-        u = torch.linspace(0.0, 1.0, N_samples, device=bins.device)
-        u = u.unsqueeze(0).repeat(bins.shape[0], 1)  # [N_rays, N_samples]
+        u = torch.linspace(0.0, 1.0, N_samples, device=bins.device, dtype=cdf.dtype)
+        u = u.unsqueeze(0).expand(N_rays, N_samples).contiguous()  # [N_rays, N_samples]
+    elif stratified:
+        u = torch.arange(N_samples, device=bins.device, dtype=cdf.dtype)
+        u = (u.unsqueeze(0) + torch.rand(N_rays, N_samples, device=bins.device, dtype=cdf.dtype)) / N_samples
     else:
-        u = torch.rand(bins.shape[0], N_samples, device=bins.device)
+        u = torch.rand(N_rays, N_samples, device=bins.device, dtype=cdf.dtype)
 
     # Invert CDF
-    above_inds = torch.zeros_like(u, dtype=torch.long)  # [N_rays, N_samples]
-    for i in range(M):
-        above_inds += (u >= cdf[:, i : i + 1]).long()
-
-    # random sample inside each bin
+    # number of cdf[:, :M] entries <= u, identical to counting bin by bin since cdf is non-decreasing
+    above_inds = torch.searchsorted(cdf, u, right=True).clamp_(max=M)  # [N_rays, N_samples]
     below_inds = torch.clamp(above_inds - 1, min=0)
-    inds_g = torch.stack((below_inds, above_inds), dim=2)  # [N_rays, N_samples, 2]
-
-    cdf = cdf.unsqueeze(1).repeat(1, N_samples, 1)  # [N_rays, N_samples, M+1]
-    cdf_g = torch.gather(input=cdf, dim=-1, index=inds_g)  # [N_rays, N_samples, 2]
+    inds_g = torch.stack((below_inds, above_inds), dim=2).view(N_rays, 2 * N_samples)
 
-    bins = bins.unsqueeze(1).repeat(1, N_samples, 1)  # [N_rays, N_samples, M+1]
-    bins_g = torch.gather(input=bins, dim=-1, index=inds_g)  # [N_rays, N_samples, 2]
+    # gather directly from the [N_rays, M+1] tensors, no per-sample copies of cdf and bins
+    cdf_g = torch.gather(cdf, dim=-1, index=inds_g).view(N_rays, N_samples, 2)
+    bins_g = torch.gather(bins, dim=-1, index=inds_g).view(N_rays, N_samples, 2)
 
     # t = (u-cdf_g[:, :, 0]) / (cdf_g[:, :, 1] - cdf_g[:, :, 0] + TINY_NUMBER)  # [N_rays, N_samples]
     # fix numeric issue
@@ -59,20 +60,23 @@ def sample_along_camera_ray(ray_o, ray_d, depth_range, N_samples, inv_uniform=Fa
     """
     :param ray_o: origin of the ray in scene coordinate system; tensor of shape [N_rays, 3]
     :param ray_d: homogeneous ray direction vectors in scene coordinate system; tensor of shape [N_rays, 3]
-    :param depth_range: [near_depth, far_depth]
+    :param depth_range: [batch, 2], [near_depth, far_depth] of every target view, the rays of each
+                        target view are contiguous
     :param inv_uniform: if True, uniformly sampling inverse depth
     :param det: if True, will perform deterministic sampling
     :return: tensor of shape [N_rays, N_samples, 3]
     """
     # will sample inside [near_depth, far_depth]
     # assume the nearest possible depth is at least (min_ratio * depth)
-    near_depth_value = depth_range[0, 0]  # 相当于Semantic-Ray中的get_diff_feats函数
-    far_depth_value = depth_range[0, 1]
-    assert near_depth_value > 0 and far_depth_value > 0 and far_depth_value > near_depth_value
-
-    near_depth = near_depth_value * torch.ones_like(ray_d[..., 0])
+    near_depth_value = depth_range[:, 0:1]  # 相当于Semantic-Ray中的get_diff_feats函数
+    far_depth_value = depth_range[:, 1:2]
+    assert (
+        (near_depth_value > 0).all() and (far_depth_value > 0).all() and (far_depth_value > near_depth_value).all()
+    )
 
-    far_depth = far_depth_value * torch.ones_like(ray_d[..., 0])
+    rays_per_target = ray_d.shape[0] // depth_range.shape[0]
+    near_depth = near_depth_value.repeat_interleave(rays_per_target, dim=0)[:, 0].to(ray_d.dtype)
+    far_depth = far_depth_value.repeat_interleave(rays_per_target, dim=0)[:, 0].to(ray_d.dtype)
     if inv_uniform:
         start = 1.0 / near_depth  # [N_rays,]
         step = (1.0 / far_depth - start) / (N_samples - 1)
@@ -102,6 +106,167 @@ def sample_along_camera_ray(ray_o, ray_d, depth_range, N_samples, inv_uniform=Fa
     return pts, z_vals
 
 
+class OccupancyProxy(object):
+    """
+    empty-space skipping: a network-free pre-pass estimates which parts of every ray can hold surfaces, from
+    N_probe probe intervals between near and far, and the N_samples of the coarse pass are drawn inside them.
+    cues:
+        visibility  a probe is a candidate if it projects in front of and inside at least min_views source views
+        depth       with source depth maps ('src_depths' in the ray batch), a probe clearly in front of the observed
+                    surface of some view (by more than depth_tol of that depth) is empty (space carving), and so is
+                    a probe that is not within depth_tol of the surface in any view measuring it (occluded)
+    candidate intervals are dilated by one probe on each side, rays without any candidate keep uniform samples
+    """
+
+    def __init__(self, N_probe=128, min_views=2, depth_tol=0.05):
+        self.N_probe = N_probe
+        self.min_views = min_views
+        self.depth_tol = depth_tol
+        self.n_rays = 0
+        self.kept = 0.0
+
+    @classmethod
+    def from_args(cls, args):
+        if not args.skip_empty:
+            return None
+        return cls(args.occupancy_probes, args.occupancy_min_views, args.occupancy_depth_tol)
+
+    @torch.no_grad()
+    def __call__(self, ray_batch, projector, proj_ctx, inv_uniform=False):
+        """
+        :return: bins [N_rays, N_probe+1] (depths of the probe interval bounds), occupancy [N_rays, N_probe] in {0, 1}
+        """
+        bounds, bins = sample_along_camera_ray(
+            ray_batch["ray_o"], ray_batch["ray_d"], ray_batch["depth_range"], self.N_probe + 1,
+            inv_uniform=inv_uniform, det=True,
+        )
+        probes = 0.5 * (bounds[:, 1:] + bounds[:, :-1])  # [N_rays, N_probe, 3]
+        pixel_locations, in_front = projector.compute_projections(probes, None, proj_ctx)
+        visible = in_front & projector.inbound(pixel_locations, proj_ctx["h"], proj_ctx["w"])
+        batch, num_views = proj_ctx["proj_mats"].shape[:2]
+        # [batch*n_views, n_rays, N_probe] -> [batch*n_rays, N_probe]
+        occupied = visible.reshape(batch, num_views, -1, self.N_probe).sum(dim=1).flatten(0, 1) >= self.min_views
+
+        if ray_batch.get("src_depths") is not None:
+            src_depths = ray_batch["src_depths"].flatten(0, 1).unsqueeze(1).float()  # [batch*n_views, 1, h, w]
+            observed = F.grid_sample(
+                src_depths,
+                projector.normalize(pixel_locations, proj_ctx["h"], proj_ctx["w"], proj_ctx["resize_factor"]),
+                mode="nearest",
+                align_corners=True,
+            )[:, 0]  # [batch*n_views, n_rays, N_probe]
+            # depth of the probes in the source cameras, the last row of the projection matrices
+            proj_z = proj_ctx["proj_mats"][:, :, 2]  # [batch, n_views, 4]
+            z = torch.einsum("bvj,bnj->bvn", proj_z[..., :3], probes.reshape(batch, -1, 3)) + proj_z[..., 3:]
+            z = z.reshape(observed.shape)
+            measured = visible & (observed > 0)
+
+            def any_view(x):
+                return x.reshape(batch, num_views, -1, self.N_probe).any(dim=1).flatten(0, 1)
+
+            free = any_view(measured & (z < observed * (1 - self.depth_tol)))
+            near_surface = any_view(measured & ((z - observed).abs() <= observed * self.depth_tol))
+            # in front of the observed surface of a view, or behind the surfaces of all views measuring it: empty;
+            # probes no view measures keep the visibility cue
+            occupied = occupied & ~free & (near_surface | ~any_view(measured))
+
+        occupied = F.max_pool1d(occupied.float().unsqueeze(1), 3, stride=1, padding=1)[:, 0]
+        self.n_rays += occupied.shape[0]
+        self.kept += occupied.mean(dim=1).sum().item()
+        return bins, occupied
+
+    def sample(self, ray_batch, projector, proj_ctx, N_samples, inv_uniform=False, det=False):
+        """
+        N_samples depths per ray inside the candidate intervals, drop-in for sample_along_camera_ray
+        :return: pts [N_rays, N_samples, 3], z_vals [N_rays, N_samples]
+        """
+        bins, occupied = self(ray_batch, projector, proj_ctx, inv_uniform)
+        z_vals = sample_pdf(bins, occupied, N_samples, det=det, stratified=not det)
+        z_vals, _ = torch.sort(z_vals, dim=-1)
+        pts = z_vals.unsqueeze(2) * ray_batch["ray_d"].unsqueeze(1) + ray_batch["ray_o"].unsqueeze(1)
+        return pts, z_vals
+
+    def stats(self):
+        """
+        mean share of the depth range kept per ray, 1 - the share of samples moved out of empty space
+        """
+        return {"rays": self.n_rays, "kept_fraction": self.kept / max(self.n_rays, 1)}
+
+
+class FineSamplePruner(object):
+    """
+    early ray termination in the fine pass, inference only: behind the depth at which the coarse weights of a ray
+    have accumulated all but eps of their sum (plus one coarse sample of margin) the fine samples are dropped.
+    the kept samples of a ray are a prefix of its sorted z_vals; rays are bucketed by that prefix length rounded up
+    to a multiple of bucket, and the view and ray transformers run once per bucket on the packed prefixes.
+    the ray transformer attends over all samples of a ray, so the result is close to, not equal to, the full pass
+    """
+
+    def __init__(self, eps=1e-3, bucket=16):
+        self.eps = eps
+        self.bucket = bucket
+        self.n_samples = 0
+        self.n_processed = 0
+
+    @classmethod
+    def from_args(cls, args):
+        if not args.fine_prune or args.N_importance <= 0:
+            return None
+        return cls(args.fine_prune_eps, args.fine_prune_bucket)
+
+    def applies(self, ray_batch):
+        # rays are regrouped, which the projector supports for a single target view only
+        return not torch.is_grad_enabled() and ray_batch["camera"].shape[0] == 1
+
+    def lengths(self, weights, z_coarse, z_vals):
+        """
+        :param weights: [N_rays, N_samples] weights of the coarse pass
+        :param z_coarse: [N_rays, N_samples] depths of the coarse samples
+        :param z_vals: [N_rays, N_total] sorted depths of the fine samples
+        :return: [N_rays] number of fine samples kept per ray, a multiple of bucket or N_total
+        """
+        weights = weights.float()
+        cum = torch.cumsum(weights / weights.sum(dim=-1, keepdim=True).clamp_min(1e-10), dim=-1)
+        # first coarse sample with a negligible share of the weight behind it, and one more as margin
+        term = ((cum < 1 - self.eps).sum(dim=-1, keepdim=True) + 1).clamp(max=z_coarse.shape[1] - 1)
+        far = torch.gather(z_coarse, 1, term)
+        n_keep = (z_vals <= far).sum(dim=-1).clamp(min=1)
+        return ((n_keep + self.bucket - 1) // self.bucket * self.bucket).clamp(max=z_vals.shape[1])
+
+    @torch.no_grad()
+    def __call__(self, fine_pass, pts, z_vals, ray_d, weights, z_coarse):
+        """
+        :param fine_pass: fine_pass(pts, z_vals, ray_d) of render_rays on a subset of the rays
+        :return: outputs of fine_pass for all rays, weights zero behind the kept samples
+        """
+        N_rays, N_total = z_vals.shape
+        n_keep = self.lengths(weights, z_coarse, z_vals)
+        out = {}
+        for L in n_keep.unique().tolist():
+            rays = (n_keep == L).nonzero()[:, 0]
+            ret = fine_pass(pts[rays, :L], z_vals[rays, :L], ray_d[rays])
+            for k, v in ret.items():
+                if v is None:
+                    out[k] = None
+                    continue
+                if k not in out:
+                    shape = (N_rays, N_total) if k == "weights" else (N_rays,) + tuple(v.shape[1:])
+                    out[k] = v.new_zeros(shape)
+                if k == "weights":
+                    out[k][rays, :L] = v
+                else:
+                    out[k][rays] = v
+        self.n_samples += N_rays * N_total
+        self.n_processed += int(n_keep.sum())
+        return out
+
+    def stats(self):
+        return {
+            "samples": self.n_samples,
+            "culled_fraction": 1 - self.n_processed / max(self.n_samples, 1),
+        }
+
+
 ########################################################################################################################
 # ray rendering of nerf
 ########################################################################################################################
@@ -114,6 +279,8 @@ def raw2outputs(raw, z_vals, mask, white_bkgd=False):
     :param ray_d: [N_rays, 3]
     :return: {'rgb': [N_rays, 3], 'depth': [N_rays,], 'weights': [N_rays,], 'depth_std': [N_rays,]}
     """
+    # compositing (exp, cumprod) in fp32, raw may come out of the network in bf16/fp16 under autocast
+    raw = raw.float()
     rgb = raw[:, :, :3]  # [N_rays, N_samples, 3]
     sigma = raw[:, :, 3]  # [N_rays, N_samples]
 
@@ -206,6 +373,10 @@ def render_rays(
     single_net=True,
     save_feature=False,
     model_type = 'gnt',
+    proj_ctx=None,
+    ref_stack=None,
+    occupancy=None,
+    pruner=None,
 ):
     """
     :param ray_batch: {'ray_o': [N_rays, 3] , 'ray_d': [N_rays, 3], 'view_dir': [N_rays, 2]}
@@ -218,22 +389,31 @@ def render_rays(
     :param det: if True, will deterministicly sample depths
     :param ret_alpha: if True, will return learned 'density' values inferred from the attention maps
     :param single_net: if True, will use single network, can be cued with both coarse and fine points
+    :param proj_ctx: projection context from projector.prepare(), shared by coarse and fine passes
+    :param ref_stack: channel-stacked reference maps from projector.stack_reference(), enables fused sampling
+    :param occupancy: OccupancyProxy, places the coarse samples inside the non-empty parts of the rays if given
+    :param pruner: FineSamplePruner, drops the fine samples behind the surface found by the coarse pass (inference)
     :return: {'outputs_coarse': {}, 'outputs_fine': {}}
     """
 
     ret = {"outputs_coarse": None, "outputs_fine": None}
     ray_o, ray_d = ray_batch["ray_o"], ray_batch["ray_d"]
+    if proj_ctx is None:
+        proj_ctx = projector.prepare(ray_batch["camera"], ray_batch["src_cameras"])
 
     # pts: [N_rays, N_samples, 3]
     # z_vals: [N_rays, N_samples]
-    pts, z_vals = sample_along_camera_ray(
-        ray_o=ray_o,  # 值都是一样的
-        ray_d=ray_d,
-        depth_range=ray_batch["depth_range"],
-        N_samples=N_samples,
-        inv_uniform=inv_uniform,
-        det=det,
-    )
+    if occupancy is not None:
+        pts, z_vals = occupancy.sample(ray_batch, projector, proj_ctx, N_samples, inv_uniform=inv_uniform, det=det)
+    else:
+        pts, z_vals = sample_along_camera_ray(
+            ray_o=ray_o,  # 值都是一样的
+            ray_d=ray_d,
+            depth_range=ray_batch["depth_range"],
+            N_samples=N_samples,
+            inv_uniform=inv_uniform,
+            det=det,
+        )
 
     N_rays, N_samples = pts.shape[:2]
     rgb_feat, deep_sem_feat, ray_diff, mask = projector.compute(
@@ -243,6 +423,8 @@ def render_rays(
         ray_batch["src_cameras"],
         featmaps=featmaps,
         deep_semantics=ref_deep_semantics,
+        proj_ctx=proj_ctx,
+        ref_stack=ref_stack,
     )  # [N_rays, N_samples, N_views, x]
     # TODO: include pixel mask in ray transformer
     
@@ -268,33 +450,41 @@ def render_rays(
     if N_importance > 0:
         # detach since we would like to decouple the coarse and fine networks
         weights = ret["outputs_coarse"]["weights"].clone().detach()  # [N_rays, N_samples]
+        z_coarse = z_vals
         pts, z_vals = sample_fine_pts(
             inv_uniform, N_importance, det, N_samples, ray_batch, weights, z_vals
         )
 
-        rgb_feat_sampled, deep_sem_feat_sampled, ray_diff, mask = projector.compute(
-            pts,
-            ray_batch["camera"],
-            ray_batch["src_rgbs"],
-            ray_batch["src_cameras"],
-            featmaps=featmaps,
-            deep_semantics=ref_deep_semantics,
-        )
+        def fine_pass(pts, z_vals, ray_d):
+            rgb_feat_sampled, deep_sem_feat_sampled, ray_diff, mask = projector.compute(
+                pts,
+                ray_batch["camera"],
+                ray_batch["src_rgbs"],
+                ray_batch["src_cameras"],
+                featmaps=featmaps,
+                deep_semantics=ref_deep_semantics,
+                proj_ctx=proj_ctx,
+                ref_stack=ref_stack,
+            )
+
+            # TODO: Include pixel mask in ray transformer
+            # pixel_mask = (
+            #     mask[..., 0].sum(dim=2) > 1
+            # )  # [N_rays, N_samples]. should at least have 2 observations
+
+            if single_net:
+                out = model.net_coarse(rgb_feat_sampled, deep_sem_feat_sampled, ray_diff, mask, pts, ray_d)
+            else:
+                out = model.net_fine(rgb_feat_sampled, ray_diff, mask, pts, ray_d)
+            rgb_out, feats_out, _ = out
 
-        # TODO: Include pixel mask in ray transformer
-        # pixel_mask = (
-        #     mask[..., 0].sum(dim=2) > 1
-        # )  # [N_rays, N_samples]. should at least have 2 observations
+            rgb_out, weights = rgb_out[:, 0:3], rgb_out[:, 3:]
+            depth_map = torch.sum(weights * z_vals, dim=-1)
+            return {"rgb": rgb_out, "weights": weights, "depth": depth_map, "feats_out": feats_out}
 
-        if single_net:
-            out = model.net_coarse(rgb_feat_sampled, deep_sem_feat_sampled, ray_diff, mask, pts, ray_d)
+        if pruner is not None and pruner.applies(ray_batch):
+            ret["outputs_fine"] = pruner(fine_pass, pts, z_vals, ray_d, weights, z_coarse)
         else:
-            out = model.net_fine(rgb_feat_sampled, ray_diff, mask, pts, ray_d)
-        rgb_out, feats_out, _ = out
-
-        rgb_out, weights = rgb_out[:, 0:3], rgb_out[:, 3:]
-        depth_map = torch.sum(weights * z_vals, dim=-1)
-        ret["outputs_fine"] = {
-            "rgb": rgb_out, "weights": weights, "depth": depth_map, "feats_out": feats_out}
+            ret["outputs_fine"] = fine_pass(pts, z_vals, ray_d)
 
     return ret
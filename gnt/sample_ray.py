@@ -1,9 +1,11 @@
+from collections import OrderedDict
+
 import numpy as np
 import torch
 import torch.nn.functional as F
 
+from .pixel_sampler import PixelSampler
 
-rng = np.random.RandomState(234)
 
 ########################################################################################################################
 # ray batch sampling
@@ -25,6 +27,83 @@ def parse_camera_ray(params):
     return W, H, intrinsics, c2w
 
 
+def image_to_float(img, device=None):
+    """
+    uint8 frames (from the shared frame pool) are moved to the device as uint8 and converted there,
+    float images are only moved
+    """
+    if device is not None:
+        img = img.to(device, non_blocking=True)
+    if img.dtype == torch.uint8:
+        img = img.float().div_(255.0)
+    return img
+
+
+class PixelDirectionCache(object):
+    """
+    camera-space ray directions K^-1 [u, v, 1] of the pixel grid, keyed by (H, W, K, render_stride, device).
+    the frames of a dataset share a few intrinsics, so every grid (and inverse of K) is built once and reused,
+    the least recently used entries are dropped beyond max_entries
+    """
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def lookup(self, key, build):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        else:
+            self.entries[key] = build()
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return self.entries[key]
+
+    @staticmethod
+    def intrinsics_key(K):
+        return tuple(K[:3, :3].detach().cpu().flatten().tolist())
+
+    def inverse(self, K, device):
+        """
+        :param K: intrinsics of one camera, 3x3 or 4x4
+        :return: K^-1, 3x3 on the device
+        """
+        key = ("inverse", self.intrinsics_key(K), str(device))
+        return self.lookup(key, lambda: torch.inverse(K[:3, :3].float()).to(device))
+
+    def grid(self, H, W, K, render_stride, device):
+        """
+        :return: [ceil(H / render_stride) * ceil(W / render_stride), 3] directions of the (strided) pixel grid
+        """
+
+        def build():
+            v, u = torch.meshgrid(
+                torch.arange(0, H, render_stride, dtype=torch.float32, device=device),
+                torch.arange(0, W, render_stride, dtype=torch.float32, device=device),
+                indexing="ij",
+            )
+            pixels = torch.stack((u, v, torch.ones_like(u)), dim=-1).reshape(-1, 3)
+            return pixels @ self.inverse(K, device).T
+
+        key = ("grid", H, W, self.intrinsics_key(K), render_stride, str(device))
+        return self.lookup(key, build)
+
+
+pixel_directions = PixelDirectionCache()
+
+default_pixel_samplers = {}
+
+
+def default_pixel_sampler(device):
+    """
+    sampler of the callers that do not pass their own, one per device
+    """
+    device = str(device)
+    if device not in default_pixel_samplers:
+        default_pixel_samplers[device] = PixelSampler(device)
+    return default_pixel_samplers[device]
+
+
 def dilate_img(img, kernel_size=20):
     import cv2
 
@@ -38,7 +117,8 @@ class RaySamplerSingleImage(object):
     def __init__(self, data, device, resize_factor=1, render_stride=1):
         super().__init__()
         self.render_stride = render_stride
-        self.rgb = data["rgb"] if "rgb" in data.keys() else None
+        # the target image is the ground truth of the evaluation and stays on the cpu
+        self.rgb = image_to_float(data["rgb"]) if "rgb" in data.keys() else None
         self.labels = data["labels"] if "labels" in data.keys() else None
         self.camera = data["camera"]
         self.rgb_path = data["rgb_path"]
@@ -67,9 +147,8 @@ class RaySamplerSingleImage(object):
                     self.labels.permute(0, 3, 1, 2), scale_factor=resize_factor
                 ).permute(0, 2, 3, 1)
 
-        self.rays_o, self.rays_d = self.get_rays_single_image(
-            self.H, self.W, self.intrinsics, self.c2w_mat
-        )
+        # rays of the full image are generated on first use, random_sample only generates the selected ones
+        self.full_rays = None
         if self.rgb is not None:
             self.rgb = self.rgb.reshape(-1, 3)
         if self.labels is not None:
@@ -77,6 +156,8 @@ class RaySamplerSingleImage(object):
 
         if "src_rgbs" in data.keys():
             self.src_rgbs = data["src_rgbs"]
+            if self.src_rgbs.dtype == torch.uint8:
+                self.src_rgbs = image_to_float(self.src_rgbs, device)
         else:
             self.src_rgbs = None
         if "src_cameras" in data.keys():
@@ -87,6 +168,27 @@ class RaySamplerSingleImage(object):
             self.src_labels = data["src_labels"]
         else:
             self.src_labels = None
+        # source depth maps of the empty-space skipping, if the dataset loads them
+        self.src_depths = data["src_depths"] if "src_depths" in data.keys() else None
+        if "src_rgb_paths" in data.keys():
+            # collated into one tuple per source view, holding the path for each batch element
+            self.src_rgb_paths = [
+                p[0] if isinstance(p, (list, tuple)) else p for p in data["src_rgb_paths"]
+            ]
+        else:
+            self.src_rgb_paths = None
+
+    @property
+    def rays_o(self):
+        if self.full_rays is None:
+            self.full_rays = self.get_rays_single_image(self.H, self.W, self.intrinsics, self.c2w_mat)
+        return self.full_rays[0]
+
+    @property
+    def rays_d(self):
+        if self.full_rays is None:
+            self.full_rays = self.get_rays_single_image(self.H, self.W, self.intrinsics, self.c2w_mat)
+        return self.full_rays[1]
 
     def get_rays_single_image(self, H, W, intrinsics, c2w):
         """
@@ -94,24 +196,34 @@ class RaySamplerSingleImage(object):
         :param W: image width
         :param intrinsics: 4 by 4 intrinsic matrix
         :param c2w: 4 by 4 camera to world extrinsic matrix
-        :return:
+        :return: rays of every render_stride-th pixel of all views, on the device
+        """
+        rays_d = []
+        for b in range(self.batch_size):
+            dirs = pixel_directions.grid(H, W, intrinsics[b], self.render_stride, self.device)
+            rays_d.append(dirs @ c2w[b, :3, :3].to(self.device).T)
+        rays_d = torch.cat(rays_d)
+        rays_o = c2w[:, :3, 3].to(self.device).repeat_interleave(len(rays_d) // self.batch_size, dim=0)
+        return rays_o, rays_d
+
+    def get_rays_selected(self, select_inds):
         """
-        u, v = np.meshgrid(
-            np.arange(W)[:: self.render_stride], np.arange(H)[:: self.render_stride]
+        rays of the selected pixels only
+        :param select_inds: indices into the flattened [batch*H*W] pixels
+        :return: rays_o, rays_d [len(select_inds), 3] on the device
+        """
+        inds = torch.as_tensor(select_inds, device=self.device)
+        b, p = inds // (self.H * self.W), inds % (self.H * self.W)
+        u, v = (p % self.W).float(), (p // self.W).float()
+        pixels = torch.stack((u, v, torch.ones_like(u)), dim=-1)
+        c2w = self.c2w_mat[:, :3].to(self.device)
+        K_inv = torch.stack(
+            [pixel_directions.inverse(self.intrinsics[i], self.device) for i in range(self.batch_size)]
         )
-        u = u.reshape(-1).astype(dtype=np.float32)  # + 0.5    # add half pixel
-        v = v.reshape(-1).astype(dtype=np.float32)  # + 0.5
-        pixels = np.stack((u, v, np.ones_like(u)), axis=0)  # (3, H*W)
-        pixels = torch.from_numpy(pixels)
-        batched_pixels = pixels.unsqueeze(0).repeat(self.batch_size, 1, 1)
-
-        rays_d = (
-            c2w[:, :3, :3].bmm(torch.inverse(intrinsics[:, :3, :3])).bmm(batched_pixels)
-        ).transpose(1, 2)
-        rays_d = rays_d.reshape(-1, 3)
-        rays_o = (
-            c2w[:, :3, 3].unsqueeze(1).repeat(1, rays_d.shape[0], 1).reshape(-1, 3)
-        )  # B x HW x 3
+        # one 3x3 per view, applied to the pixels of that view
+        pix2world = c2w[:, :, :3].bmm(K_inv)
+        rays_d = (pix2world[b] @ pixels.unsqueeze(-1)).squeeze(-1)
+        rays_o = c2w[b, :, 3]
         return rays_o, rays_d
 
     def get_all(self):
@@ -125,56 +237,54 @@ class RaySamplerSingleImage(object):
             "labels": self.labels.cuda() if self.labels is not None else None,
             "src_labels": self.src_labels.cuda() if self.src_labels is not None else None,
             "src_cameras": self.src_cameras.cuda() if self.src_cameras is not None else None,
+            "src_depths": self.src_depths.cuda() if self.src_depths is not None else None,
         }
         return ret
 
-    def sample_random_pixel(self, N_rand, sample_mode, center_ratio=0.8):
-        if sample_mode == "center":
-            border_H = int(self.H * (1 - center_ratio) / 2.0)
-            border_W = int(self.W * (1 - center_ratio) / 2.0)
-
-            # pixel coordinates
-            u, v = np.meshgrid(
-                np.arange(border_H, self.H - border_H), np.arange(border_W, self.W - border_W)
-            )
-            u = u.reshape(-1)
-            v = v.reshape(-1)
-
-            select_inds = rng.choice(u.shape[0], size=(N_rand,), replace=False)
-            select_inds = v[select_inds] + self.W * u[select_inds]
-
-        elif sample_mode == "uniform":
-            # Random from one image
-            select_inds = rng.choice(self.H * self.W, size=(N_rand,), replace=False)
-        else:
-            raise Exception("unknown sample mode!")
-
-        return select_inds
+    def sample_random_pixel(self, N_rand, sample_mode, center_ratio=0.8, pixel_sampler=None, weights=None):
+        """
+        :param weights: [H*W] sampling weights of the pixels for sample_mode 'importance'
+        :return: [N_rand] distinct pixel indices of one view, on the device
+        """
+        if pixel_sampler is None:
+            pixel_sampler = default_pixel_sampler(self.device)
+        return pixel_sampler.sample(N_rand, self.H, self.W, sample_mode, center_ratio, weights)
 
-    def random_sample(self, N_rand, sample_mode, center_ratio=0.8):
+    def random_sample(self, N_rand, sample_mode, center_ratio=0.8, pixel_sampler=None, weights=None):
         """
-        :param N_rand: number of rays to be casted
-        :return:
+        :param N_rand: number of rays to be casted for each target view
+        :param sample_mode: uniform|center|stratified|patch|importance, see pixel_sampler.PixelSampler
+        :param pixel_sampler: PixelSampler holding the random stream, a shared one seeded with 234 if None
+        :param weights: [batch, H*W] sampling weights for sample_mode 'importance'
+        :return: rays of all target views, the N_rand rays of each target view are contiguous;
+                 'selected_inds' index the flattened [batch*H*W] pixels (long tensor on the device)
         """
 
-        select_inds = self.sample_random_pixel(N_rand, sample_mode, center_ratio)
+        select_inds = torch.cat(
+            [
+                self.sample_random_pixel(
+                    N_rand, sample_mode, center_ratio, pixel_sampler, weights[b] if weights is not None else None
+                )
+                + b * self.H * self.W
+                for b in range(self.batch_size)
+            ]
+        )
 
-        rays_o = self.rays_o[select_inds]
-        rays_d = self.rays_d[select_inds]
+        rays_o, rays_d = self.get_rays_selected(select_inds)
 
         if self.rgb is not None:
-            rgb = self.rgb[select_inds]
+            rgb = self.rgb[select_inds.to(self.rgb.device)]
         else:
             rgb = None
 
         if self.labels is not None:
-            labels = self.labels[select_inds]
+            labels = self.labels[select_inds.to(self.labels.device)]
         else:
             labels = None
 
         ret = {
-            "ray_o": rays_o.cuda(),
-            "ray_d": rays_d.cuda(),
+            "ray_o": rays_o,
+            "ray_d": rays_d,
             "camera": self.camera.cuda(),
             "depth_range": self.depth_range.cuda(),
             "rgb": rgb.cuda() if rgb is not None else None,
@@ -182,6 +292,7 @@ class RaySamplerSingleImage(object):
             "labels": labels.cuda() if labels is not None else None,
             "src_labels": self.src_labels.cuda() if self.src_labels is not None else None,
             "src_cameras": self.src_cameras.cuda() if self.src_cameras is not None else None,
+            "src_depths": self.src_depths.cuda() if self.src_depths is not None else None,
             "selected_inds": select_inds,
         }
         return ret
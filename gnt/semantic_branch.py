@@ -7,6 +7,9 @@ import fvcore.nn.weight_init as weight_init
 from detectron2.layers import Conv2d, ShapeSpec, get_norm
 
 
+# (H, W) of the ScanNet query images, the size the logits are returned at unless the caller gives one
+QUERY_SIZE = (240, 320)
+
 
 class NeRFSemSegFPNHead(nn.Module):
 
@@ -49,36 +52,61 @@ class NeRFSemSegFPNHead(nn.Module):
 
 
 
-    def forward(self, deep_feats, out_feats, select_inds):
-        h, w = deep_feats.shape[-2:]
+    def sample_pixels(self, out, batch_inds, ys, xs, H, W):
+        """
+        bilinear interpolation (align_corners=True) of out at full-resolution pixels, equal to upsampling out
+        to [H, W] and gathering the pixels, without the full-resolution map
+        :param out: [batch, c, h, w]
+        :param batch_inds, ys, xs: [N_rays], batch element and pixel coordinates of every selected ray
+        :return: [N_rays, c]
+        """
+        h, w = out.shape[-2:]
+        sy = ys.to(out.dtype) * ((h - 1) / max(H - 1, 1))
+        sx = xs.to(out.dtype) * ((w - 1) / max(W - 1, 1))
+        y0, x0 = sy.floor().long(), sx.floor().long()
+        y1, x1 = (y0 + 1).clamp(max=h - 1), (x0 + 1).clamp(max=w - 1)
+        wy, wx = (sy - y0)[:, None], (sx - x0)[:, None]
+        top = out[batch_inds, :, y0, x0] * (1 - wx) + out[batch_inds, :, y0, x1] * wx
+        bottom = out[batch_inds, :, y1, x0] * (1 - wx) + out[batch_inds, :, y1, x1] * wx
+        return top * (1 - wy) + bottom * wy
+
+    def forward(self, deep_feats, out_feats, select_inds, out_size=None):
+        """
+        :param deep_feats: [batch, 512, h, w] semantic features of the query views (or the rendered feats_out)
+        :param out_size: (H, W) of the query image, the logits are returned at this size and select_inds index
+                         its pixels; QUERY_SIZE if None
+        """
+        batch, c, h, w = deep_feats.shape
+        H, W = QUERY_SIZE if out_size is None else out_size
         #######   replace feature map           #######
         if select_inds is not None:
-            batch=1
-            ratio = 240 * 320 // (deep_feats.shape[-2] * deep_feats.shape[-1])
-            deep_feats = deep_feats.reshape(1, deep_feats.shape[1], -1).squeeze(0).permute(1,0)
-            re_select_inds = torch.tensor([select_ind // ratio for select_ind in select_inds])
-            deep_feats[re_select_inds] = out_feats
-            chunks = torch.chunk(deep_feats, 4, dim=1)
-        else:
-            batch = deep_feats.shape[0]
-            deep_feats = deep_feats.reshape(batch, deep_feats.shape[1], -1).permute(0,2,1)
-            chunks = torch.chunk(deep_feats, 4, dim=2)
+            # select_inds index the flattened [batch*H*W] query pixels, one group of rays per target view;
+            # converted on the device, every ray replaces the feature of the cell that holds its pixel
+            select_inds = torch.as_tensor(select_inds, device=deep_feats.device)
+            batch_inds = select_inds // (H * W)
+            ys, xs = (select_inds % (H * W)) // W, select_inds % W
+            cell_inds = (ys * h // H) * w + xs * w // W
+            feats = deep_feats.flatten(2)
+            feats.transpose(1, 2)[batch_inds, cell_inds] = out_feats.to(feats.dtype)
+            deep_feats = feats.view(batch, c, h, w)
 
         ####### constrcut feature pyramids and Decoder  #######
-        for i, chunk in enumerate(chunks):
-            chunk = chunk.reshape(batch, h, w, chunk.shape[-1]).permute(0,3,1,2) # batch, 512, h, w
+        # channel groups of the [batch, 512, h, w] map feed the four scale heads
+        for i, chunk in enumerate(torch.chunk(deep_feats, 4, dim=1)):
             if i == 0:
                 x = self.scale_heads[i](chunk)
             else:
                 chunk = F.interpolate(chunk, scale_factor = 1/(2**i), mode='bilinear', align_corners=True, recompute_scale_factor=True)
                 x = x + self.scale_heads[i](chunk)
 
-        out = self.predictor(x)
-        out = F.interpolate(out, scale_factor = 240 // h, mode='bilinear', align_corners=True)  # b, c, h, w
+        out = self.predictor(x).float()  # logits in fp32 under autocast
 
-        if self.selected_inds is True:
-            out = out.reshape(batch, out.shape[1], -1)[:,:,re_select_inds]
+        if self.selected_inds is True and select_inds is not None:
+            # only the supervised pixels of the upsampled logits, [1, c, N_rays]
+            out = self.sample_pixels(out, batch_inds, ys, xs, H, W).permute(1, 0).unsqueeze(0)
+        else:
+            out = F.interpolate(out, size=(H, W), mode='bilinear', align_corners=True)  # b, c, H, W
         if self.unbounded is True:
             return self.softmax(out)
         else:
-            return out 
\ No newline at end of file
+            return out 
@@ -0,0 +1,107 @@
+import itertools
+import time
+import traceback
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+########################################################################################################################
+# sharded evaluation: work items (e.g. (scene, frame) pairs) spread over ranks or local worker processes
+########################################################################################################################
+
+_run_ids = itertools.count()
+
+
+class WorkCounter(object):
+    """
+    index of the next unclaimed work item, shared by all workers. a worker claims the next `claim` items whenever
+    it is done with its previous ones, so fast workers keep taking items until none are left (work stealing
+    from one shared queue instead of a static split).
+    backed by a multiprocessing value for local worker processes, by the store of the default process group for
+    torch.distributed ranks, or by a plain integer for a single in-process worker
+    """
+
+    def __init__(self, n_items, claim=1, value=None, store=None, key=None):
+        self.n_items = n_items
+        self.claim = max(int(claim), 1)
+        self.value = value
+        self.store = store
+        self.key = key
+        self.next = 0
+
+    def claim_next(self):
+        """
+        :return: range of claimed item indices, empty once all items are claimed
+        """
+        if self.store is not None:
+            start = self.store.add(self.key, self.claim) - self.claim
+        elif self.value is not None:
+            with self.value.get_lock():
+                start = self.value.value
+                self.value.value += self.claim
+        else:
+            start = self.next
+            self.next += self.claim
+        return range(min(start, self.n_items), min(start + self.claim, self.n_items))
+
+    def __iter__(self):
+        while True:
+            items = self.claim_next()
+            if len(items) == 0:
+                return
+            yield from items
+
+
+def _local_worker(rank, worker_fn, counter, queue):
+    try:
+        queue.put((rank, worker_fn(rank, counter), None))
+    except Exception:
+        queue.put((rank, None, traceback.format_exc()))
+
+
+def run_sharded(worker_fn, n_items, num_workers=1, claim=1):
+    """
+    runs worker_fn(rank, counter) in every worker; a worker evaluates the items it draws from iterating the
+    counter and returns a list of (item index, result).
+    workers are the ranks of an initialized process group (every rank calls run_sharded and gets all results),
+    else num_workers spawned processes (worker_fn must be picklable), else the calling process itself
+    :return: results of all items ordered by item index, wall-clock seconds
+    """
+    t0 = time.time()
+    if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+        # a fresh key per run, every rank calls run_sharded in the same order
+        key = "sharded_eval_{}".format(next(_run_ids))
+        store = dist.distributed_c10d._get_default_store()
+        counter = WorkCounter(n_items, claim, store=store, key=key)
+        results = worker_fn(dist.get_rank(), counter)
+        gathered = [None] * dist.get_world_size()
+        dist.all_gather_object(gathered, results)
+        results = [r for rank_results in gathered for r in rank_results]
+    elif num_workers > 1:
+        ctx = mp.get_context("spawn")
+        counter = WorkCounter(n_items, claim, value=ctx.Value("l", 0))
+        queue = ctx.Queue()
+        procs = [
+            ctx.Process(target=_local_worker, args=(rank, worker_fn, counter, queue)) for rank in range(num_workers)
+        ]
+        for p in procs:
+            p.start()
+        results, errors = [], []
+        # drain the queue before joining, a worker blocks on exit until its results are read
+        for _ in procs:
+            rank, rank_results, error = queue.get()
+            if error is not None:
+                errors.append("worker {}:\n{}".format(rank, error))
+            else:
+                results.extend(rank_results)
+        for p in procs:
+            p.join()
+        if errors:
+            raise RuntimeError("sharded evaluation failed\n" + "\n".join(errors))
+    else:
+        results = worker_fn(0, WorkCounter(n_items, claim))
+
+    results = sorted(results, key=lambda r: r[0])
+    assert [r[0] for r in results] == list(range(n_items)), "work items lost or evaluated twice"
+    return [r[1] for r in results], time.time() - t0
@@ -1,6 +1,8 @@
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 # sin-cose embedding module
 class Embedder(nn.Module):
@@ -52,8 +54,10 @@ class FeedForward(nn.Module):
 
 
 # Subtraction-based efficient attention
+# chunk_size > 0 processes the rays in chunks, so the expanded [rays, samples, views, dim] tensors only exist
+# for one chunk at a time; with gradients enabled each chunk is recomputed in the backward pass
 class Attention2D(nn.Module):
-    def __init__(self, dim, dp_rate):
+    def __init__(self, dim, dp_rate, chunk_size=0):
         super(Attention2D, self).__init__()
         self.q_fc = nn.Linear(dim, dim, bias=False)
         self.k_fc = nn.Linear(dim, dim, bias=False)
@@ -70,8 +74,9 @@ class Attention2D(nn.Module):
         )
         self.out_fc = nn.Linear(dim, dim)
         self.dp = nn.Dropout(dp_rate)
+        self.chunk_size = chunk_size
 
-    def forward(self, q, k, deep_semantics, pos, mask=None, ret_attn=False):
+    def attend(self, q, k, deep_semantics, pos, mask=None, ret_attn=False):
         q = self.q_fc(q)
         k = self.k_fc(k)
         v = self.v_fc(k)
@@ -79,29 +84,59 @@ class Attention2D(nn.Module):
         pos = self.pos_fc(pos)
         attn = k - q[:, :, None, :] + pos
         attn = self.attn_fc(attn)
+        # masking and softmax in fp32 under autocast, -1e9 overflows fp16
+        attn = attn.float()
         if mask is not None:
             attn = attn.masked_fill(mask == 0, -1e9)
-        attn = torch.softmax(attn, dim=-2)
+        attn = torch.softmax(attn, dim=-2).to(v.dtype)
         attn = self.dp(attn)
 
         x = ((v + pos) * attn).sum(dim=2)
         x = self.dp(self.out_fc(x))
         if ret_attn is True:   # 保留积分权重不变，直接乘上深层语义特征
-            view_deep_semantic = (deep_semantics * attn.repeat_interleave(8, dim=-1)).sum(dim=2) # 这个地方的16需要改进
+            # every attention channel weights a group of deep semantic channels, broadcast instead of repeat_interleave
+            group = deep_semantics.shape[-1] // attn.shape[-1]
+            view_deep_semantic = (
+                deep_semantics.unflatten(-1, (attn.shape[-1], group)) * attn[..., None]
+            ).sum(dim=2).flatten(-2)
             return x, view_deep_semantic
         else:
             return x
 
+    def forward(self, q, k, deep_semantics, pos, mask=None, ret_attn=False):
+        if self.chunk_size <= 0 or q.shape[0] <= self.chunk_size:
+            return self.attend(q, k, deep_semantics, pos, mask, ret_attn)
+
+        outs = []
+        for i in range(0, q.shape[0], self.chunk_size):
+            chunk = slice(i, i + self.chunk_size)
+            inputs = (
+                q[chunk],
+                k[chunk],
+                deep_semantics[chunk] if ret_attn is True else None,
+                pos[chunk],
+                mask[chunk] if mask is not None else None,
+                ret_attn,
+            )
+            if torch.is_grad_enabled():
+                outs.append(checkpoint(self.attend, *inputs, use_reentrant=False))
+            else:
+                outs.append(self.attend(*inputs))
+        if ret_attn is True:
+            return torch.cat([out[0] for out in outs]), torch.cat([out[1] for out in outs])
+        else:
+            return torch.cat(outs)
+
 
 # View Transformer
 class Transformer2D(nn.Module):
-    def __init__(self, dim, ff_hid_dim, ff_dp_rate, attn_dp_rate):
+    def __init__(self, dim, ff_hid_dim, ff_dp_rate, attn_dp_rate, chunk_size=0):
         super(Transformer2D, self).__init__()
         self.attn_norm = nn.LayerNorm(dim, eps=1e-6)
         self.ff_norm = nn.LayerNorm(dim, eps=1e-6)
 
         self.ff = FeedForward(dim, ff_hid_dim, ff_dp_rate)
-        self.attn = Attention2D(dim, attn_dp_rate)
+        self.attn = Attention2D(dim, attn_dp_rate, chunk_size)
 
     def forward(self, q, k, deep_semantics, pos, mask=None, ret_attn=False):
         residue = q
@@ -127,8 +162,10 @@ class Transformer2D(nn.Module):
 #   - qk (default) -> only (q.k) attention.
 #   - pos -> replace (q.k) attention with position attention.
 #   - gate -> weighted addition of  (q.k) attention and position attention.
+# backend "sdpa" runs the qk attention with scaled_dot_product_attention, without the [heads, samples, samples]
+# matrix; only the attention of the first sample is formed explicitly, as the density returned with ret_attn
 class Attention(nn.Module):
-    def __init__(self, dim, n_heads, dp_rate, attn_mode="qk", pos_dim=None):
+    def __init__(self, dim, n_heads, dp_rate, attn_mode="qk", pos_dim=None, backend="matmul"):
         super(Attention, self).__init__()
         if attn_mode in ["qk", "gate"]:
             self.q_fc = nn.Linear(dim, dim, bias=False)
@@ -145,6 +182,7 @@ class Attention(nn.Module):
         self.dp = nn.Dropout(dp_rate)
         self.n_heads = n_heads
         self.attn_mode = attn_mode
+        self.backend = backend if attn_mode == "qk" else "matmul"
 
     def forward(self, x, deep_semantics, pos=None, ret_attn=False):
         if self.attn_mode in ["qk", "gate"]:
@@ -155,32 +193,50 @@ class Attention(nn.Module):
         v = self.v_fc(x)
         v = v.view(x.shape[0], x.shape[1], self.n_heads, -1).permute(0, 2, 1, 3)
 
-        if self.attn_mode in ["qk", "gate"]:
-            attn = torch.matmul(q, k.transpose(-2, -1)) / np.sqrt(q.shape[-1])
-            attn = torch.softmax(attn, dim=-1)
-        elif self.attn_mode == "pos":
-            pos = self.pos_fc(pos)
-            attn = self.head_fc(pos[:, :, None, :] - pos[:, None, :, :]).permute(0, 3, 1, 2)
-            attn = torch.softmax(attn, dim=-1)
-        if self.attn_mode == "gate":
-            pos = self.pos_fc(pos)
-            pos_attn = self.head_fc(pos[:, :, None, :] - pos[:, None, :, :]).permute(0, 3, 1, 2)
-            pos_attn = torch.softmax(pos_attn, dim=-1)
-            gate = self.gate.view(1, -1, 1, 1)
-            attn = (1.0 - torch.sigmoid(gate)) * attn + torch.sigmoid(gate) * pos_attn
-            attn /= attn.sum(dim=-1).unsqueeze(-1)
-        attn = self.dp(attn)
+        if ret_attn:
+            ray_sem_out = deep_semantics.view(deep_semantics.shape[0], 
+                                              deep_semantics.shape[1], 
+                                              self.n_heads, -1).permute(0, 2, 1, 3)
 
-        out = torch.matmul(attn, v).permute(0, 2, 1, 3).contiguous()
+        if self.backend == "sdpa":
+            dp_rate = self.dp.p if self.training else 0.0
+            if ret_attn:
+                # one kernel for both values, they share the (dropped out) attention weights
+                out = F.scaled_dot_product_attention(
+                    q, k, torch.cat([v, ray_sem_out.to(v.dtype)], dim=-1), dropout_p=dp_rate
+                )
+                out, ray_sem_out = out.split([v.shape[-1], ray_sem_out.shape[-1]], dim=-1)
+                attn = torch.matmul(q[:, :, :1], k.transpose(-2, -1)) / np.sqrt(q.shape[-1])
+                attn = torch.softmax(attn.float(), dim=-1)  # [N_rays, n_heads, 1, N_samples]
+            else:
+                out = F.scaled_dot_product_attention(q, k, v, dropout_p=dp_rate)
+        else:
+            if self.attn_mode in ["qk", "gate"]:
+                attn = torch.matmul(q, k.transpose(-2, -1)) / np.sqrt(q.shape[-1])
+                attn = torch.softmax(attn.float(), dim=-1)
+            elif self.attn_mode == "pos":
+                pos = self.pos_fc(pos)
+                attn = self.head_fc(pos[:, :, None, :] - pos[:, None, :, :]).permute(0, 3, 1, 2)
+                attn = torch.softmax(attn.float(), dim=-1)
+            if self.attn_mode == "gate":
+                pos = self.pos_fc(pos)
+                pos_attn = self.head_fc(pos[:, :, None, :] - pos[:, None, :, :]).permute(0, 3, 1, 2)
+                pos_attn = torch.softmax(pos_attn.float(), dim=-1)
+                gate = self.gate.view(1, -1, 1, 1)
+                attn = (1.0 - torch.sigmoid(gate)) * attn + torch.sigmoid(gate) * pos_attn
+                attn /= attn.sum(dim=-1).unsqueeze(-1)
+            attn = self.dp(attn)
+            out = torch.matmul(attn, v)
+            if ret_attn:   # 保留积分权重不变，直接乘上深层语义特征
+                ray_sem_out = torch.matmul(attn, ray_sem_out)
+
+        out = out.permute(0, 2, 1, 3).contiguous()
         out = out.view(x.shape[0], x.shape[1], -1)
 
         
         out = self.dp(self.out_fc(out))
-        if ret_attn:   # 保留积分权重不变，直接乘上深层语义特征
-            ray_sem_out = deep_semantics.view(deep_semantics.shape[0], 
-                                              deep_semantics.shape[1], 
-                                              self.n_heads, -1).permute(0, 2, 1, 3)
-            ray_sem_out = torch.matmul(attn, ray_sem_out).permute(0, 2, 1, 3).contiguous()
+        if ret_attn:
+            ray_sem_out = ray_sem_out.permute(0, 2, 1, 3).contiguous()
             ray_sem_out = ray_sem_out.view(x.shape[0], x.shape[1], -1)
             return out, attn, ray_sem_out
         else:
@@ -190,14 +246,14 @@ class Attention(nn.Module):
 # Ray Transformer
 class Transformer(nn.Module):
     def __init__(
-        self, dim, ff_hid_dim, ff_dp_rate, n_heads, attn_dp_rate, attn_mode="qk", pos_dim=None
+        self, dim, ff_hid_dim, ff_dp_rate, n_heads, attn_dp_rate, attn_mode="qk", pos_dim=None, backend="matmul"
     ):
         super(Transformer, self).__init__()
         self.attn_norm = nn.LayerNorm(dim, eps=1e-6)
         self.ff_norm = nn.LayerNorm(dim, eps=1e-6)
 
         self.ff = FeedForward(dim, ff_hid_dim, ff_dp_rate)
-        self.attn = Attention(dim, n_heads, attn_dp_rate, attn_mode, pos_dim)
+        self.attn = Attention(dim, n_heads, attn_dp_rate, attn_mode, pos_dim, backend)
 
     def forward(self, x, deep_semantics, pos=None, ret_attn=False):
         residue = x
@@ -238,6 +294,7 @@ class GNT(nn.Module):
                 ff_hid_dim=int(args.netwidth * 4),
                 ff_dp_rate=0.1,
                 attn_dp_rate=0.1,
+                chunk_size=args.view_attn_chunk,
             )
             self.view_crosstrans.append(view_trans)
             # ray transformer
@@ -247,6 +304,7 @@ class GNT(nn.Module):
                 n_heads=4,
                 ff_dp_rate=0.1,
                 attn_dp_rate=0.1,
+                backend=args.ray_attn_backend,
             )
             self.view_selftrans.append(ray_trans)
             # mlp
@@ -290,7 +348,7 @@ class GNT(nn.Module):
         )
 
     def forward(self, rgb_feat, deep_sem_feat, ray_diff, mask, pts, ray_d):
-        # compute positional embeddings
+        # compute positional embeddings, kept in fp32 under autocast (frequencies up to 2^9)
         viewdirs = ray_d
         viewdirs = viewdirs / torch.norm(viewdirs, dim=-1, keepdim=True)
         viewdirs = torch.reshape(viewdirs, [-1, 3]).float()
@@ -331,19 +389,19 @@ class GNT(nn.Module):
                 q, attn, ray_sem_out = q
                 deep_sem_out.append(ray_sem_out)
 
-        # normalize & rgb
+        # normalize & rgb, outputs in fp32 under autocast for compositing, importance sampling and losses
         h = self.norm(q)
-        outputs = self.rgb_fc(h.mean(dim=1))
+        outputs = self.rgb_fc(h.mean(dim=1)).float()
         if self.semantic_model == 'fc':
-            sem_outputs = self.semantic_fc(h.mean(dim=1))
+            sem_outputs = self.semantic_fc(h.mean(dim=1)).float()
         else:
             sem_outputs = None
             
         if self.ret_alpha and self.save_feature is False:
-            return torch.cat([outputs, attn], dim=1), None, sem_outputs
+            return torch.cat([outputs, attn.float()], dim=1), None, sem_outputs
         elif self.ret_alpha and self.save_feature:
-            return torch.cat([outputs, attn], dim=1), \
-                   torch.stack(deep_sem_out, dim=0).sum(dim=0).mean(dim=1), \
+            return torch.cat([outputs, attn.float()], dim=1), \
+                   torch.stack(deep_sem_out, dim=0).sum(dim=0).mean(dim=1).float(), \
                    sem_outputs
         else:
             return outputs, None, None
@@ -7,13 +7,15 @@ import torch.utils.data.distributed
 from torch.utils.data import DataLoader
 
 from gnt.data_loaders import dataset_dict
-from gnt.render_image import render_single_image
+from gnt.render_image import render_single_image, make_chunk_sizer
+from gnt.render_ray import OccupancyProxy, FineSamplePruner
 from gnt.model import GNTModel
 from gnt.sample_ray import RaySamplerSingleImage
 from utils import img_HWC2CHW, colorize, img2psnr, lpips, ssim
 import config
 import torch.distributed as dist
 from gnt.projection import Projector
+from gnt.feature_cache import ReferenceFeatureCache
 from gnt.data_loaders.create_training_dataset import create_training_dataset
 import imageio
 
@@ -70,6 +72,17 @@ def render(args):
     )
     # create projector
     projector = Projector(device=device)
+    # neighbouring render poses pick mostly the same source views, encode each of them once
+    if args.ref_feat_cache_mb > 0:
+        ref_feat_cache = ReferenceFeatureCache(args.ref_feat_cache_mb, storage=args.ref_feat_cache_device)
+    else:
+        ref_feat_cache = None
+    # rays per chunk adapted to --chunk_mem_mb over all rendered views, None keeps --chunk_size
+    chunk_sizer = make_chunk_sizer(args)
+    # empty-space skipping pre-pass with --skip_empty, None otherwise
+    occupancy = OccupancyProxy.from_args(args)
+    # early ray termination in the fine pass with --fine_prune, None otherwise
+    pruner = FineSamplePruner.from_args(args)
 
     indx = 0
     while True:
@@ -91,9 +104,21 @@ def render(args):
                 out_folder=out_folder,
                 ret_alpha=args.N_importance > 0,
                 single_net=args.single_net,
+                ref_feat_cache=ref_feat_cache,
+                chunk_sizer=chunk_sizer,
+                occupancy=occupancy,
+                pruner=pruner,
             )
             torch.cuda.empty_cache()
             indx += 1
+    if ref_feat_cache is not None:
+        print(ref_feat_cache.stats())
+    if chunk_sizer is not None:
+        print(chunk_sizer)
+    if occupancy is not None:
+        print(occupancy.stats())
+    if pruner is not None:
+        print(pruner.stats())
 
 
 @torch.no_grad()
@@ -108,14 +133,26 @@ def log_view(
     out_folder="",
     ret_alpha=False,
     single_net=True,
+    ref_feat_cache=None,
+    chunk_sizer=None,
+    occupancy=None,
+    pruner=None,
 ):
     model.switch_to_eval()
-    with torch.no_grad():
+    with torch.no_grad(), model.autocast():
         ray_batch = ray_sampler.get_all()
-        if model.feature_net is not None:
-            featmaps = model.feature_net(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
+
+        def encode_reference(src_imgs):
+            ref_coarse_feats, _, ref_deep_semantics = model.feature_net(src_imgs)
+            return ref_coarse_feats, model.reference_fpn(ref_deep_semantics)
+
+        src_imgs = ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2)
+        if ref_feat_cache is not None and ray_sampler.src_rgb_paths is not None:
+            featmaps, deep_semantics = ref_feat_cache.lookup(
+                ray_sampler.src_rgb_paths, src_imgs, encode_reference, step=model.start_step
+            )
         else:
-            featmaps = [None, None]
+            featmaps, deep_semantics = encode_reference(src_imgs)
         ret = render_single_image(
             ray_sampler=ray_sampler,
             ray_batch=ray_batch,
@@ -129,8 +166,12 @@ def log_view(
             white_bkgd=args.white_bkgd,
             render_stride=render_stride,
             featmaps=featmaps,
+            deep_semantics=deep_semantics,
             ret_alpha=ret_alpha,
             single_net=single_net,
+            chunk_sizer=chunk_sizer,
+            occupancy=occupancy,
+            pruner=pruner,
         )
 
     average_im = ray_sampler.src_rgbs.cpu().mean(dim=(0, 1))
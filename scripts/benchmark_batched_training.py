@@ -0,0 +1,154 @@
+"""
+Training throughput of one batched step over B target views against B single-target steps (the previous loop).
+
+    python scripts/benchmark_batched_training.py --config configs/gnt_scannet.txt --batch_sizes 1 2 4 8
+
+Runs the ray branch of a train_scannet step (ResUNet, Projector, render_rays with the GNT network,
+rgb loss, backward and optimizer step) on random ScanNet-sized inputs.
+The FPN deep semantics are replaced by a 1x1 convolution of the coarse features (mmdet is not needed),
+which keeps the [n_views, 512, H/2, W/2] layout sampled by the Projector.
+"""
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import config
+from gnt.feature_network import ResUNet
+from gnt.projection import Projector
+from gnt.render_ray import render_rays
+from gnt.transformer_network import GNT
+
+
+def make_camera(H, W, pose):
+    K = torch.eye(4)
+    K[0, 0] = K[1, 1] = 0.9 * W
+    K[0, 2], K[1, 2] = W / 2.0, H / 2.0
+    return torch.cat([torch.tensor([H, W], dtype=torch.float32), K.flatten(), pose.flatten()])
+
+
+def make_ray_batch(batch_size, H, W, num_source_views, N_rand, device):
+    """
+    rays of batch_size target views, each with its own source views, laid out as RaySamplerSingleImage.random_sample
+    """
+    cameras, src_cameras, rays_o, rays_d = [], [], [], []
+    for _ in range(batch_size):
+        poses = []
+        for _ in range(num_source_views + 1):
+            pose = torch.eye(4)
+            pose[:3, 3] = torch.randn(3) * 0.1
+            poses.append(pose)
+        cameras.append(make_camera(H, W, poses[0]))
+        src_cameras.append(torch.stack([make_camera(H, W, p) for p in poses[1:]]))
+        d = torch.randn(N_rand, 3) * 0.3
+        d[:, 2] = 1.0
+        rays_d.append(d)
+        rays_o.append(poses[0][:3, 3].expand(N_rand, 3))
+    return {
+        "ray_o": torch.cat(rays_o).to(device),
+        "ray_d": torch.cat(rays_d).to(device),
+        "camera": torch.stack(cameras).to(device),
+        "src_cameras": torch.stack(src_cameras).to(device),
+        "depth_range": torch.tensor([[0.1, 10.0]] * batch_size, device=device),
+        "rgb": torch.rand(batch_size * N_rand, 3, device=device),
+        "src_rgbs": torch.rand(batch_size, num_source_views, H, W, 3, device=device),
+    }
+
+
+def train_step(args, model, projector, optimizer, ray_batch):
+    src_imgs = ray_batch["src_rgbs"].flatten(0, 1).permute(0, 3, 1, 2)
+    ref_coarse_feats, _, _ = model.feature_net(src_imgs)
+    ref_deep_semantics = F.interpolate(
+        model.deep_semantics(ref_coarse_feats), scale_factor=2, mode="bilinear", align_corners=True
+    )
+    ret = render_rays(
+        ray_batch=ray_batch,
+        model=model,
+        projector=projector,
+        featmaps=ref_coarse_feats,
+        ref_deep_semantics=ref_deep_semantics,
+        N_samples=args.N_samples,
+        inv_uniform=args.inv_uniform,
+        N_importance=args.N_importance,
+        det=args.det,
+        ret_alpha=args.N_importance > 0,
+        single_net=args.single_net,
+    )
+    loss = torch.mean(torch.sum((ret["outputs_coarse"]["rgb"] - ray_batch["rgb"]) ** 2, -1))
+    if ret["outputs_fine"] is not None:
+        loss = loss + torch.mean(torch.sum((ret["outputs_fine"]["rgb"] - ray_batch["rgb"]) ** 2, -1))
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+
+
+def timeit(fn, n_iters, device):
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    t0 = time.time()
+    for _ in range(n_iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.time() - t0) / n_iters
+
+
+def main():
+    parser = config.config_parser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--image_size", type=int, nargs=2, default=[240, 320])
+    parser.add_argument("--bench_iters", type=int, default=5)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    H, W = args.image_size
+
+    model = SimpleNamespace(
+        net_coarse=GNT(
+            args,
+            in_feat_ch=args.coarse_feat_dim,
+            posenc_dim=3 + 3 * 2 * 10,
+            viewenc_dim=3 + 3 * 2 * 10,
+            ret_alpha=args.N_importance > 0,
+        ).to(device),
+        feature_net=ResUNet(
+            coarse_out_ch=args.coarse_feat_dim, fine_out_ch=args.fine_feat_dim, single_net=args.single_net
+        ).to(device),
+        deep_semantics=nn.Conv2d(args.coarse_feat_dim, args.netwidth * 8, kernel_size=1).to(device),
+    )
+    optimizer = torch.optim.Adam(
+        list(model.net_coarse.parameters())
+        + list(model.feature_net.parameters())
+        + list(model.deep_semantics.parameters()),
+        lr=1e-5,
+    )
+    projector = Projector(device=device)
+
+    print("{:>6} {:>7} {:>12} {:>12} {:>12} {:>12} {:>8}".format(
+        "batch", "N_rand", "loop rays/s", "batch rays/s", "loop img/s", "batch img/s", "speedup"))
+    for batch_size in args.batch_sizes:
+        batched = make_ray_batch(batch_size, H, W, args.num_source_views, args.N_rand, device)
+        singles = [
+            make_ray_batch(1, H, W, args.num_source_views, args.N_rand, device) for _ in range(batch_size)
+        ]
+
+        def loop():
+            for ray_batch in singles:
+                train_step(args, model, projector, optimizer, ray_batch)
+
+        t_loop = timeit(loop, args.bench_iters, device)
+        t_batch = timeit(lambda: train_step(args, model, projector, optimizer, batched), args.bench_iters, device)
+        n_rays = batch_size * args.N_rand
+        print("{:>6} {:>7} {:>12.0f} {:>12.0f} {:>12.2f} {:>12.2f} {:>7.2f}x".format(
+            batch_size, args.N_rand, n_rays / t_loop, n_rays / t_batch,
+            batch_size / t_loop, batch_size / t_batch, t_loop / t_batch))
+
+
+if __name__ == "__main__":
+    main()
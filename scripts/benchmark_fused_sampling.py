@@ -0,0 +1,149 @@
+"""
+Benchmark of Projector.compute with separate grid_sample calls against the fused (channel-stacked) path.
+The source views are crops of a real image, the run fails if the sampled rgb of the fused path deviates from
+the separate path by more than --rgb_tol.
+
+    python scripts/benchmark_fused_sampling.py --preset scannet llff --device cuda
+"""
+import argparse
+import os
+import sys
+import time
+
+import imageio
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from gnt.projection import Projector
+
+# image size and reference feature layout of the ScanNet (240x320) and LLFF (factor 4) configs:
+# ResUNet coarse features at 1/4 resolution, FPN deep semantics (4 x 128 channels) at 1/2 resolution
+PRESETS = {
+    "scannet": {"H": 240, "W": 320, "num_source_views": 10, "N_samples": 64, "N_rays": 2048},
+    "llff": {"H": 756, "W": 1008, "num_source_views": 10, "N_samples": 64, "N_rays": 2048},
+}
+COARSE_FEAT_DIM = 32
+DEEP_SEM_DIM = 512
+IMAGE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "docs", "assets", "flowers.png")
+
+
+def make_camera(H, W, pose):
+    K = torch.eye(4)
+    K[0, 0] = K[1, 1] = 0.9 * W
+    K[0, 2], K[1, 2] = W / 2.0, H / 2.0
+    return torch.cat([torch.tensor([H, W], dtype=torch.float32), K.flatten(), pose.flatten()])
+
+
+def smooth_noise(n, c, h, w, device):
+    x = torch.rand(n, c, h // 8 + 2, w // 8 + 2, device=device)
+    return F.interpolate(x, size=(h, w), mode="bicubic", align_corners=True).clamp(0.0, 1.0)
+
+
+def image_views(image_file, n, h, w, device):
+    """
+    n [h, w, 3] crops of a real image at shifted offsets, with its full-resolution edges and texture
+    """
+    img = torch.from_numpy(np.asarray(imageio.imread(image_file))[..., :3].astype(np.float32) / 255.0)
+    img = img.permute(2, 0, 1)[None].to(device)
+    # enlarged so that every crop fits, an upscaled photo keeps high frequency edges unlike smooth_noise
+    scale = max((h + n) / img.shape[-2], (w + n) / img.shape[-1], 1.0)
+    img = F.interpolate(img, scale_factor=scale, mode="bilinear", align_corners=False)
+    return torch.stack([img[0, :, i : i + h, i : i + w] for i in range(n)]).permute(0, 2, 3, 1)
+
+
+def make_inputs(H, W, num_source_views, N_samples, N_rays, device, image_file=IMAGE_FILE):
+    poses = []
+    for _ in range(num_source_views + 1):
+        pose = torch.eye(4)
+        pose[:3, 3] = torch.randn(3) * 0.1
+        poses.append(pose)
+    query_camera = make_camera(H, W, poses[0])[None].to(device)
+    train_cameras = torch.stack([make_camera(H, W, p) for p in poses[1:]])[None].to(device)
+
+    # points in front of the cameras
+    xyz = torch.randn(N_rays, N_samples, 3, device=device) * 0.5
+    xyz[..., 2] = xyz[..., 2].abs() + 1.0
+
+    # real image content for the rgb, smooth random maps for the features
+    train_imgs = image_views(image_file, num_source_views, H, W, device)[None]
+    featmaps = smooth_noise(num_source_views, COARSE_FEAT_DIM, H // 4, W // 4, device)
+    deep_semantics = smooth_noise(num_source_views, DEEP_SEM_DIM, H // 2, W // 2, device)
+    return xyz, query_camera, train_imgs, train_cameras, featmaps, deep_semantics
+
+
+def timeit(fn, n_iters, device):
+    for _ in range(2):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    t0 = time.time()
+    for _ in range(n_iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.time() - t0) / n_iters * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--preset", type=str, nargs="+", default=["scannet", "llff"], choices=list(PRESETS))
+    parser.add_argument("--N_rays", type=int, default=None, help="override the preset chunk size")
+    parser.add_argument("--n_iters", type=int, default=10)
+    parser.add_argument("--image", type=str, default=IMAGE_FILE, help="image the source views are cropped from")
+    parser.add_argument("--rgb_tol", type=float, default=1e-5, help="max |diff| allowed on the sampled rgb")
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    projector = Projector(device=device)
+
+    print("{:>8} {:>7} {:>14} {:>12} {:>8} {:>12} {:>10} {:>10}".format(
+        "preset", "N_rays", "separate (ms)", "fused (ms)", "speedup", "stack (ms)", "rgb diff", "feat diff"))
+    failed = []
+    for name in args.preset:
+        cfg = dict(PRESETS[name])
+        if args.N_rays is not None:
+            cfg["N_rays"] = args.N_rays
+        xyz, query_camera, train_imgs, train_cameras, featmaps, deep_semantics = make_inputs(
+            cfg["H"], cfg["W"], cfg["num_source_views"], cfg["N_samples"], cfg["N_rays"], device, args.image
+        )
+        proj_ctx = projector.prepare(query_camera, train_cameras)
+        ref_stack = projector.stack_reference(featmaps, deep_semantics)
+
+        def separate():
+            return projector.compute(
+                xyz, query_camera, train_imgs, train_cameras, featmaps, deep_semantics, proj_ctx=proj_ctx
+            )
+
+        def fused():
+            return projector.compute(
+                xyz, query_camera, train_imgs, train_cameras, featmaps, deep_semantics,
+                proj_ctx=proj_ctx, ref_stack=ref_stack,
+            )
+
+        # the rgb is sampled the same way in both paths and must match; the resampled feature maps only differ
+        # where the new grid straddles source cells. compared inside the images only, since the zero padding
+        # ramps over one pixel of each resolution
+        out_separate, out_fused = separate(), fused()
+        valid = out_separate[3][..., 0] > 0
+        rgb_diff = (out_separate[0][..., :3] - out_fused[0][..., :3])[valid].abs().max().item()
+        feat_diff = max(
+            (out_separate[0][..., 3:] - out_fused[0][..., 3:])[valid].abs().max().item(),
+            (out_separate[1] - out_fused[1])[valid].abs().max().item(),
+        )
+        if rgb_diff > args.rgb_tol:
+            failed.append(name)
+
+        t_stack = timeit(lambda: projector.stack_reference(featmaps, deep_semantics), args.n_iters, device)
+        t_separate = timeit(separate, args.n_iters, device)
+        t_fused = timeit(fused, args.n_iters, device)
+        print("{:>8} {:>7} {:>14.3f} {:>12.3f} {:>7.2f}x {:>12.3f} {:>10.2e} {:>10.2e}".format(
+            name, cfg["N_rays"], t_separate, t_fused, t_separate / t_fused, t_stack, rgb_diff, feat_diff))
+    if failed:
+        sys.exit("fused sampling changes the reference rgb beyond --rgb_tol {} for {}".format(
+            args.rgb_tol, ", ".join(failed)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Worker time and host-to-device bytes of the ScanNet frame decoding, with and without --gpu_preprocess.
+
+    python scripts/benchmark_gpu_preprocess.py --num_source_views 10 --frames 20
+
+Writes synthetic ScanNet-sized color jpgs and label pngs, decodes a target and its source views the way the data
+loader workers do in both modes, runs the GPUFramePreprocessor on the result and compares it with the cpu path.
+"""
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import config
+from gnt.data_loaders.gpu_preprocess import GPUFramePreprocessor
+from gnt.data_loaders.scannet_dataset import SCANNET_COLOR_SIZE, ScannetFrameReader
+from gnt.data_loaders.semantic_utils import PointSegClassMapping
+
+
+def write_frames(folder, n, rng):
+    H, W = SCANNET_COLOR_SIZE
+    rgb_files, label_files = [], []
+    for i in range(n):
+        # smooth color blobs and label regions compress like real frames
+        rgb = cv2.resize(rng.randint(0, 256, (H // 32, W // 32, 3)).astype(np.uint8), (W, H))
+        label = cv2.resize(rng.randint(0, 1200, (H // 64, W // 64)).astype(np.uint16), (W, H),
+                           interpolation=cv2.INTER_NEAREST)
+        rgb_files.append(os.path.join(folder, "{}.jpg".format(i)))
+        label_files.append(os.path.join(folder, "{}.png".format(i)))
+        cv2.imwrite(rgb_files[-1], rgb)
+        cv2.imwrite(label_files[-1], label)
+    return rgb_files, label_files
+
+
+def make_reader(args, gpu_preprocess):
+    reader = ScannetFrameReader()
+    reader.ratio = 320 / 1296
+    reader.h, reader.w = int(reader.ratio * 972), 320
+    reader.scan2nyu = np.random.RandomState(0).randint(0, 41, 1200).astype(np.int32)
+    reader.label_mapping = PointSegClassMapping(
+        valid_cat_ids=[1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 14, 16, 24, 28, 33, 34, 36, 39], max_cat_id=40
+    )
+    reader.init_frame_reader(args, gpu_preprocess=gpu_preprocess)
+    return reader
+
+
+def load(reader, rgb_files, label_files, n_views):
+    """
+    one dataset item: target and source frames and labels, stacked as returned by ScannetTrainDataset
+    """
+    ids = np.arange(n_views + 1) % len(rgb_files)
+    rgbs = np.stack([reader.read_rgb(rgb_files[i]) for i in ids])
+    labels = np.stack([reader.read_label(label_files[i]) for i in ids])
+    return {
+        "rgb": torch.from_numpy(rgbs[:1]),
+        "src_rgbs": torch.from_numpy(rgbs[1:])[None],
+        "labels": torch.from_numpy(labels[:1]),
+        "src_labels": torch.from_numpy(labels[1:])[None],
+    }
+
+
+def main():
+    parser = config.config_parser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--frames", type=int, default=20)
+    args = parser.parse_args()
+    args.frame_pool_mb = 0
+    device = torch.device(args.device)
+    rng = np.random.RandomState(0)
+
+    with tempfile.TemporaryDirectory() as folder:
+        rgb_files, label_files = write_frames(folder, args.frames, rng)
+        items = {}
+        for gpu_preprocess in [False, True]:
+            reader = make_reader(args, gpu_preprocess)
+            t0 = time.time()
+            for i in range(args.frames):
+                item = load(reader, np.roll(rgb_files, i), np.roll(label_files, i), args.num_source_views)
+            dt = (time.time() - t0) / args.frames
+            n_bytes = sum(v.numel() * v.element_size() for v in item.values())
+            print("{:>14}: worker time per item {:.1f}ms, host-to-device {:.2f}MB per item".format(
+                "gpu_preprocess" if gpu_preprocess else "cpu", 1000 * dt, n_bytes / 2**20))
+            items[gpu_preprocess] = (reader, item)
+
+    reader, item = items[True]
+    H, W = reader.h, reader.w
+    item["camera"] = torch.tensor([[H, W]], dtype=torch.float32)
+    stage = GPUFramePreprocessor(reader.label_table(), device)
+    out = stage(item)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    t0 = time.time()
+    for _ in range(10):
+        out = stage(item)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    print("gpu stage on {}: {:.2f}ms per item".format(device, 100 * (time.time() - t0)))
+
+    ref = items[False][1]
+    d_rgb = (out["src_rgbs"].cpu() - ref["src_rgbs"]).abs()
+    print("rgb vs cpu path: max |d| {:.3f}, mean |d| {:.4f} (jpeg reduction {}x)".format(
+        d_rgb.max().item(), d_rgb.mean().item(), reader.jpeg_reduction))
+    print("labels equal to the cpu path: {}".format(
+        bool((out["src_labels"].cpu() == ref["src_labels"]).all() and (out["labels"].cpu() == ref["labels"]).all())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Micro-benchmark of gnt.render_ray.sample_pdf against the previous loop-based implementation.
+
+    python scripts/benchmark_sample_pdf.py --device cuda --N_rays 512 2048 --M 62 190 --N_importance 32 64 128
+"""
+import argparse
+import itertools
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from gnt.render_ray import sample_pdf
+
+
+def sample_pdf_loop(bins, weights, N_samples, det=False):
+    """
+    previous implementation: bin-by-bin cdf inversion and per-sample copies of cdf and bins
+    """
+    M = weights.shape[1]
+    weights = weights + 1e-5
+    pdf = weights / torch.sum(weights, dim=-1, keepdim=True)
+    cdf = torch.cumsum(pdf, dim=-1)
+    cdf = torch.cat([torch.zeros_like(cdf[:, 0:1]), cdf], dim=-1)
+
+    if det:
+        u = torch.linspace(0.0, 1.0, N_samples, device=bins.device)
+        u = u.unsqueeze(0).repeat(bins.shape[0], 1)
+    else:
+        u = torch.rand(bins.shape[0], N_samples, device=bins.device)
+
+    above_inds = torch.zeros_like(u, dtype=torch.long)
+    for i in range(M):
+        above_inds += (u >= cdf[:, i : i + 1]).long()
+
+    below_inds = torch.clamp(above_inds - 1, min=0)
+    inds_g = torch.stack((below_inds, above_inds), dim=2)
+
+    cdf = cdf.unsqueeze(1).repeat(1, N_samples, 1)
+    cdf_g = torch.gather(input=cdf, dim=-1, index=inds_g)
+
+    bins = bins.unsqueeze(1).repeat(1, N_samples, 1)
+    bins_g = torch.gather(input=bins, dim=-1, index=inds_g)
+
+    denom = cdf_g[:, :, 1] - cdf_g[:, :, 0]
+    denom = torch.where(denom < 1e-5, torch.ones_like(denom), denom)
+    t = (u - cdf_g[:, :, 0]) / denom
+
+    samples = bins_g[:, :, 0] + t * (bins_g[:, :, 1] - bins_g[:, :, 0])
+    return samples
+
+
+def make_inputs(N_rays, M, device):
+    # sorted bins in [0.1, 10] and peaky weights, similar to coarse weights of a trained model
+    bins = torch.sort(torch.rand(N_rays, M + 1, device=device) * 9.9 + 0.1, dim=-1)[0]
+    weights = torch.softmax(torch.randn(N_rays, M, device=device) * 4.0, dim=-1)
+    return bins, weights
+
+
+def timeit(fn, n_iters, device):
+    for _ in range(3):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    t0 = time.time()
+    for _ in range(n_iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.time() - t0) / n_iters * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--N_rays", type=int, nargs="+", default=[512, 2048, 4096])
+    parser.add_argument("--M", type=int, nargs="+", default=[62, 190])
+    parser.add_argument("--N_importance", type=int, nargs="+", default=[32, 64, 128])
+    parser.add_argument("--n_iters", type=int, default=20)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    print("{:>8} {:>5} {:>6} {:>12} {:>12} {:>8} {:>10}".format(
+        "N_rays", "M", "N_imp", "loop (ms)", "search (ms)", "speedup", "max |diff|"))
+    for N_rays, M, N_importance in itertools.product(args.N_rays, args.M, args.N_importance):
+        bins, weights = make_inputs(N_rays, M, device)
+
+        # same seed -> same uniform samples, so the random mode is compared as well
+        max_diff = 0.0
+        for det in [True, False]:
+            torch.manual_seed(0)
+            ref = sample_pdf_loop(bins, weights, N_importance, det=det)
+            torch.manual_seed(0)
+            out = sample_pdf(bins, weights, N_importance, det=det)
+            max_diff = max(max_diff, (ref - out).abs().max().item())
+        assert max_diff < args.atol, "sample_pdf mismatch: {}".format(max_diff)
+
+        t_loop = timeit(lambda: sample_pdf_loop(bins, weights, N_importance), args.n_iters, device)
+        t_search = timeit(lambda: sample_pdf(bins, weights, N_importance), args.n_iters, device)
+        print("{:>8} {:>5} {:>6} {:>12.3f} {:>12.3f} {:>7.1f}x {:>10.2e}".format(
+            N_rays, M, N_importance, t_loop, t_search, t_loop / t_search, max_diff))
+
+
+if __name__ == "__main__":
+    main()
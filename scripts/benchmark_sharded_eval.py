@@ -0,0 +1,40 @@
+"""
+Wall-clock scaling of the sharded ScanNet evaluation from 1 to N workers, and a check that every worker count
+gives the metrics of the sequential run.
+
+    python scripts/benchmark_sharded_eval.py --config <config> --run_val --max_workers 4
+
+Runs eval_scannet.eval with --eval_workers 1, 2, ..., max_workers (all on the cpu without gpus). The timings
+include the start-up of the worker processes (imports, model and checkpoint loading).
+"""
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import config
+import eval_scannet
+
+
+def main():
+    parser = config.config_parser()
+    parser.add_argument("--run_val", action="store_true", help="run on val set")
+    parser.add_argument("--max_workers", type=int, default=4)
+    args = parser.parse_args()
+    args.semantic_color_map = eval_scannet.SEMANTIC_COLOR_MAP
+
+    summaries = {}
+    for num_workers in range(1, args.max_workers + 1):
+        args.eval_workers = num_workers
+        summaries[num_workers] = eval_scannet.eval(args)
+
+    base = summaries[1]
+    metrics = ["psnr", "lpips", "ssim", "iou", "global_iou"]
+    print("workers  seconds  speedup  identical to 1 worker")
+    for num_workers, summary in summaries.items():
+        identical = all(summary[k] == base[k] for k in metrics)
+        print("{:>7}  {:>7.1f}  {:>7.2f}  {}".format(
+            num_workers, summary["seconds"], base["seconds"] / summary["seconds"], identical))
+
+
+if __name__ == "__main__":
+    main()
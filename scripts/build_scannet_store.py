@@ -0,0 +1,76 @@
+"""
+One-time conversion of exported ScanNet scenes into the compact store read by the train_scannet_store dataset.
+
+    python scripts/build_scannet_store.py --split configs/scannetv2_train_split.txt --store data/scannet_store
+    python train_scannet.py --config <config> --train_dataset train_scannet_store --scannet_store data/scannet_store
+"""
+import argparse
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from gnt.data_loaders.scannet_store import MAX_SUBSAMPLE_FACTOR, build_scene_store, load_label_mapping
+
+
+def convert(job):
+    scene_path, store_dir, mapping_file, image_size, num_neighbors = job
+    scan2nyu, label_mapping = load_label_mapping(mapping_file)
+    t0 = time.time()
+    num_frames = build_scene_store(
+        scene_path, store_dir, scan2nyu, label_mapping, image_size=image_size, num_neighbors=num_neighbors
+    )
+    return scene_path, num_frames, time.time() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--split", type=str, nargs="+", default=["configs/scannetv2_train_split.txt"])
+    parser.add_argument("--rootdir", type=str, default="./", help="same as the training --rootdir")
+    parser.add_argument("--store", type=str, default="data/scannet_store")
+    parser.add_argument("--mapping_file", type=str, default="data/scannet/scannetv2-labels.combined.tsv")
+    parser.add_argument("--image_size", type=int, default=320)
+    parser.add_argument(
+        "--num_source_views",
+        type=int,
+        default=10,
+        help="same as the training --num_source_views, sizes the nearest view table",
+    )
+    parser.add_argument(
+        "--num_neighbors",
+        type=int,
+        default=None,
+        help="nearest views kept per frame, num_source_views * {} (what the training sampler draws from) "
+        "if not given".format(MAX_SUBSAMPLE_FACTOR),
+    )
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+    min_neighbors = args.num_source_views * MAX_SUBSAMPLE_FACTOR
+    if args.num_neighbors is None:
+        args.num_neighbors = min_neighbors
+    elif args.num_neighbors < min_neighbors:
+        parser.error(
+            "--num_neighbors must be at least {} for {} source views".format(min_neighbors, args.num_source_views)
+        )
+
+    jobs = []
+    for split in args.split:
+        for scene in np.loadtxt(split, dtype=str).tolist():
+            scene_path = os.path.join(args.rootdir + "data", scene[:-10])
+            store_dir = os.path.join(args.store, os.path.basename(scene[:-10]))
+            if not args.overwrite and os.path.isfile(os.path.join(store_dir, "meta.json")):
+                continue
+            jobs.append((scene_path, store_dir, args.mapping_file, args.image_size, args.num_neighbors))
+    print("converting {} scenes into {}".format(len(jobs), args.store))
+
+    with Pool(args.num_workers) as pool:
+        for scene_path, num_frames, t in pool.imap_unordered(convert, jobs):
+            print("{}: {} frames, {:.1f}s".format(scene_path, num_frames, t))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Mixed precision check of the ray branch, runs on CPU with bf16 (no GPU needed).
+
+    python scripts/check_amp.py --amp bf16 --channels_last --N_rand 256 --N_samples 32 --N_importance 16
+
+Renders the same ray batch with fp32 and under autocast from the same weights and reports the difference
+of the composited outputs, the loss and the gradients. It then takes an amp optimizer step and checks that
+the weights stayed fp32 and load strictly into a fresh fp32 model.
+"""
+import copy
+import os
+import sys
+from types import SimpleNamespace
+
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import config
+from benchmark_batched_training import make_ray_batch
+from gnt.amp import amp_dtype, autocast, make_grad_scaler, to_channels_last, contiguous_state_dict
+from gnt.feature_network import ResUNet
+from gnt.projection import Projector
+from gnt.render_ray import render_rays
+from gnt.transformer_network import GNT
+
+
+def forward(args, nets, projector, ray_batch):
+    net_coarse, feature_net = nets
+    src_imgs = ray_batch["src_rgbs"].flatten(0, 1).permute(0, 3, 1, 2)
+    ref_coarse_feats, _, _ = feature_net(src_imgs)
+    ret = render_rays(
+        ray_batch=ray_batch,
+        model=SimpleNamespace(net_coarse=net_coarse),
+        projector=projector,
+        featmaps=ref_coarse_feats,
+        # the FPN semantics need mmdet, the upsampled coarse features keep the sampling path exercised
+        ref_deep_semantics=torch.nn.functional.interpolate(
+            ref_coarse_feats.repeat(1, args.netwidth * 8 // args.coarse_feat_dim, 1, 1), scale_factor=2
+        ),
+        N_samples=args.N_samples,
+        inv_uniform=args.inv_uniform,
+        N_importance=args.N_importance,
+        det=True,
+        ret_alpha=args.N_importance > 0,
+        single_net=args.single_net,
+    )
+    out = ret["outputs_fine"] if ret["outputs_fine"] is not None else ret["outputs_coarse"]
+    loss = torch.mean((out["rgb"] - ray_batch["rgb"]) ** 2)
+    return out, loss
+
+
+def grads(nets):
+    return torch.cat([p.grad.flatten() for net in nets for p in net.parameters() if p.grad is not None])
+
+
+def main():
+    parser = config.config_parser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--image_size", type=int, nargs=2, default=[240, 320])
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    dtype = amp_dtype(args.amp)
+    assert dtype is not None, "pass --amp bf16|fp16"
+    torch.manual_seed(0)
+
+    def build():
+        net_coarse = GNT(
+            args,
+            in_feat_ch=args.coarse_feat_dim,
+            posenc_dim=3 + 3 * 2 * 10,
+            viewenc_dim=3 + 3 * 2 * 10,
+            ret_alpha=args.N_importance > 0,
+        ).to(device)
+        feature_net = ResUNet(
+            coarse_out_ch=args.coarse_feat_dim, fine_out_ch=args.fine_feat_dim, single_net=args.single_net
+        ).to(device)
+        return net_coarse, feature_net
+
+    nets = build()
+    # eval mode disables dropout, both passes then see the same network
+    for net in nets:
+        net.eval()
+    amp_nets = copy.deepcopy(nets)
+    if args.channels_last:
+        to_channels_last(amp_nets[1])
+    projector = Projector(device=device)
+    H, W = args.image_size
+    ray_batch = make_ray_batch(1, H, W, args.num_source_views, args.N_rand, device)
+
+    out, loss = forward(args, nets, projector, ray_batch)
+    loss.backward()
+    with autocast(device, dtype):
+        amp_out, amp_loss = forward(args, amp_nets, projector, ray_batch)
+    scaler = make_grad_scaler(device, dtype)
+    scaler.scale(amp_loss).backward()
+
+    print("output dtypes: rgb {}, depth {}, weights {}".format(
+        amp_out["rgb"].dtype, amp_out["depth"].dtype, amp_out["weights"].dtype))
+    print("max |rgb fp32 - rgb amp|: {:.3e}".format((out["rgb"] - amp_out["rgb"]).abs().max().item()))
+    print("max |depth fp32 - depth amp| / far: {:.3e}".format(
+        ((out["depth"] - amp_out["depth"]).abs().max() / ray_batch["depth_range"][0, 1]).item()))
+    print("loss fp32 {:.6f}, amp {:.6f}".format(loss.item(), amp_loss.item()))
+    g, amp_g = grads(nets), grads(amp_nets) / scaler.get_scale()
+    print("gradient cosine similarity: {:.4f}".format(torch.nn.functional.cosine_similarity(g, amp_g, dim=0).item()))
+
+    optimizer = torch.optim.Adam([p for net in amp_nets for p in net.parameters()], lr=1e-4)
+    scaler.step(optimizer)
+    scaler.update()
+    assert all(p.dtype == torch.float32 for net in amp_nets for p in net.parameters())
+    fresh = build()
+    for net, amp_net in zip(fresh, amp_nets):
+        net.load_state_dict(contiguous_state_dict(amp_net), strict=True)
+    print("weights stay fp32 and load strictly into an fp32 model")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Closeness check and peak memory of the attention backends of the GNT network.
+
+    python scripts/check_attention_backends.py --N_rand 512 --N_samples 192 --view_attn_chunk 128
+
+Runs the GNT network on random inputs with the reference configuration (--ray_attn_backend matmul,
+--view_attn_chunk 0) and with the configuration given on the command line, from the same weights, and
+reports the largest differences of the outputs and gradients. On CUDA the peak memory of both is printed too.
+"""
+import copy
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import config
+from gnt.transformer_network import GNT
+
+
+def run(net, inputs, backward):
+    inputs = [x.clone().requires_grad_(backward and x.is_floating_point()) for x in inputs]
+    net.zero_grad()
+    with torch.set_grad_enabled(backward):
+        rgb_alpha, deep_sem, _ = net(*inputs)
+        if backward:
+            (rgb_alpha.sum() + deep_sem.sum()).backward()
+    grads = torch.cat([p.grad.flatten() for p in net.parameters() if p.grad is not None]) if backward else None
+    return rgb_alpha.detach(), deep_sem.detach(), grads
+
+
+def measure(net, inputs, backward, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    t0 = time.time()
+    out = run(net, inputs, backward)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        peak = None
+    return out, time.time() - t0, peak
+
+
+def main():
+    parser = config.config_parser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+    # deep semantics are returned only with save_feature, they are compared as well
+    args.save_feature = True
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    ref_args = copy.copy(args)
+    ref_args.ray_attn_backend, ref_args.view_attn_chunk = "matmul", 0
+    ref_net = GNT(ref_args, in_feat_ch=args.coarse_feat_dim, posenc_dim=63, viewenc_dim=63, ret_alpha=True)
+    net = GNT(args, in_feat_ch=args.coarse_feat_dim, posenc_dim=63, viewenc_dim=63, ret_alpha=True)
+    net.load_state_dict(ref_net.state_dict())
+    # eval mode disables dropout, the backends are then deterministic and comparable
+    ref_net.to(device).eval()
+    net.to(device).eval()
+
+    N_rays, N_samples, N_views = args.N_rand, args.N_samples, args.num_source_views
+    inputs = [
+        torch.randn(N_rays, N_samples, N_views, args.coarse_feat_dim + 3, device=device),
+        torch.randn(N_rays, N_samples, N_views, args.netwidth * 8, device=device),
+        torch.randn(N_rays, N_samples, N_views, 4, device=device),
+        (torch.rand(N_rays, N_samples, N_views, 1, device=device) > 0.1).float(),
+        torch.randn(N_rays, N_samples, 3, device=device),
+        torch.randn(N_rays, 3, device=device),
+    ]
+
+    print("reference: matmul ray attention, unchunked view attention")
+    print("candidate: {} ray attention, view attention chunk {}".format(args.ray_attn_backend, args.view_attn_chunk))
+    for backward in [False, True]:
+        (ref_rgb, ref_sem, ref_g), ref_t, ref_peak = measure(ref_net, inputs, backward, device)
+        (rgb, sem, g), t, peak = measure(net, inputs, backward, device)
+        line = "{:>8}: max |d rgb/alpha| {:.2e}, max |d deep semantics| {:.2e}".format(
+            "backward" if backward else "forward",
+            (ref_rgb - rgb).abs().max().item(),
+            (ref_sem - sem).abs().max().item(),
+        )
+        if backward:
+            line += ", max |d grad| / max |grad| {:.2e}".format(
+                ((ref_g - g).abs().max() / ref_g.abs().max()).item()
+            )
+        print(line)
+        line = "          time {:.3f}s -> {:.3f}s".format(ref_t, t)
+        if device.type == "cuda":
+            line += ", peak memory {:.0f}MB -> {:.0f}MB".format(ref_peak, peak)
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
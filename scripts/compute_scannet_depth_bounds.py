@@ -0,0 +1,58 @@
+"""
+One-time pass over the depth frames of exported ScanNet scenes, writes per-frame near/far bounds next to the poses.
+
+    python scripts/compute_scannet_depth_bounds.py --split configs/scannetv2_train_split.txt configs/scannetv2_val_split.txt
+    python train_scannet.py --config <config> --depth_bounds
+
+The bounds are the 1st and 99th percentiles of the valid sensor depths of every frame, widened by --margin.
+The printed density gain is how much denser the N_samples of a ray are than over the fixed [0.1, 10.0] range,
+i.e. by how much N_samples can be reduced for the same sampling density.
+"""
+import argparse
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from gnt.data_loaders.depth_bounds import DEFAULT_DEPTH_RANGE, compute_scene_depth_bounds
+
+
+def compute(job):
+    scene_path, percentile, margin = job
+    t0 = time.time()
+    table = compute_scene_depth_bounds(scene_path, percentile=percentile, margin=margin)
+    return scene_path, table, time.time() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--split", type=str, nargs="+", default=["configs/scannetv2_train_split.txt"])
+    parser.add_argument("--rootdir", type=str, default="./", help="same as the training --rootdir")
+    parser.add_argument("--percentile", type=float, default=1.0, help="depths below / above it are outliers")
+    parser.add_argument("--margin", type=float, default=0.1, help="relative widening of the bounds")
+    parser.add_argument("--num_workers", type=int, default=8)
+    args = parser.parse_args()
+
+    jobs = []
+    for split in args.split:
+        for scene in np.loadtxt(split, dtype=str).tolist():
+            jobs.append((os.path.join(args.rootdir + "data", scene[:-10]), args.percentile, args.margin))
+    print("computing depth bounds of {} scenes".format(len(jobs)))
+
+    full = DEFAULT_DEPTH_RANGE[1] - DEFAULT_DEPTH_RANGE[0]
+    lengths = []
+    with Pool(args.num_workers) as pool:
+        for scene_path, table, t in pool.imap_unordered(compute, jobs):
+            length = table[:, 2] - table[:, 1]
+            lengths.append(length)
+            print("{}: {} frames, near {:.2f}, far {:.2f}, density gain {:.1f}x, {:.1f}s".format(
+                scene_path, len(table), table[:, 1].mean(), table[:, 2].mean(), full / length.mean(), t))
+    if lengths:
+        print("mean density gain over all frames: {:.1f}x".format(full / np.concatenate(lengths).mean()))
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,7 @@ from gnt.render_image import render_single_image
 from gnt.model import GNTModel
 from gnt.sample_ray import RaySamplerSingleImage
 from gnt.criterion import Criterion
+from gnt.error_map import ErrorMapStore
 from utils import img2mse, mse2psnr, img_HWC2CHW, colorize, cycle, img2psnr
 import config
 import torch.distributed as dist
@@ -132,6 +133,8 @@ def train(args):
     )
     # create projector
     projector = Projector(device=device)
+    # recent per-ray losses of every training frame, the sampling weights of sample_mode importance
+    error_maps = ErrorMapStore.from_args(args, device) if args.sample_mode == "importance" else None
 
     # Create criterion
     criterion = Criterion()
@@ -139,6 +142,8 @@ def train(args):
 
     global_step = model.start_step + 1
     epoch = 0
+    # wall-clock progress of the training psnr, to compare sampling modes per hour of training
+    train_start, first_psnr = time.time(), None
     while global_step < model.start_step + args.n_iters + 1:
         np.random.seed()
         for train_data in train_loader:
@@ -154,10 +159,15 @@ def train(args):
             N_rand = int(
                 1.0 * args.N_rand * args.num_source_views / train_data["src_rgbs"][0].shape[0]
             )
+            if error_maps is not None:
+                weights = error_maps.weights(ray_sampler.rgb_path, ray_sampler.H, ray_sampler.W)
+            else:
+                weights = None
             ray_batch = ray_sampler.random_sample(
                 N_rand,
                 sample_mode=args.sample_mode,
                 center_ratio=args.center_ratio,
+                weights=weights,
             )
 
             outs = model.feature_net(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
@@ -193,6 +203,13 @@ def train(args):
             model.optimizer.step()
             model.scheduler.step()
 
+            if error_maps is not None:
+                outputs = ret["outputs_fine"] if ret["outputs_fine"] is not None else ret["outputs_coarse"]
+                ray_errors = torch.sum((outputs["rgb"].detach() - ray_batch["rgb"]) ** 2, -1)
+                error_maps.update(
+                    ray_sampler.rgb_path, ray_sampler.H, ray_sampler.W, ray_batch["selected_inds"], ray_errors
+                )
+
             scalars_to_log["lr"] = model.scheduler.get_last_lr()[0]
             # end of core optimization loop
             dt = time.time() - time0
@@ -204,6 +221,14 @@ def train(args):
                     mse_error = img2mse(ret["outputs_coarse"]["rgb"], ray_batch["rgb"]).item()
                     scalars_to_log["train/coarse-loss"] = mse_error
                     scalars_to_log["train/coarse-psnr-training-batch"] = mse2psnr(mse_error)
+                    hours = (time.time() - train_start) / 3600
+                    scalars_to_log["train/wall-hours"] = hours
+                    if first_psnr is None:
+                        first_psnr = scalars_to_log["train/coarse-psnr-training-batch"]
+                    elif hours > 0:
+                        scalars_to_log["train/coarse-psnr-rise-per-hour"] = (
+                            scalars_to_log["train/coarse-psnr-training-batch"] - first_psnr
+                        ) / hours
                     if ret["outputs_fine"] is not None:
                         mse_error = img2mse(ret["outputs_fine"]["rgb"], ray_batch["rgb"]).item()
                         scalars_to_log["train/fine-loss"] = mse_error
@@ -269,6 +294,8 @@ def train(args):
             if global_step > model.start_step + args.n_iters + 1:
                 break
         epoch += 1
+    # the last checkpoint of --async_ckpt is on disk before the process exits
+    model.wait_for_checkpoint()
 
 
 @torch.no_grad()
@@ -119,7 +119,7 @@ def train(args):
             }
             # reference feature extractor
             ref_coarse_feats, ref_fine_feats, ref_deep_semantics = model.feature_net(tmp_train_data["src_rgbs"].squeeze(0).permute(0, 3, 1, 2).to(device))
-            ref_deep_semantics = model.feature_fpn(ref_deep_semantics)
+            ref_deep_semantics = model.reference_fpn(ref_deep_semantics)
             # load training rays
             ray_sampler = RaySamplerSingleImage(tmp_train_data, device)
             N_rand = int(
@@ -263,6 +263,8 @@ def train(args):
             if global_step > model.start_step + args.n_iters + 1:
                 break
         epoch += 1
+    # the last checkpoint of --async_ckpt is on disk before the process exits
+    model.wait_for_checkpoint()
 
 if __name__ == "__main__":
     parser = config.config_parser()
@@ -9,20 +9,24 @@ from torch.nn import functional as F
 from torch.utils.data import DataLoader
 
 from gnt.data_loaders import dataset_dict
-from gnt.render_ray import render_rays
-from gnt.render_image import render_single_image
+from gnt.render_ray import render_rays, OccupancyProxy
+from gnt.render_image import render_single_image, make_chunk_sizer
 from gnt.model import GNTModel
 from gnt.ibrnet import IBRNetModel
 
 
-from gnt.sample_ray import RaySamplerSingleImage
+from gnt.sample_ray import RaySamplerSingleImage, image_to_float
+from gnt.pixel_sampler import PixelSampler
+from gnt.error_map import ErrorMapStore
 from gnt.criterion import SemanticCriterion
 from utils import img_HWC2CHW, img2psnr, colorize, img2psnr, lpips, ssim
 from gnt.loss import RenderLoss, SemanticLoss, IoU
 import config
 import torch.distributed as dist
 from gnt.projection import Projector
-from gnt.data_loaders.create_training_dataset import create_training_dataset
+from gnt.feature_cache import ReferenceFeatureCache
+from gnt.data_loaders.create_training_dataset import create_training_dataset, collate_targets
+from gnt.data_loaders.gpu_preprocess import GPUFramePreprocessor
 import imageio
 import wandb 
 
@@ -104,9 +108,14 @@ def train(args):
             shutil.copy(args.config, f)
 
     # create training dataset
+    if args.gpu_preprocess and "train_scannet_store" in args.train_dataset.split("+"):
+        raise ValueError(
+            "--gpu_preprocess needs raw ScanNet frames, train_scannet_store reads frames that are already resized "
+            "and labels that are already mapped; drop --gpu_preprocess or use train_scannet"
+        )
     train_dataset, train_sampler = create_training_dataset(args)
-    # currently only support batch_size=1 (i.e., one set of target and source views) for each GPU node
-    # please use distributed parallel on multiple GPUs to train multiple target views per batch
+    # every batch holds batch_size target views, each with its own source views;
+    # N_rand rays are sampled from every target view and rendered together
     train_loader = torch.utils.data.DataLoader(
         train_dataset,
         batch_size=args.batch_size,
@@ -115,8 +124,11 @@ def train(args):
         pin_memory=True,
         sampler=train_sampler,
         shuffle=True if train_sampler is None else False,
+        collate_fn=collate_targets,
     )
     print(f'train set len {len(train_loader)}')
+    # blur, resize and label mapping of the uint8 frames and raw labels of the workers, batched on the gpu
+    gpu_preprocess = GPUFramePreprocessor(train_dataset.label_table(), device) if args.gpu_preprocess else None
 
     # create validation dataset
     val_set_lists, val_set_names = [], []
@@ -139,6 +151,19 @@ def train(args):
         )
     # create projector
     projector = Projector(device=device)
+    # training pixels, drawn on the gpu from a stream seeded per rank
+    pixel_sampler = PixelSampler.from_args(args, device)
+    # recent per-ray losses of every training frame, the sampling weights of sample_mode importance
+    error_maps = ErrorMapStore.from_args(args, device) if args.sample_mode == "importance" else None
+    # validation frames of a scene share most source views, encode each of them once per checkpoint
+    if args.ref_feat_cache_mb > 0 and not args.rectify_inplane_rotation:
+        ref_feat_cache = ReferenceFeatureCache(args.ref_feat_cache_mb, storage=args.ref_feat_cache_device)
+    else:
+        ref_feat_cache = None
+    # rays per chunk adapted to --chunk_mem_mb over all rendered views, None keeps --chunk_size
+    chunk_sizer = make_chunk_sizer(args)
+    # empty-space skipping pre-pass with --skip_empty, None otherwise
+    occupancy = OccupancyProxy.from_args(args)
 
     # Create criterion
     render_criterion = RenderLoss(args)
@@ -148,6 +173,8 @@ def train(args):
 
     global_step = model.start_step + 1
     epoch = 0
+    # wall-clock progress of the training metrics, to compare sampling modes per hour of training
+    train_start, first_metrics = time.time(), {}
     while global_step < model.start_step + args.n_iters + 1:
         for train_data in train_loader:
             time0 = time.time()
@@ -155,81 +182,114 @@ def train(args):
             if args.distributed:
                 train_sampler.set_epoch(epoch)
 
+            if gpu_preprocess is not None:
+                train_data = gpu_preprocess(train_data)
+
             # load training rays
             ray_sampler = RaySamplerSingleImage(train_data, device)
             N_rand = int(
                 1.0 * args.N_rand * args.num_source_views / train_data["src_rgbs"][0].shape[0]
             )
+            if error_maps is not None:
+                weights = error_maps.weights(ray_sampler.rgb_path, ray_sampler.H, ray_sampler.W)
+            else:
+                weights = None
             ray_batch = ray_sampler.random_sample(
                 N_rand,
                 sample_mode=args.sample_mode,
                 center_ratio=args.center_ratio,
+                pixel_sampler=pixel_sampler,
+                weights=weights,
             )
 
-            if args.backbone_pretrain is False:
-                # reference feature extractor
-                ref_coarse_feats, _, ref_deep_semantics = model.feature_net(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
-                ref_deep_semantics = model.feature_fpn(ref_deep_semantics)
-
-                # novel view feature extractor
-                _, _, que_deep_semantics = model.feature_net(train_data["rgb"].permute(0, 3, 1, 2).to(device))
-                que_deep_semantics = model.feature_fpn(que_deep_semantics)
-            else:
-                # reference feature extractor
-                ref_coarse_feats, _, _ = model.feature_net(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
-                src_images = F.interpolate(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2), 
-                                       scale_factor = 2, mode='bilinear', align_corners=True) # 先扩展一倍
-                ref_deep_semantics = model.sem_feature_net(src_images)
-                ref_deep_semantics = model.feature_fpn(ref_deep_semantics)
-
-                # novel view feature extractor
-                images = F.interpolate(train_data["rgb"].permute(0, 3, 1, 2).to(device), 
-                                       scale_factor = 2, mode='bilinear', align_corners=True) # 先扩展一倍
-                que_deep_semantics = model.sem_feature_net(images)
-                que_deep_semantics = model.feature_fpn(que_deep_semantics)
-
-            ret = render_rays(
-                ray_batch=ray_batch,
-                model=model,
-                projector=projector,
-                featmaps=ref_coarse_feats,
-                ref_deep_semantics=ref_deep_semantics, # reference encoder的语义输出
-                N_samples=args.N_samples,
-                inv_uniform=args.inv_uniform,
-                N_importance=args.N_importance,
-                det=args.det,
-                white_bkgd=args.white_bkgd,
-                ret_alpha=args.N_importance > 0,
-                single_net=args.single_net,
-                save_feature=args.save_feature,
-                model_type = args.model
-            )
-
-            if args.selected_inds is True:
-                selected_inds = ray_batch["selected_inds"]
-                corase_sem_out = model.sem_seg_head(que_deep_semantics, ret['outputs_coarse']['feats_out'].detach(), selected_inds).permute(0,2,1)    # 34
-                ret['outputs_coarse']['sems'], ret['outputs_fine']['sems'] = corase_sem_out, corase_sem_out
-            else:
-                corase_sem_out = model.sem_seg_head(que_deep_semantics, None, None)
-                ray_batch['labels'] = train_data['labels'].to(device)
-                ret['outputs_coarse']['sems'] = corase_sem_out.permute(0,2,3,1)
-                ret['outputs_fine']['sems'] = corase_sem_out.permute(0,2,3,1)
+            # forward passes and losses under autocast with --amp, backward through the grad scaler
+            with model.autocast():
+                # source views of all target views, [batch*n_views, 3, h, w]; permuted from NHWC, so already channels-last
+                src_imgs = ray_batch["src_rgbs"].flatten(0, 1).permute(0, 3, 1, 2)
+                if args.backbone_pretrain is False:
+                    # reference feature extractor
+                    ref_coarse_feats, _, ref_deep_semantics = model.feature_net(src_imgs)
+                    ref_deep_semantics = model.reference_fpn(ref_deep_semantics)
+
+                    # novel view feature extractor
+                    _, _, que_deep_semantics = model.feature_net(image_to_float(train_data["rgb"], device).permute(0, 3, 1, 2))
+                    que_deep_semantics = model.feature_fpn(que_deep_semantics)
+                else:
+                    # reference feature extractor
+                    ref_coarse_feats, _, _ = model.feature_net(src_imgs)
+                    src_images = F.interpolate(src_imgs, 
+                                           scale_factor = 2, mode='bilinear', align_corners=True) # 先扩展一倍
+                    ref_deep_semantics = model.sem_feature_net(src_images)
+                    ref_deep_semantics = model.reference_fpn(ref_deep_semantics)
+
+                    # novel view feature extractor
+                    images = F.interpolate(image_to_float(train_data["rgb"], device).permute(0, 3, 1, 2), 
+                                           scale_factor = 2, mode='bilinear', align_corners=True) # 先扩展一倍
+                    que_deep_semantics = model.sem_feature_net(images)
+                    que_deep_semantics = model.feature_fpn(que_deep_semantics)
+
+                if args.fused_sampling:
+                    ref_stack = projector.stack_reference(ref_coarse_feats, ref_deep_semantics)
+                else:
+                    ref_stack = None
+
+                ret = render_rays(
+                    ray_batch=ray_batch,
+                    model=model,
+                    projector=projector,
+                    featmaps=ref_coarse_feats,
+                    ref_deep_semantics=ref_deep_semantics, # reference encoder的语义输出
+                    N_samples=args.N_samples,
+                    inv_uniform=args.inv_uniform,
+                    N_importance=args.N_importance,
+                    det=args.det,
+                    white_bkgd=args.white_bkgd,
+                    ret_alpha=args.N_importance > 0,
+                    single_net=args.single_net,
+                    save_feature=args.save_feature,
+                    model_type = args.model,
+                    ref_stack=ref_stack,
+                    occupancy=occupancy,
+                )
+
+                if args.selected_inds is True:
+                    selected_inds = ray_batch["selected_inds"]
+                    corase_sem_out = model.sem_seg_head(
+                        que_deep_semantics, ret['outputs_coarse']['feats_out'].detach(), selected_inds,
+                        out_size=(ray_sampler.H, ray_sampler.W),
+                    ).permute(0,2,1)    # 34
+                    ret['outputs_coarse']['sems'], ret['outputs_fine']['sems'] = corase_sem_out, corase_sem_out
+                else:
+                    corase_sem_out = model.sem_seg_head(que_deep_semantics, None, None)
+                    ray_batch['labels'] = train_data['labels'].to(device)
+                    ret['outputs_coarse']['sems'] = corase_sem_out.permute(0,2,3,1)
+                    ret['outputs_fine']['sems'] = corase_sem_out.permute(0,2,3,1)
             
-            # ref_sem_out = model.sem_seg_head(ref_deep_semantics, None, None)   # 对reference view也进行语义分割训练
-            # ret['reference_sems'] = ref_sem_out.permute(0,2,3,1)
+                # ref_sem_out = model.sem_seg_head(ref_deep_semantics, None, None)   # 对reference view也进行语义分割训练
+                # ret['reference_sems'] = ref_sem_out.permute(0,2,3,1)
 
-            del ret['outputs_coarse']['feats_out'], ret['outputs_fine']['feats_out']
+                del ret['outputs_coarse']['feats_out'], ret['outputs_fine']['feats_out']
 
-            # compute loss
-            render_loss = render_criterion(ret, ray_batch)
-            semantic_loss = semantic_criterion(ret, ray_batch, step=global_step)
-            loss = semantic_loss['train/semantic-loss'] + render_loss['train/rgb-loss']
+                # compute loss
+                render_loss = render_criterion(ret, ray_batch)
+                semantic_loss = semantic_criterion(ret, ray_batch, step=global_step)
+                loss = semantic_loss['train/semantic-loss'] + render_loss['train/rgb-loss']
 
-            model.optimizer.zero_grad()
-            loss.backward()
-            model.optimizer.step()
+            model.backward_step(loss)
             model.scheduler.step()
 
+            if error_maps is not None:
+                with torch.no_grad():
+                    ray_errors = render_criterion.ray_losses(ret, ray_batch)
+                    if args.selected_inds is True:
+                        ray_errors += semantic_criterion.ray_losses(ret['outputs_coarse']['sems'], ray_batch['labels'])
+                    else:
+                        # full-image predictions, the losses of the sampled rays are gathered
+                        ray_errors += semantic_criterion.ray_losses(
+                            ret['outputs_coarse']['sems'], ray_batch['labels'], ray_batch['selected_inds'])
+                error_maps.update(
+                    ray_sampler.rgb_path, ray_sampler.H, ray_sampler.W, ray_batch['selected_inds'], ray_errors)
+
             scalars_to_log["loss"] = loss.item()
             scalars_to_log["train/semantic-loss"] = semantic_loss['train/semantic-loss'].item()
             scalars_to_log["train/rgb-loss"] = render_loss['train/rgb-loss'].item()
@@ -249,11 +309,26 @@ def train(args):
                         iou_metric = iou_criterion(ret, ray_batch, global_step)
                         scalars_to_log["train/iou"] = iou_metric['miou'].item()
 
+                    hours = (time.time() - train_start) / 3600
+                    scalars_to_log["train/wall-hours"] = hours
+                    for k in ["train/coarse-psnr", "train/iou"]:
+                        if k in scalars_to_log:
+                            first_metrics.setdefault(k, scalars_to_log[k])
+                            if hours > 0:
+                                scalars_to_log[k + "-rise-per-hour"] = (scalars_to_log[k] - first_metrics[k]) / hours
+
                     logstr = "{} Epoch: {}  step: {} ".format(args.expname, epoch, global_step)
                     for k in scalars_to_log.keys():
                         logstr += " {}: {:.6f}".format(k, scalars_to_log[k])
                     print(logstr)
                     print("each iter time {:.05f} seconds".format(dt))
+                    if getattr(train_dataset, "rgb_pool", None) is not None:
+                        print(train_dataset.rgb_pool.stats())
+                        print(train_dataset.label_pool.stats())
+                    if error_maps is not None:
+                        print(error_maps.stats())
+                    if occupancy is not None:
+                        print(occupancy.stats())
 
                     if args.expname != 'debug':
                         wandb.log({
@@ -299,6 +374,10 @@ def train(args):
                                 out_folder=out_folder,
                                 ret_alpha=args.N_importance > 0,
                                 single_net=args.single_net,
+                                ref_feat_cache=ref_feat_cache,
+                                chunk_sizer=chunk_sizer,
+                                occupancy=occupancy,
+                                ckpt_step=global_step,
                             )
                             psnr_scores.append(psnr_curr_img)
                             lpips_scores.append(lpips_curr_img)
@@ -327,11 +406,17 @@ def train(args):
                     wandb.log({
                         "val-PSNR/Average": np.mean(all_psnr_scores), 
                         "val-IoU/Average": np.mean(all_iou_scores)})
+                    if ref_feat_cache is not None:
+                        # the weights change before the next validation, release the memory for training
+                        print(ref_feat_cache.stats())
+                        ref_feat_cache.clear()
                  
             global_step += 1
             if global_step > model.start_step + args.n_iters + 1:
                 break
         epoch += 1
+    # the last checkpoint of --async_ckpt is on disk before the process exits
+    model.wait_for_checkpoint()
 
 @torch.no_grad()
 def log_view(
@@ -348,26 +433,45 @@ def log_view(
     out_folder="",
     ret_alpha=False,
     single_net=True,
+    ref_feat_cache=None,
+    chunk_sizer=None,
+    occupancy=None,
+    ckpt_step=0,
 ):
     model.switch_to_eval()
-    with torch.no_grad():
+    with torch.no_grad(), model.autocast():
         ray_batch = ray_sampler.get_all()
 
         ########       测试直接使用sem seg head来预测   #######
         # _, _, que_deep_semantics = model.feature_net(gt_img.unsqueeze(0).permute(0, 3, 1, 2).to(ref_coarse_feats.device))
         # que_deep_semantics = model.feature_fpn(que_deep_semantics)
         
-        if args.backbone_pretrain is False:
-            # reference feature extractor
-            ref_coarse_feats, _, ref_deep_semantics = model.feature_net(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
-            ref_deep_semantics = model.feature_fpn(ref_deep_semantics)
+        def encode_reference(src_imgs):
+            if args.backbone_pretrain is False:
+                # reference feature extractor
+                ref_coarse_feats, _, ref_deep_semantics = model.feature_net(src_imgs)
+                ref_deep_semantics = model.reference_fpn(ref_deep_semantics)
+            else:
+                # reference feature extractor
+                ref_coarse_feats, _, _ = model.feature_net(src_imgs)
+                src_images = F.interpolate(src_imgs, 
+                                           scale_factor = 2, mode='bilinear', align_corners=True) # 先扩展一倍
+                ref_deep_semantics = model.sem_feature_net(src_images)
+                ref_deep_semantics = model.reference_fpn(ref_deep_semantics)
+            return ref_coarse_feats, ref_deep_semantics
+
+        src_imgs = ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2)
+        if ref_feat_cache is not None and ray_sampler.src_rgb_paths is not None:
+            ref_coarse_feats, ref_deep_semantics = ref_feat_cache.lookup(
+                ray_sampler.src_rgb_paths, src_imgs, encode_reference, step=ckpt_step
+            )
+        else:
+            ref_coarse_feats, ref_deep_semantics = encode_reference(src_imgs)
+
+        if args.fused_sampling:
+            ref_stack = projector.stack_reference(ref_coarse_feats, ref_deep_semantics)
         else:
-            # reference feature extractor
-            ref_coarse_feats, _, _ = model.feature_net(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2))
-            src_images = F.interpolate(ray_batch["src_rgbs"].squeeze(0).permute(0, 3, 1, 2), 
-                                       scale_factor = 2, mode='bilinear', align_corners=True) # 先扩展一倍
-            ref_deep_semantics = model.sem_feature_net(src_images)
-            ref_deep_semantics = model.feature_fpn(ref_deep_semantics)
+            ref_stack = None
 
         ret = render_single_image(
             ray_sampler=ray_sampler,
@@ -385,10 +489,13 @@ def log_view(
             deep_semantics=ref_deep_semantics, # encoder的语义输出
             ret_alpha=ret_alpha,
             single_net=single_net,
+            ref_stack=ref_stack,
+            chunk_sizer=chunk_sizer,
+            occupancy=occupancy,
         )
         
-        ret['outputs_coarse']['sems'] = model.sem_seg_head(ret['outputs_coarse']['feats_out'].permute(2,0,1).unsqueeze(0).to(ref_coarse_feats.device), None, None).permute(0,2,3,1)
-        ret['outputs_fine']['sems'] = model.sem_seg_head(ret['outputs_coarse']['feats_out'].permute(2,0,1).unsqueeze(0).to(ref_coarse_feats.device), None, None).permute(0,2,3,1)
+        ret['outputs_coarse']['sems'] = model.sem_seg_head(ret['outputs_coarse']['feats_out'].permute(2,0,1).unsqueeze(0).to(ref_coarse_feats.device), None, None, out_size=(ray_sampler.H, ray_sampler.W)).permute(0,2,3,1)
+        ret['outputs_fine']['sems'] = model.sem_seg_head(ret['outputs_coarse']['feats_out'].permute(2,0,1).unsqueeze(0).to(ref_coarse_feats.device), None, None, out_size=(ray_sampler.H, ray_sampler.W)).permute(0,2,3,1)
 
 
     average_im = ray_sampler.src_rgbs.cpu().mean(dim=(0, 1))
@@ -1,22 +1,17 @@
 import torch
 import numpy as np
-from matplotlib.backends.backend_agg import FigureCanvasAgg
-from matplotlib.figure import Figure
-import matplotlib as mpl
-from matplotlib import cm
 import cv2
 import os
+import contextlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 import shutil
 import torch.nn.functional as F
 from torch.autograd import Variable
 from math import exp
-import lpips
 
-lpips_alex = lpips.LPIPS(net="alex")  # best forward scores
-lpips_vgg = lpips.LPIPS(
-    net="vgg"
-)  # closer to "traditional" perceptual loss, when used for optimization
+# matplotlib and lpips are imported on first use, importing utils stays cheap (e.g. in DataLoader workers)
 
 HUGE_NUMBER = 1e10
 TINY_NUMBER = 1e-6  # float32 only has 7 decimal digits precision
@@ -88,6 +83,11 @@ def get_vertical_colorbar(h, vmin, vmax, cmap_name="jet", label=None, cbar_preci
     :param label
     :return:
     """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    import matplotlib as mpl
+    from matplotlib import cm
+
     fig = Figure(figsize=(2, 8), dpi=100)
     fig.subplots_adjust(right=1.5)
     canvas = FigureCanvasAgg(fig)
@@ -165,6 +165,8 @@ def colorize_np(
     x = (x - vmin) / (vmax - vmin)
     # x = np.clip(x, 0., 1.)
 
+    from matplotlib import cm
+
     cmap = cm.get_cmap(cmap_name)
     x_new = cmap(x)[:, :, :3]
 
@@ -267,38 +269,170 @@ class SSIM(torch.nn.Module):
 
 def ssim_utils(img1, img2, window_size=11, size_average=True):
     (_, channel, _, _) = img1.size()
-    window = create_window(window_size, channel)
-
-    if img1.is_cuda:
-        window = window.cuda(img1.get_device())
-    window = window.type_as(img1)
-
+    window = metrics_engine.window(window_size, channel, img1.device, img1.dtype)
     return _ssim(img1, img2, window, window_size, channel, size_average)
 
 
-def ssim(img1, img2, window_size=11, size_average=True, format="NCHW"):
+def to_nchw(img, format="NCHW"):
     if format == "HWC":
-        img1 = img1.permute([2, 0, 1])[None, ...]
-        img2 = img2.permute([2, 0, 1])[None, ...]
+        return img.permute([2, 0, 1])[None, ...]
     elif format == "NHWC":
-        img1 = img1.permute([0, 3, 1, 2])
-        img2 = img2.permute([0, 3, 1, 2])
+        return img.permute([0, 3, 1, 2])
+    return img
 
-    return ssim_utils(img1, img2, window_size, size_average)
+
+def ssim(img1, img2, window_size=11, size_average=True, format="NCHW"):
+    return metrics_engine.ssim(to_nchw(img1, format), to_nchw(img2, format), window_size, size_average)
 
 
 def lpips(img1, img2, net="vgg", format="NCHW"):
-    if format == "HWC":
-        img1 = img1.permute([2, 0, 1])[None, ...]
-        img2 = img2.permute([2, 0, 1])[None, ...]
-    elif format == "NHWC":
-        img1 = img1.permute([0, 3, 1, 2])
-        img2 = img2.permute([0, 3, 1, 2])
+    """
+    alex: best forward scores, vgg: closer to "traditional" perceptual loss, when used for optimization
+    """
+    return metrics_engine.lpips(to_nchw(img1, format), to_nchw(img2, format), net)
+
+
+class MetricsEngine(object):
+    """
+    image quality metrics (psnr, ssim, lpips) of rendered frames.
+    the lpips networks are built on first use, once per (net, device), and the ssim windows are cached per
+    (window size, channel, device, dtype). submitted frames are batched, batch_size frames of the same size go
+    through one forward, and with background=True the batches run in a worker thread (on a side stream on
+    the gpu) while the caller renders the next frames.
+    :param device: where the metrics run, None keeps the device of the inputs
+    """
 
-    if net == "alex":
-        return lpips_alex(img1, img2)
-    elif net == "vgg":
-        return lpips_vgg(img1, img2)
+    def __init__(self, device=None, batch_size=1, background=False):
+        self.device = None if device is None else torch.device(device)
+        self.batch_size = max(int(batch_size), 1)
+        self.background = background
+        self.nets = {}
+        self.windows = {}
+        self.streams = {}
+        self.pending = []
+        self.executor = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_args(cls, args, device):
+        return cls(device, batch_size=args.metrics_batch, background=not args.metrics_sync)
+
+    def lpips_net(self, net, device):
+        key = (net, device)
+        with self.lock:
+            if key not in self.nets:
+                import lpips
+
+                self.nets[key] = lpips.LPIPS(net=net).to(device).eval()
+            return self.nets[key]
+
+    def window(self, window_size, channel, device, dtype):
+        key = (window_size, channel, device, dtype)
+        window = self.windows.get(key)
+        if window is None:
+            window = create_window(window_size, channel).to(device, dtype)
+            self.windows[key] = window
+        return window
+
+    def ssim(self, img1, img2, window_size=11, size_average=True):
+        """
+        :param img1: [N, C, H, W]
+        :return: mean ssim, or [N] per-frame ssim without size_average
+        """
+        channel = img1.shape[1]
+        window = self.window(window_size, channel, img1.device, img1.dtype)
+        return _ssim(img1, img2, window, window_size, channel, size_average)
+
+    def lpips(self, img1, img2, net="vgg"):
+        """
+        :param img1: [N, C, H, W]
+        :return: [N, 1, 1, 1] lpips of the frames
+        """
+        return self.lpips_net(net, img1.device)(img1, img2)
+
+    def scores(self, preds, gts):
+        """
+        :param preds: [N, H, W, 3] rendered frames
+        :param gts: [N, H, W, 3] ground truth
+        :return: list of N {'psnr', 'ssim', 'lpips'} of the frames
+        """
+        device = self.device or preds.device
+        preds, gts = to_nchw(preds, "NHWC").to(device), to_nchw(gts, "NHWC").to(device)
+        mse = ((preds - gts) ** 2).flatten(1).mean(dim=1)
+        ssim = self.ssim(preds, gts, size_average=False)
+        lpips = self.lpips(preds, gts).flatten()
+        # one host sync for the whole batch
+        mse, ssim, lpips = torch.stack([mse, ssim, lpips]).float().cpu().tolist()
+        return [{"psnr": mse2psnr(m), "ssim": s, "lpips": l} for m, s, l in zip(mse, ssim, lpips)]
+
+    def submit(self, pred, gt, format="HWC"):
+        """
+        queues the metrics of one frame, its batch runs once batch_size frames are queued or on flush()
+        :return: Future of {'psnr', 'ssim', 'lpips'} of the frame
+        """
+        if format == "HWC":
+            pred, gt = pred[None], gt[None]
+        future = Future()
+        self.pending.append((pred.detach(), gt, future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        return future
+
+    def flush(self):
+        """
+        runs the queued frames, must be called before waiting on their futures
+        """
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        ready = None
+        if any(pred.is_cuda for pred, _, _ in batch):
+            # the frames may still be written by the current stream
+            ready = torch.cuda.Event()
+            ready.record()
+        if not self.background:
+            self.run(batch, ready)
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metrics")
+        self.executor.submit(self.run, batch, ready)
+
+    def side_stream(self, device):
+        if device.type != "cuda" or not self.background:
+            return None
+        if device not in self.streams:
+            self.streams[device] = torch.cuda.Stream(device)
+        return self.streams[device]
+
+    def run(self, batch, ready=None):
+        try:
+            # frames of one size per forward
+            groups = {}
+            for frame in batch:
+                groups.setdefault(tuple(frame[0].shape[1:]), []).append(frame)
+            stream = self.side_stream(self.device or batch[0][0].device)
+            with torch.no_grad(), torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+                if stream is not None and ready is not None:
+                    stream.wait_event(ready)
+                for frames in groups.values():
+                    preds = torch.cat([pred for pred, _, _ in frames])
+                    gts = torch.cat([gt.to(pred.device) for pred, gt, _ in frames])
+                    for (_, _, future), scores in zip(frames, self.scores(preds, gts)):
+                        future.set_result(scores)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def close(self):
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+# shared by lpips() and ssim(), runs on the device of the inputs
+metrics_engine = MetricsEngine()
 
 
 def concat_images(img0,img1,vert=False):